@@ -0,0 +1,46 @@
+"""Free-slot search over room reservations."""
+
+from itertools import groupby
+
+
+def free_slots(busy, window_start, window_end, min_duration):
+    """Get the gaps of at least min_duration between busy intervals.
+
+    busy must be (start, end) pairs sorted by start; they may overlap and
+    may extend past the window. Returns (start, end) pairs clipped to the
+    window.
+    """
+    slots = []
+    cursor = window_start
+    for start, end in busy:
+        if start > cursor:
+            gap_end = min(start, window_end)
+            if gap_end - cursor >= min_duration and gap_end > cursor:
+                slots.append((cursor, gap_end))
+        if end > cursor:
+            cursor = end
+        if cursor >= window_end:
+            return slots
+    if window_end - cursor >= min_duration and window_end > cursor:
+        slots.append((cursor, window_end))
+    return slots
+
+
+def find_free_slots(room_ids, busy_rows, window_start, window_end,
+                    min_duration):
+    """Get the free slots of each room in a single pass over reservations.
+
+    busy_rows must be (room_id, start, end) sorted by room and start.
+    Returns a dict of room id -> free slots, leaving out rooms with none.
+    """
+    busy_by_room = {}
+    for room_id, rows in groupby(busy_rows, key=lambda r: r[0]):
+        busy_by_room[room_id] = [(start, end) for _, start, end in rows]
+
+    result = {}
+    for room_id in room_ids:
+        slots = free_slots(busy_by_room.get(room_id, ()), window_start,
+                           window_end, min_duration)
+        if slots:
+            result[room_id] = slots
+    return result
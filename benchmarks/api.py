@@ -0,0 +1,318 @@
+"""Measure throughput and latency of the /v1 API against a large database.
+
+Seeds a SQLite database with thousands of users, teams and rooms and
+hundreds of thousands of reservations, then times a series of requests to
+each endpoint: in-process through the Flask test client and, with --http,
+over HTTP to gunicorn. Results can be written to a JSON file and compared
+with an earlier run, e.g. one from a previous commit.
+
+Usage: python benchmarks/api.py [--reservations 200000] [--output new.json]
+                                [--compare old.json] [--http]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from serving import ROOT, wait_until_up
+
+import database
+from models import User
+from sample_data import SLOT, SPAN_DAYS
+
+
+def seed(path, args):
+    """Create and fill the database; return what the scenarios need."""
+    database.set_engine('sqlite:///' + path)
+    generated = database.init_db(
+        users=args.users, teams=args.teams, rooms=args.rooms,
+        reservations=args.reservations, random_seed=args.seed)
+    database.engine.execute('ANALYZE')
+
+    rng = random.Random(args.seed)
+    admin = User.query.filter_by(name='admin').first()
+    fixture = {
+        'admin_token': admin.generate_auth_token(),
+        'users': ['user%06d' % u
+                  for u in rng.sample(generated['users'], 50)],
+        'teams': [],
+        'rooms': generated['rooms'],
+        'today': generated['origin']
+    }
+    for team_id, user_id in rng.sample(generated['teams'], 50):
+        user = User.query.get(user_id)
+        fixture['teams'].append((team_id, user.generate_auth_token()))
+    database.get_db().remove()
+    return fixture
+
+
+def scenarios(fixture):
+    """Get (name, request) pairs; request(i) returns method, path, body
+    and headers for the ith request."""
+    rng = random.Random(0)
+    admin = {'Authorization': 'Bearer ' + fixture['admin_token']}
+    # new reservations go after the seeded ones, with a gap between each
+    # since touching reservations conflict
+    future = fixture['today'] + datetime.timedelta(days=SPAN_DAYS + 1)
+    rooms = fixture['rooms']
+
+    def auth(i):
+        return 'POST', '/v1/auth', json.dumps(
+            {'username': rng.choice(fixture['users'])}), {}
+
+    def reservation_add(i):
+        team_id, token = fixture['teams'][i % len(fixture['teams'])]
+        start = future + (i // len(rooms)) * 2 * SLOT
+        return 'POST', '/v1/reservation', json.dumps({
+            'team_id': team_id,
+            'room_id': rooms[i % len(rooms)],
+            'start': start.isoformat(),
+            'end': (start + SLOT).isoformat()
+        }), {'Authorization': 'Bearer ' + token}
+
+    def get_reservations(i):
+        return 'GET', '/v1/reservation', None, {}
+
+    def get_reservations_window(i):
+        day = fixture['today'] + datetime.timedelta(
+            days=rng.randint(-SPAN_DAYS, SPAN_DAYS - 1))
+        return 'GET', '/v1/reservation?start=%s&end=%s' % (
+            day.isoformat(), (day + datetime.timedelta(days=1)).isoformat()
+        ), None, {}
+
+    def team_read(i):
+        team_id, _ = rng.choice(fixture['teams'])
+        return 'GET', '/v1/team/%d' % team_id, None, admin
+
+    def user_search_partial(i):
+        return 'GET', '/v1/user?search=user%03d' % rng.randint(0, 999), \
+            None, {}
+
+    return [
+        ('auth', auth),
+        ('reservation_add', reservation_add),
+        ('get_reservations', get_reservations),
+        ('get_reservations_window', get_reservations_window),
+        ('team_read', team_read),
+        ('user_search_partial', user_search_partial)
+    ]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000
+    }
+
+
+def run_in_process(fixture, requests, warmup):
+    """Time each scenario through the Flask test client."""
+    import main
+    client = main.app.test_client()
+    results = {}
+    for name, make in scenarios(fixture):
+        for i in range(warmup):
+            send_test_client(client, make(i))
+        latencies = []
+        errors = 0
+        started = time.time()
+        for i in range(warmup, warmup + requests):
+            request_started = time.time()
+            if not send_test_client(client, make(i)):
+                errors += 1
+            latencies.append(time.time() - request_started)
+        results[name] = summarize(latencies, errors, time.time() - started)
+        report('in-process', name, results[name])
+    return results
+
+
+def send_test_client(client, request):
+    method, path, body, headers = request
+    rv = client.open(path, method=method, data=body, headers=headers,
+                     content_type='application/json')
+    return rv.status_code < 400
+
+
+def run_http(fixture, directory, requests, warmup, clients, workers):
+    """Time each scenario against gunicorn from concurrent clients."""
+    env = dict(os.environ, PYTHONPATH=ROOT, WEB_WORKERS=str(workers))
+    server = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn.app.wsgiapp',
+        '-c', os.path.join(ROOT, 'gunicorn_conf.py'),
+        '--bind', '127.0.0.1:5105', 'wsgi:app'
+    ], cwd=directory, env=env, stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:5105'
+    results = {}
+    try:
+        wait_until_up(base_url + '/v1/room')
+        # reservation_add must not reuse the in-process run's slots
+        offset = warmup + requests
+        for name, make in scenarios(fixture):
+            for i in range(warmup):
+                send_http(base_url, make(offset + i))
+            latencies = []
+            errors = []
+            lock = threading.Lock()
+            counter = iter(range(offset + warmup,
+                                 offset + warmup + requests))
+
+            def client():
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    request_started = time.time()
+                    ok = send_http(base_url, make(i))
+                    with lock:
+                        latencies.append(time.time() - request_started)
+                        if not ok:
+                            errors.append(i)
+
+            started = time.time()
+            threads = [threading.Thread(target=client)
+                       for _ in range(clients)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            results[name] = summarize(latencies, len(errors),
+                                      time.time() - started)
+            report('http', name, results[name])
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+
+def send_http(base_url, request):
+    method, path, body, headers = request
+    request = urllib2.Request(base_url + path, body,
+                              dict(headers, **{'Content-Type':
+                                               'application/json'}))
+    request.get_method = lambda: method
+    try:
+        urllib2.urlopen(request).read()
+        return True
+    except urllib2.HTTPError:
+        return False
+
+
+def report(mode, name, result):
+    print '%-11s %-24s %8.1f req/s  p50 %7.2fms  p99 %7.2fms  errors %d' % (
+        mode, name, result['throughput'], result['p50_ms'],
+        result['p99_ms'], result['errors'])
+
+
+def compare(old, new, tolerance):
+    """Print the change in each result; return the regressed ones."""
+    regressions = []
+    print
+    print '%-11s %-24s %10s %10s %10s' % ('', '', 'req/s', 'p50', 'p99')
+    for mode in sorted(new['results']):
+        for name in sorted(new['results'][mode]):
+            before = old['results'].get(mode, {}).get(name)
+            if before is None:
+                continue
+            after = new['results'][mode][name]
+            changes = [
+                after['throughput'] / before['throughput'] - 1,
+                after['p50_ms'] / before['p50_ms'] - 1,
+                after['p99_ms'] / before['p99_ms'] - 1
+            ]
+            print '%-11s %-24s %+9.1f%% %+9.1f%% %+9.1f%%' % (
+                (mode, name) + tuple(c * 100 for c in changes))
+            if changes[0] < -tolerance or changes[1] > tolerance:
+                regressions.append((mode, name))
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--teams', type=int, default=2000)
+    parser.add_argument('--rooms', type=int, default=200)
+    parser.add_argument('--reservations', type=int, default=200000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=500,
+                        help='timed requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--http', action='store_true',
+                        help='also time requests to gunicorn over HTTP')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='compare with an earlier output')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown to call a regression (default 0.1)')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        started = time.time()
+        fixture = seed(os.path.join(directory, 'test.db'), args)
+        print 'seeded in %.1fs' % (time.time() - started)
+
+        results = {'in-process': run_in_process(fixture, args.requests,
+                                                args.warmup)}
+        if args.http:
+            database.engine.dispose()
+            results['http'] = run_http(fixture, directory, args.requests,
+                                       args.warmup, args.clients,
+                                       args.workers)
+    finally:
+        shutil.rmtree(directory)
+
+    output = {
+        'commit': git_commit(),
+        'date': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'volumes': {
+            'users': args.users,
+            'teams': args.teams,
+            'rooms': args.rooms,
+            'reservations': args.reservations,
+            'seed': args.seed
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), output, args.tolerance)
+        if regressions:
+            print 'regressed: ' + ', '.join('%s %s' % r for r in regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Benchmark reservation queries with and without the declared indexes.
+
+Times the range query behind Reservation.validate_conflicts (when the
+in-memory index is off) and the upcoming-reservations query behind
+GET /v1/reservation, against SQLite databases of increasing size.
+
+Usage: python benchmarks/conflict_check.py [--sizes 10000,100000,1000000]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database
+from models import Reservation, Room, Team, TeamType
+from sqlalchemy import select, func
+
+
+ROOMS = 50
+SLOT = datetime.timedelta(hours=1)
+EPOCH = datetime.datetime(2017, 1, 1)
+
+
+def fill(size):
+    """Insert size reservations spread over ROOMS rooms."""
+    conn = database.engine.connect()
+    conn.execute(TeamType.__table__.insert(),
+                 [{'id': 1, 'name': 'single', 'priority': 4,
+                   'advance_time': 14}])
+    conn.execute(Team.__table__.insert(),
+                 [{'id': 1, 'name': 'bench', 'team_type_id': 1}])
+    conn.execute(Room.__table__.insert(),
+                 [{'id': i, 'number': str(i)} for i in range(1, ROOMS + 1)])
+    per_room = size // ROOMS
+    batch = []
+    with conn.begin():
+        for room_id in range(1, ROOMS + 1):
+            for slot in range(per_room):
+                start = EPOCH + slot * SLOT
+                batch.append({'team_id': 1, 'room_id': room_id,
+                              'start': start, 'end': start + SLOT})
+                if len(batch) == 10000:
+                    conn.execute(Reservation.__table__.insert(), batch)
+                    batch = []
+        if batch:
+            conn.execute(Reservation.__table__.insert(), batch)
+    conn.close()
+    return per_room
+
+
+def measure(per_room, rng, iterations):
+    """Return mean milliseconds for the conflict and upcoming queries."""
+    table = Reservation.__table__
+    conn = database.engine.connect()
+
+    def conflict():
+        start = EPOCH + rng.randint(0, per_room) * SLOT
+        conn.execute(select([table.c.id]).where(
+            (table.c.end >= start) &
+            (table.c.start <= start + SLOT) &
+            (table.c.room_id == rng.randint(1, ROOMS))
+        )).fetchall()
+
+    def upcoming():
+        now = EPOCH + (per_room - 24) * SLOT
+        conn.execute(select([func.count(table.c.id)]).where(
+            (table.c.start >= now) | (table.c.end >= now)
+        )).scalar()
+
+    results = {}
+    for name, fn in (('conflict', conflict), ('upcoming', upcoming)):
+        seconds = timeit.timeit(fn, number=iterations)
+        results[name] = seconds / iterations * 1000
+    conn.close()
+    return results
+
+
+def run(size, iterations):
+    """Benchmark one database size, before and after indexing."""
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    try:
+        database.set_engine('sqlite:///' + path)
+        database.Base.metadata.create_all(bind=database.engine)
+        for index in Reservation.__table__.indexes:
+            index.drop(bind=database.engine)
+
+        rng = random.Random(size)
+        per_room = fill(size)
+        database.engine.execute('ANALYZE')
+        before = measure(per_room, rng, iterations)
+
+        database.create_indexes()
+        database.engine.execute('ANALYZE')
+        after = measure(per_room, rng, iterations)
+    finally:
+        database.engine.dispose()
+        os.unlink(path)
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    print '%10s %12s %12s %12s %12s' % (
+        'rows', 'conflict', 'conflict', 'upcoming', 'upcoming')
+    print '%10s %12s %12s %12s %12s' % (
+        '', 'before (ms)', 'after (ms)', 'before (ms)', 'after (ms)')
+    for size in map(int, args.sizes.split(',')):
+        before, after = run(size, args.iterations)
+        print '%10d %12.3f %12.3f %12.3f %12.3f' % (
+            size, before['conflict'], after['conflict'],
+            before['upcoming'], after['upcoming'])
+
+
+if __name__ == '__main__':
+    main()
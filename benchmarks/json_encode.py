@@ -0,0 +1,68 @@
+"""Benchmark JSON encoding of Reservation.as_dict payloads.
+
+Compares json.dumps with every available serialization backend.
+
+Usage: python benchmarks/json_encode.py [--sizes 1000,10000]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import serialization
+from models import Reservation, Room, Team, TeamType
+
+
+def payload(size):
+    """Build size reservation dicts the way GET /v1/reservation does."""
+    team_type = TeamType(name='class', priority=3, advance_time=14)
+    rooms = [Room(number=str(1560 + i)) for i in range(10)]
+    for i, room in enumerate(rooms):
+        room.id = i + 1
+    start = datetime.datetime(2017, 1, 30, 8, 0, 0, 123000)
+    rows = []
+    for i in range(size):
+        team = Team(name='team%d' % i)
+        team.id = i + 1
+        team.team_type = team_type
+        res = Reservation(start=start + datetime.timedelta(hours=i),
+                          end=start + datetime.timedelta(hours=i + 1),
+                          team=team, room=rooms[i % len(rooms)])
+        res.id = i + 1
+        rows.append(res.as_dict())
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    backends = []
+    for name in ('json', 'simplejson'):
+        try:
+            backends.append(serialization.load_backend(name))
+        except ImportError:
+            print '%s not installed, skipping' % name
+
+    print '%8s %-28s %14s' % ('rows', 'encoder', 'rows/second')
+    for size in map(int, args.sizes.split(',')):
+        rows = payload(size)
+
+        candidates = [('json.dumps', lambda: json.dumps(rows))]
+        for name, encode in backends:
+            candidates.append((name, lambda encode=encode: encode(rows)))
+
+        for label, fn in candidates:
+            seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+            print '%8d %-28s %14.0f' % (size, label, size / seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Check that waiting change feed clients don't starve other requests.
+
+Seeds a SQLite database in a scratch directory and starts gunicorn on it,
+first with threaded workers and then with gevent workers. Each time it
+parks a crowd of clients on the reservation change feed, then times
+ordinary requests made while they wait.
+
+Usage: python benchmarks/long_poll.py [--waiters 500] [--requests 100]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+from serving import ROOT, seed, wait_until_up
+
+
+def park(base_url, waiters, seconds):
+    """Start waiters clients long-polling the change feed."""
+    cursor = json.loads(urllib2.urlopen(
+        base_url + '/v1/reservation/changes?timeout=0').read())['cursor']
+    url = '%s/v1/reservation/changes?since=%d&timeout=%d' % (
+        base_url, cursor, seconds)
+    errors = []
+
+    def waiter():
+        try:
+            urllib2.urlopen(url, timeout=seconds + 30).read()
+        except Exception:
+            errors.append(1)
+
+    threading.stack_size(256 * 1024)
+    threads = [threading.Thread(target=waiter) for _ in range(waiters)]
+    for t in threads:
+        t.start()
+    return threads, errors
+
+
+def run(name, env, directory, port, args):
+    server = subprocess.Popen([
+        sys.executable, '-m', 'gunicorn.app.wsgiapp',
+        '-c', os.path.join(ROOT, 'gunicorn_conf.py'),
+        '--bind', '127.0.0.1:%d' % port,
+        'wsgi:app'
+    ], cwd=directory, env=env, stdout=open(os.devnull, 'w'),
+        stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        wait_until_up(base_url + '/v1/room')
+        threads, waiter_errors = park(base_url, args.waiters, args.wait)
+        time.sleep(1)
+
+        latencies = []
+        errors = 0
+        for i in range(args.requests):
+            started = time.time()
+            try:
+                urllib2.urlopen(base_url + '/v1/room', timeout=10).read()
+            except Exception:
+                errors += 1
+            latencies.append(time.time() - started)
+        for t in threads:
+            t.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    print '%-32s p50 %7.1fms  p99 %7.1fms  errors %d  waiter errors %d' % (
+        name, latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000,
+        errors, len(waiter_errors))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--waiters', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--wait', type=int, default=20,
+                        help='seconds each waiter long-polls for')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        seed(directory)
+        env = dict(os.environ, PYTHONPATH=ROOT,
+                   WEB_WORKERS=str(args.workers))
+        run('gthread %d workers x %d threads' % (args.workers, args.threads),
+            dict(env, WEB_WORKER_CLASS='gthread',
+                 WEB_THREADS=str(args.threads)),
+            directory, 5103, args)
+        run('gevent %d workers' % args.workers,
+            dict(env, WEB_WORKER_CLASS='gevent'),
+            directory, 5104, args)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Load test the connection pool with bursts of concurrent requests.
+
+Runs bursts of simultaneous requests through the Flask app, each on its
+own thread and so its own session, against a pooled SQLite database. It
+then checks that no request timed out waiting for a connection, that
+the pool never went past pool_size + max_overflow, and that every
+connection was returned.
+
+Usage: python benchmarks/pool_load.py [--threads 50] [--bursts 20]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database
+from sqlalchemy.pool import QueuePool
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=50)
+    parser.add_argument('--bursts', type=int, default=20)
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--max-overflow', type=int, default=10)
+    parser.add_argument('--pool-timeout', type=int, default=10)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    database.set_engine('sqlite:///' + path,
+                        poolclass=QueuePool,
+                        pool_size=args.pool_size,
+                        max_overflow=args.max_overflow,
+                        pool_timeout=args.pool_timeout,
+                        connect_args={'check_same_thread': False})
+    database.init_db()
+
+    import main as app_module
+    from models import User
+    token = User.query.filter_by(name='admin').first().generate_auth_token()
+    team_id = User.query.filter_by(name='admin').first().teams[0].id
+    database.get_db().remove()
+    database.reset_pool_stats()
+
+    paths = ['/v1/reservation', '/v1/room', '/v1/team/%d' % team_id,
+             '/v1/user?search=s']
+    failures = []
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(i):
+        client = app_module.app.test_client()
+        started = time.time()
+        rv = client.get(paths[i % len(paths)],
+                        headers={'Authorization': 'Bearer ' + token})
+        with lock:
+            latencies.append(time.time() - started)
+            if rv.status_code != 200:
+                failures.append((paths[i % len(paths)], rv.status_code))
+
+    started = time.time()
+    for burst in range(args.bursts):
+        threads = [threading.Thread(target=worker, args=(i,))
+                   for i in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    elapsed = time.time() - started
+
+    limit = args.pool_size + args.max_overflow
+    stats = database.pool_stats
+    latencies.sort()
+    print 'requests:          %d in %.2fs' % (len(latencies), elapsed)
+    print 'p50 / p99 latency: %.1fms / %.1fms' % (
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000)
+    print 'failed requests:   %d' % len(failures)
+    print 'pool:              %r' % stats
+    print 'peak connections:  %d (limit %d)' % (
+        stats['peak_checked_out'], limit)
+
+    database.engine.dispose()
+    os.unlink(path)
+
+    ok = not failures and stats['peak_checked_out'] <= limit and \
+        stats['checked_out'] == 0
+    print 'PASS' if ok else 'FAIL'
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
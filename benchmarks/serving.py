@@ -0,0 +1,127 @@
+"""Compare request throughput of the dev server and gunicorn.
+
+Seeds a SQLite database in a scratch directory, starts each server on it
+in turn and hits a mix of read endpoints from concurrent client threads.
+
+Usage: python benchmarks/serving.py [--clients 32] [--seconds 10]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+
+def seed(directory):
+    """Create the test.db the app opens outside production."""
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'setup.py')],
+                          cwd=directory)
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib2.urlopen(url).read()
+            return
+        except Exception:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start: ' + url)
+
+
+def load(base_url, clients, seconds):
+    """Hit the server from client threads; return (requests, errors, lats)."""
+    token = json.loads(urllib2.urlopen(urllib2.Request(
+        base_url + '/v1/auth', '{"username": "admin"}',
+        {'Content-Type': 'application/json'})).read())['token']
+    paths = ['/v1/reservation', '/v1/room', '/v1/feature',
+             '/v1/user?search=a']
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def client(i):
+        n = i
+        while time.time() < deadline:
+            request = urllib2.Request(base_url + paths[n % len(paths)],
+                                      headers={'Authorization':
+                                               'Bearer ' + token})
+            started = time.time()
+            try:
+                urllib2.urlopen(request).read()
+                ok = True
+            except Exception:
+                ok = False
+            with lock:
+                latencies.append(time.time() - started)
+                if not ok:
+                    errors.append(paths[n % len(paths)])
+            n += 1
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return len(latencies), len(errors), sorted(latencies)
+
+
+def run(name, command, directory, port, clients, seconds, env=None):
+    server = subprocess.Popen(command, cwd=directory, env=env,
+                              stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        wait_until_up(base_url + '/v1/room')
+        count, errors, latencies = load(base_url, clients, seconds)
+    finally:
+        server.terminate()
+        server.wait()
+    print '%-28s %8.0f req/s  p50 %6.1fms  p99 %7.1fms  errors %d' % (
+        name, count / float(seconds),
+        latencies[len(latencies) // 2] * 1000,
+        latencies[int(len(latencies) * 0.99)] * 1000, errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        seed(directory)
+        env = dict(os.environ, PYTHONPATH=ROOT)
+        run('flask dev server', [
+            sys.executable, '-c',
+            'import main; main.app.run(port=5101)'
+        ], directory, 5101, args.clients, args.seconds, env)
+        run('gunicorn %d workers x %d threads' % (args.workers,
+                                                  args.threads), [
+            sys.executable, '-m', 'gunicorn.app.wsgiapp',
+            '-c', os.path.join(ROOT, 'gunicorn_conf.py'),
+            '--bind', '127.0.0.1:5102',
+            '--workers', str(args.workers),
+            '--threads', str(args.threads),
+            'wsgi:app'
+        ], directory, 5102, args.clients, args.seconds, env)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Benchmark user prefix search with and without the in-memory name index.
+
+Seeds a SQLite database with generated users, then times User.search for
+the prefixes someone typing a username goes through: on the in-memory
+index, and on the LIKE query it falls back to, with and without the prefix
+cache in front of it.
+
+Usage: python benchmarks/user_search.py [--users 100000] [--limit 10]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import database
+import models
+from models import User
+
+
+def keystrokes(rng, user_ids, count):
+    """Get the prefixes typed on the way to count random usernames."""
+    prefixes = []
+    for user_id in rng.sample(user_ids, count):
+        name = 'user%06d' % user_id
+        prefixes.extend(name[:i] for i in range(1, len(name) + 1))
+    return prefixes
+
+
+def run(prefixes, limit):
+    """Time each search; return the latencies in milliseconds, sorted."""
+    latencies = []
+    for prefix in prefixes:
+        started = time.time()
+        User.search(prefix, limit)
+        latencies.append((time.time() - started) * 1000)
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--limit', type=int, default=10)
+    parser.add_argument('--names', type=int, default=100,
+                        help='usernames to type out')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        database.set_engine('sqlite:///' + path)
+        started = time.time()
+        generated = database.init_db(users=args.users)
+        print 'seeded %d users in %.1fs' % (args.users, time.time() - started)
+        prefixes = keystrokes(random.Random(0), generated['users'],
+                              args.names)
+
+        started = time.time()
+        models.name_index.search('', 1)
+        print 'built the name index in %.1fms' % (
+            (time.time() - started) * 1000)
+
+        cache_matches = models.user_search_cache_matches
+        for use_index, use_cache, label in (
+                (True, False, 'name index'),
+                (False, True, 'LIKE + cache'),
+                (False, False, 'LIKE query')):
+            models.use_name_index = use_index
+            models.user_search_cache_matches = cache_matches if use_cache \
+                else 0
+            models.user_search_cache.clear()
+            run(prefixes[:50], args.limit)
+            latencies = run(prefixes, args.limit)
+            print '%-12s %6d searches  mean %8.3fms  p50 %8.3fms  ' \
+                'p99 %8.3fms' % (
+                    label, len(latencies), sum(latencies) / len(latencies),
+                    latencies[len(latencies) // 2],
+                    latencies[int(len(latencies) * 0.99)])
+    finally:
+        database.get_db().remove()
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
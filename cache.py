@@ -0,0 +1,193 @@
+"""In-process caches."""
+
+from collections import OrderedDict
+import datetime
+import threading
+import time
+
+
+_caches = []
+
+
+def register(c):
+    """Have clear_all() also empty the given object, via its clear()."""
+    _caches.append(c)
+    return c
+
+
+def clear_all():
+    """Empty every cache created in this process.
+
+    Called whenever the database is swapped out from under the caches.
+    """
+    for c in _caches:
+        c.clear()
+
+
+class LRUCache(object):
+    """Thread-safe least-recently-used cache with a time-to-live.
+
+    Entries older than ttl seconds are treated as missing. Once max_size
+    entries are held, the least recently used one is evicted. Given weigh,
+    a function sizing a value, entries are also evicted while their total
+    size is over max_weight.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, weigh=None, max_weight=None):
+        """Create an empty cache."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.max_weight = max_weight
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped by clear(), see set()
+        self.generation = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        register(self)
+
+    def get(self, key, default=None):
+        """Return the cached value for key, or default if absent/expired."""
+        return self.get_first([key], default)
+
+    def get_first(self, keys, default=None):
+        """Return the value of the first of keys that is cached, or default.
+
+        Counts as a single hit or miss, however many keys are tried.
+        """
+        with self._lock:
+            now = time.time()
+            for key in keys:
+                entry = self._data.pop(key, None)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires < now:
+                    self._removed(value)
+                    continue
+                # re-insert to mark as most recently used
+                self._data[key] = entry
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        """Store value under key.
+
+        If a generation is given and the cache has been cleared since it
+        was read, the value is dropped: it may have been computed from
+        data the clear was meant to throw away.
+        """
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(entry[1])
+            self._data[key] = (time.time() + self.ttl, value)
+            if self.weigh is not None:
+                self.weight += self.weigh(value)
+            while len(self._data) > self.max_size or (
+                    self.max_weight is not None and
+                    self.weight > self.max_weight):
+                self._removed(self._data.popitem(last=False)[1][1])
+                self.evictions += 1
+
+    def _removed(self, value):
+        if self.weigh is not None:
+            self.weight -= self.weigh(value)
+
+    def invalidate(self, key):
+        """Drop a single key."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(entry[1])
+
+    def invalidate_where(self, predicate):
+        """Drop every entry whose value matches the predicate."""
+        with self._lock:
+            for key, (expires, value) in list(self._data.items()):
+                if predicate(value):
+                    del self._data[key]
+                    self._removed(value)
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+            self.generation += 1
+
+    def __len__(self):
+        """Return the number of entries, including expired ones."""
+        return len(self._data)
+
+    def stats(self):
+        """Return the hit/miss counters as a dict."""
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class VersionCounter(object):
+    """Version number for some data, bumped whenever it changes.
+
+    Also records when the last change happened, to the second, for use as
+    a Last-Modified time. Several changes can fall within one second, so
+    that time alone doesn't tell versions apart until the second is over.
+    """
+
+    def __init__(self):
+        """Create a counter at version 0, modified now."""
+        self._lock = threading.Lock()
+        self.version = 0
+        self.modified = datetime.datetime.utcnow().replace(microsecond=0)
+        register(self)
+
+    def bump(self):
+        """Record a change."""
+        with self._lock:
+            self.version += 1
+            self.modified = datetime.datetime.utcnow().replace(microsecond=0)
+
+    def clear(self):
+        """Record a change; the data may have been swapped out entirely."""
+        self.bump()
+
+
+class LazyIndex(object):
+    """In-memory index filled by loader() the first time it is used.
+
+    Subclasses define two hooks: _reset(), which sets the index's data
+    attributes to empty, and _build(rows), which fills them from the rows
+    the loader returns. Lookups call _ensure_loaded() with _lock held.
+    clear() drops everything so the next lookup reloads; clear_all() calls
+    it too.
+    """
+
+    def __init__(self, loader):
+        """Create an empty index filled by loader() on first use."""
+        self._loader = loader
+        self._loaded = False
+        self._lock = threading.RLock()
+        self._reset()
+        register(self)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self._build(self._loader())
+            self._loaded = True
+
+    def clear(self):
+        """Forget everything; the next lookup reloads from the loader."""
+        with self._lock:
+            self._reset()
+            self._loaded = False
@@ -1,10 +1,41 @@
 """Database methods."""
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, event, select, exc, text
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-import datetime
 import os
+import threading
+import time
+import cache
+import diagnostics
+import metrics
+
+
+# counters for the current engine's connection pool, see instrument_pool()
+pool_stats = {
+    'connects': 0,
+    'checkouts': 0,
+    'checkins': 0,
+    'invalidations': 0,
+    'checked_out': 0,
+    'peak_checked_out': 0
+}
+_pool_stats_lock = threading.Lock()
+
+
+def pool_options():
+    """Get connection pool settings from the environment.
+
+    DB_POOL_SIZE connections are kept open; up to DB_MAX_OVERFLOW more are
+    opened under load. A checkout waits DB_POOL_TIMEOUT seconds for a free
+    connection, and connections are replaced after DB_POOL_RECYCLE seconds.
+    """
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800))
+    }
 
 
 def init_engine():
@@ -13,10 +44,105 @@ def init_engine():
         USER = os.getenv('PG_ENV_POSTGRES_USER', 'postgres')
         DB = os.getenv('PG_ENV_POSTGRES_DB', USER)
         PASS = os.getenv('PG_ENV_POSTGRES_PASSWORD')
-        return create_engine(
-            'postgres://' + USER + ':' + PASS + '@pg:5432/' + DB)
+        new_engine = create_engine(
+            'postgres://' + USER + ':' + PASS + '@pg:5432/' + DB,
+            **pool_options())
+        if os.getenv('DB_POOL_PRE_PING', 'TRUE') == 'TRUE':
+            enable_pre_ping(new_engine)
     else:
-        return create_engine('sqlite:///test.db', convert_unicode=True)
+        new_engine = create_engine('sqlite:///test.db', convert_unicode=True)
+    instrument_pool(new_engine)
+    instrument_statements(new_engine)
+    return new_engine
+
+
+def enable_pre_ping(target_engine):
+    """Test each connection as it is checked out, replacing dead ones.
+
+    This is the pessimistic disconnect handling recipe from the SQLAlchemy
+    docs, which has no built-in pre-ping before 1.2.
+    """
+    @event.listens_for(target_engine, 'engine_connect')
+    def ping_connection(connection, branch):
+        if branch:
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as err:
+            # the pool is invalidated on a disconnect, so retrying the
+            # ping reconnects
+            if err.connection_invalidated:
+                connection.scalar(select([1]))
+            else:
+                raise
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+
+def instrument_pool(target_engine):
+    """Count connection pool activity for the engine into pool_stats."""
+    def bump(name, amount=1):
+        with _pool_stats_lock:
+            pool_stats[name] += amount
+            if pool_stats['checked_out'] > pool_stats['peak_checked_out']:
+                pool_stats['peak_checked_out'] = pool_stats['checked_out']
+
+    @event.listens_for(target_engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        bump('connects')
+
+    @event.listens_for(target_engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        bump('checkouts')
+        bump('checked_out')
+
+    @event.listens_for(target_engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        bump('checkins')
+        bump('checked_out', -1)
+
+    @event.listens_for(target_engine, 'invalidate')
+    def invalidate(dbapi_connection, connection_record, exception):
+        bump('invalidations')
+
+
+def instrument_statements(target_engine):
+    """Time every SQL statement run on the engine.
+
+    See metrics and diagnostics.
+    """
+    @event.listens_for(target_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        conn.info.setdefault('statement_started', []).append(time.time())
+
+    @event.listens_for(target_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        elapsed = time.time() - conn.info['statement_started'].pop()
+        metrics.record_statement(elapsed)
+        diagnostics.record_statement(statement, elapsed)
+
+    @event.listens_for(target_engine, 'handle_error')
+    def handle_error(context):
+        started = context.connection.info.get('statement_started')
+        if started:
+            started.pop()
+
+
+def reset_pool_stats():
+    """Zero the cumulative pool counters.
+
+    checked_out is left alone: connections checked out now are still
+    checked in later, and would take it below zero. The peak starts again
+    from it.
+    """
+    with _pool_stats_lock:
+        for name in ('connects', 'checkouts', 'checkins', 'invalidations'):
+            pool_stats[name] = 0
+        pool_stats['peak_checked_out'] = pool_stats['checked_out']
 
 engine = init_engine()
 _db_session = scoped_session(sessionmaker(autocommit=False,
@@ -31,231 +157,91 @@ def get_db():
     return _db_session
 
 
-def set_engine(new_querystring):
+def set_engine(new_querystring, **engine_options):
     """Swap the current sqlite database location to the new destination.
 
+    Extra keyword arguments are passed on to create_engine().
+
     FOR TESTING ONLY!
     """
     global engine, _db_session
-    engine = create_engine(new_querystring, convert_unicode=True)
+    engine = create_engine(new_querystring, convert_unicode=True,
+                           **engine_options)
+    instrument_pool(engine)
+    instrument_statements(engine)
+    reset_pool_stats()
     _db_session = scoped_session(
         sessionmaker(autocommit=False, autoflush=False, bind=engine)
     )
     Base.query = _db_session.query_property()
+    cache.clear_all()
+
+
+def reset_after_fork():
+    """Drop state inherited from a parent process.
+
+    Call in each forked worker before it handles requests: the parent's
+    pooled connections must not be shared, and the in-process caches
+    would otherwise start out as copies of the parent's.
+    """
+    _db_session.remove()
+    engine.dispose()
+    reset_pool_stats()
+    cache.clear_all()
+    metrics.clear_all()
 
 
-def init_db():
-    """Initialize the database."""
+def init_db(**volumes):
+    """Initialize the database.
+
+    Keyword arguments are passed on to seed().
+    """
     # import all modules here that might define models so that
     # they will be registered properly on the metadata.  Otherwise
     # you will have to import them first before calling init_db()
     import models
     Base.metadata.create_all(bind=engine)
-    seed()
+    create_indexes()
+    return seed(**volumes)
 
 
-def seed():
-    """Seed the database with sample data."""
-    import models
-    # the rooms
-
-    room_features = ['Projector', 'TV', 'Webcam', 'Phone Line']
-
-    rooms = {
-               '1560': ['Projector'],
-               '1561': ['TV', 'Webcam'],
-               '1562': ['Projector'],
-               '1563': ['TV'],
-               '1564': ['Projector'],
-               '1565': ['TV', 'Webcam'],
-               '1665': ['TV', 'Webcam'],
-               '1663': ['TV'],
-               '1662': ['Projector'],
-               '1661': ['Projector'],
-               '1660': ['Projector']
-            }
-
-    feature_dict = {}
-    for feature in room_features:
-        f = models.RoomFeature(name=feature)
-        get_db().add(f)
-        feature_dict[feature] = f
-
-    rooms_dict = {}
-    for room_number in rooms:
-        r = models.Room(number=room_number)
-        for feature in rooms[room_number]:
-            f = feature_dict[feature]
-            r.features.append(f)
-        rooms_dict[room_number] = r
-        get_db().add(r)
-
-    # the types of team
-    teamtype_dict = {}
-    teamtype_dict['single'] = models.TeamType(
-        name='single',
-        priority=4,
-        advance_time=7 * 2  # 2 weeks
-    )
-    get_db().add(teamtype_dict['single'])
-    get_db().add(
-        models.TeamType(
-            name='other_team',
-            priority=4,
-            advance_time=7 * 2  # 2 weeks
-        )
-    )
-    get_db().add(
-        models.TeamType(
-            name='class',
-            priority=3,
-            advance_time=7 * 2  # 2 weeks
-        )
-    )
-    get_db().add(
-        models.TeamType(
-            name='colab_class',
-            priority=2,
-            advance_time=7 * 2  # 2 weeks
-        )
-    )
-    get_db().add(
-        models.TeamType(
-            name='senior_project',
-            priority=1,
-            advance_time=7 * 2  # 2 weeks
-        )
-    )
+# Postgres-only indexes Index() can't declare here: an operator class on
+# an expression. text_pattern_ops lets LIKE 'prefix%' use the index
+# whatever the database's collation.
+POSTGRES_INDEXES = {
+    'ix_users_name_lower':
+        'CREATE INDEX ix_users_name_lower ON users '
+        '(lower(name) text_pattern_ops)'
+}
 
-    # the permissions
-
-    perm_names = [
-        'team.create',
-        'team.create.elevated',
-        'team.delete',
-        'team.delete.elevated',
-        'team.read',
-        'team.read.elevated',
-        'team.update',
-        'team.update.elevated',
-        'reservation.create',
-        'reservation.delete',
-        'reservation.delete.elevated',
-        'reservation.read',
-        'reservation.update',
-        'reservation.update.elevated',
-        'room.update.elevated',
-        'room.create.elevated',
-        'room.read',
-        'room.delete.elevated',
-        'feature.create',
-        'feature.delete',
-        'feature.update',
-        'feature.read',
-        'role.create',
-        'role.delete',
-        'role.update'
-    ]
-    perm_dict = {}
-    for perm in perm_names:
-        p = models.Permission(name=perm)
-        get_db().add(p)
-        perm_dict[perm] = p
-
-    roles = {
-        'student': [
-            'team.create',
-            'team.delete',
-            'team.read',
-            'team.update',
-            'reservation.create',
-            'reservation.delete',
-            'reservation.read',
-            'reservation.update',
-            'room.read',
-            'feature.read'
-        ],
-        'labbie': [
-            'team.create',
-            'team.delete',
-            'team.read',
-            'team.update',
-            'reservation.create',
-            'reservation.delete',
-            'reservation.read',
-            'reservation.update',
-            'room.read',
-            'feature.read',
-            'team.read.elevated'
-        ],
-        'professor': [
-            'team.create',
-            'team.delete',
-            'team.read',
-            'team.update',
-            'reservation.create',
-            'reservation.delete',
-            'reservation.read',
-            'reservation.update',
-            'room.read',
-            'feature.read',
-            'team.create.elevated',
-            'team.read.elevated'
-        ],
-        'admin': [
-            'team.create',
-            'team.create.elevated',
-            'team.delete',
-            'team.delete.elevated',
-            'team.read',
-            'team.read.elevated',
-            'team.update',
-            'team.update.elevated',
-            'reservation.create',
-            'reservation.delete',
-            'reservation.delete.elevated',
-            'reservation.read',
-            'reservation.update',
-            'reservation.update.elevated',
-            'room.update.elevated',
-            'room.create.elevated',
-            'room.read',
-            'room.delete.elevated',
-            'feature.create',
-            'feature.delete',
-            'feature.update',
-            'feature.read',
-            'role.create',
-            'role.delete',
-            'role.update'
-        ]
-    }
-    users_dict = {}
-    for role in roles:
-        r = models.Role(name=role)
-        for permission in roles[role]:
-            p = perm_dict[permission]
-            r.permissions.append(p)
-        get_db().add(r)
-        # seed a user TODO don't do this in production?
-        u = models.User(name=role, email=role + "@example.com")
-        u.roles.append(r)
-        team = models.Team(u.name)
-        team_type = teamtype_dict['single']
-        team.team_type = team_type
-        team.members.append(u)
-        u.teams.append(team)
-        users_dict[role] = u
-        get_db().add(team)
-        get_db().add(u)
-
-    reservation = models.Reservation(
-        start=datetime.datetime.now() + datetime.timedelta(days=7),
-        end=datetime.datetime.now() + datetime.timedelta(days=7, hours=1),
-        team=users_dict['admin'].teams[0],
-        room=rooms_dict['1660'],
-        created_by=users_dict['admin']
-    )
-    get_db().add(reservation)
 
-    get_db().commit()
+def create_indexes():
+    """Create any declared index missing from an existing database.
+
+    create_all() only adds indexes along with the tables they belong to.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=engine)
+    if engine.dialect.name == 'postgresql':
+        # expression indexes aren't reflected, so look them up by name
+        for name, ddl in sorted(POSTGRES_INDEXES.items()):
+            if engine.scalar(text('SELECT 1 FROM pg_class '
+                                  'WHERE relname = :name'),
+                             name=name) is None:
+                engine.execute(ddl)
+
+
+def seed(**volumes):
+    """Seed the database with sample data, and any generated data.
+
+    Volumes default to those set in the environment; see sample_data.seed()
+    for the keyword arguments and return value.
+    """
+    import sample_data
+    if not volumes:
+        volumes = sample_data.volumes()
+    return sample_data.seed(engine, **volumes)
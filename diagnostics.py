@@ -0,0 +1,103 @@
+"""Opt-in diagnostics for slow SQL and N+1 query patterns.
+
+Set SQL_DIAGNOSTICS=TRUE to log every statement slower than
+SLOW_QUERY_MS milliseconds (default 100), and every request that runs the
+same SELECT more than N_PLUS_ONE_THRESHOLD times (default 10), along with
+the endpoint that ran it. Tests can also watch requests with
+add_listener().
+"""
+
+import logging
+import os
+import re
+import threading
+
+log = logging.getLogger('diagnostics')
+
+enabled = os.getenv('SQL_DIAGNOSTICS', 'FALSE') == 'TRUE'
+slow_query_seconds = float(os.getenv('SLOW_QUERY_MS', 100)) / 1000
+n_plus_one_threshold = int(os.getenv('N_PLUS_ONE_THRESHOLD', 10))
+
+if enabled and not log.handlers:
+    log.addHandler(logging.StreamHandler())
+
+_listeners = []
+_current = threading.local()
+
+
+class RequestTrace(object):
+    """SQL statements run while handling one request."""
+
+    def __init__(self, endpoint):
+        """Start a trace for the given endpoint."""
+        self.endpoint = endpoint
+        self.statements = 0
+        # statement text -> times run, for SELECTs only
+        self.selects = {}
+
+    def record(self, statement):
+        """Count a statement."""
+        self.statements += 1
+        if statement.lstrip()[:6].upper() == 'SELECT':
+            shape = statement_shape(statement)
+            self.selects[shape] = self.selects.get(shape, 0) + 1
+
+    def repeated(self, threshold=None):
+        """Get (shape, count) for SELECTs run more than threshold times."""
+        if threshold is None:
+            threshold = n_plus_one_threshold
+        return sorted((shape, count) for shape, count in self.selects.items()
+                      if count > threshold)
+
+
+def statement_shape(statement):
+    """Get a statement with its whitespace and IN lists normalized.
+
+    Bound parameters are already placeholders, so statements that differ
+    only in their values come out the same.
+    """
+    statement = re.sub(r'\s+', ' ', statement.strip())
+    return re.sub(r'IN \([?%s, ()]*\)', 'IN (...)', statement)
+
+
+def add_listener(listener):
+    """Call listener(trace) with the trace of every finished request."""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    """Stop calling a listener added with add_listener()."""
+    _listeners.remove(listener)
+
+
+def start_request(endpoint):
+    """Start tracing a request on this thread, if anything wants traces."""
+    if enabled or _listeners:
+        _current.trace = RequestTrace(endpoint)
+    else:
+        _current.trace = None
+
+
+def record_statement(statement, seconds):
+    """Record a SQL statement run on this thread."""
+    trace = getattr(_current, 'trace', None)
+    if enabled and seconds >= slow_query_seconds:
+        log.warning('slow query (%.1fms) in %s: %s', seconds * 1000,
+                    trace.endpoint if trace else 'no request',
+                    statement_shape(statement))
+    if trace is not None:
+        trace.record(statement)
+
+
+def end_request():
+    """Finish the trace of the request on this thread."""
+    trace = getattr(_current, 'trace', None)
+    if trace is None:
+        return
+    _current.trace = None
+    if enabled:
+        for shape, count in trace.repeated():
+            log.warning('possible N+1 in %s: ran %d times: %s',
+                        trace.endpoint, count, shape)
+    for listener in list(_listeners):
+        listener(trace)
@@ -0,0 +1,57 @@
+"""In-memory index of which rooms have which features."""
+
+from cache import LazyIndex
+
+
+def bits_to_ids(bits):
+    """Get the positions of the set bits, lowest first."""
+    ids = []
+    while bits:
+        low = bits & -bits
+        ids.append(low.bit_length() - 1)
+        bits ^= low
+    return ids
+
+
+class FeatureIndex(LazyIndex):
+    """Bitset of rooms for every room feature.
+
+    Each room is given a bit position, in room ID order, and bit n of a
+    feature's bitset is set if the nth room has the feature. Rooms with
+    several features are found by ANDing their bitsets. Positions are
+    dense, so a bitset is only as wide as the number of rooms with any
+    feature, however large their IDs. The index is filled by loader() on
+    first use and rebuilt after clear().
+
+    loader must return an iterable of (room_id, feature_id) pairs.
+    """
+
+    def _reset(self):
+        self._bitsets = {}
+        # room id of each bit position
+        self._room_ids = []
+
+    def _build(self, rows):
+        rows = list(rows)
+        room_ids = sorted(set(room_id for room_id, _ in rows))
+        positions = dict((room_id, i) for i, room_id in enumerate(room_ids))
+        bitsets = {}
+        for room_id, feature_id in rows:
+            bitsets[feature_id] = bitsets.get(feature_id, 0) | \
+                (1 << positions[room_id])
+        self._bitsets = bitsets
+        self._room_ids = room_ids
+
+    def rooms_with(self, feature_ids):
+        """Get the IDs of the rooms that have all of the given features."""
+        with self._lock:
+            self._ensure_loaded()
+            bitsets = self._bitsets
+            room_ids = self._room_ids
+        result = None
+        for feature_id in feature_ids:
+            bits = bitsets.get(feature_id, 0)
+            result = bits if result is None else result & bits
+            if not result:
+                return []
+        return [room_ids[i] for i in bits_to_ids(result or 0)]
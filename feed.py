@@ -0,0 +1,29 @@
+"""Wake-ups for clients waiting on the reservation change feed."""
+
+import threading
+
+
+class ChangeNotifier(object):
+    """Counter of committed changes that threads can wait on.
+
+    Read count before checking for changes, then wait(count): a change
+    committed in between ends the wait at once instead of being missed.
+    """
+
+    def __init__(self):
+        """Create a notifier with no changes seen."""
+        self.count = 0
+        self._condition = threading.Condition()
+
+    def notify(self):
+        """Record a change and wake every waiting thread."""
+        with self._condition:
+            self.count += 1
+            self._condition.notify_all()
+
+    def wait(self, seen, timeout):
+        """Wait up to timeout seconds for count to move past seen."""
+        with self._condition:
+            if self.count == seen:
+                self._condition.wait(timeout)
+            return self.count
@@ -0,0 +1,57 @@
+"""Gunicorn settings for serving wsgi:app.
+
+WEB_WORKERS processes (default 2 per CPU + 1) are forked from a master
+that loads the app once, each running WEB_THREADS threads (default 4).
+Send the master SIGHUP to replace the workers gracefully, e.g. after a
+deploy.
+
+With WEB_WORKER_CLASS=gevent each worker instead serves up to
+WEB_WORKER_CONNECTIONS (default 1000) requests at once on greenlets, which
+suits many mostly-waiting connections such as change feed long-polls.
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv('WEB_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4))
+preload_app = True
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', 30))
+accesslog = '-'
+worker_class = os.getenv('WEB_WORKER_CLASS', 'gthread')
+worker_connections = int(os.getenv('WEB_WORKER_CONNECTIONS', 1000))
+
+if worker_class == 'gevent':
+    # patch before the app is preloaded, so the locks it creates at import
+    # and its database driver yield to other greenlets instead of blocking
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        # no Postgres driver; SQLite setups outside production
+        pass
+    else:
+        patch_psycopg()
+
+if workers > 1:
+    # the reservation, user name and room feature indexes only see their
+    # own process' writes, so with several workers conflict checks, user
+    # searches and feature filters have to go to the database
+    os.environ.setdefault('RESERVATION_INDEX', 'FALSE')
+    os.environ.setdefault('USER_SEARCH_INDEX', 'FALSE')
+    os.environ.setdefault('ROOM_FEATURE_INDEX', 'FALSE')
+    # and cached tokens and permissions would outlive a user deleted or
+    # changed by another worker
+    os.environ.setdefault('TOKEN_CACHE_SIZE', '0')
+    os.environ.setdefault('PERMISSION_CACHE_SIZE', '0')
+    # nor can a worker tell when another last changed rooms or features
+    os.environ.setdefault('LAST_MODIFIED', 'FALSE')
+
+
+def post_fork(server, worker):
+    """Give each worker its own connections and caches."""
+    import database
+    database.reset_after_fork()
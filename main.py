@@ -3,20 +3,58 @@
 Main logic and API routes.
 """
 
-from flask import Flask, request, abort, Response
+from flask import Flask, request, abort, Response, stream_with_context
 from database import get_db, init_db
 from models import *
 from functools import wraps
-import json
+from serialization import dumps
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_
+from sqlalchemy.orm import joinedload, subqueryload
+from pagination import paginate, encode_cursor, decode_cursor, \
+    DEFAULT_LIMIT, MAX_LIMIT
+from availability import find_free_slots
+import database
+import diagnostics
+import metrics
 import datetime
+import hashlib
+import heapq
+import itertools
 import iso8601
+import os
+import time
 from werkzeug.exceptions import HTTPException
 import pytz
 
 app = Flask(__name__)
 
+# longest window GET /v1/room/availability will search
+MAX_AVAILABILITY_WINDOW = datetime.timedelta(days=31)
+
+# most reservations POST /v1/reservation/batch will take at once
+MAX_BATCH_SIZE = 1000
+
+# longest window GET /v1/reservation/series will expand occurrences over
+MAX_SERIES_WINDOW = datetime.timedelta(days=366)
+
+# most days or weeks between the occurrences of a series
+MAX_SERIES_INTERVAL = 366
+
+# longest a change feed request waits for a change, in seconds
+MAX_FEED_TIMEOUT = 60
+
+# how often a waiting change feed request checks the database, in seconds;
+# changes committed by this process wake it up sooner
+FEED_POLL_INTERVAL = 1
+
+# longest the change feed stream goes without sending something, in seconds
+FEED_HEARTBEAT = 15
+
+# whether snapshots send Last-Modified and honor If-Modified-Since; the
+# modification times only cover this process' writes
+use_last_modified = os.getenv('LAST_MODIFIED', 'TRUE') == 'TRUE'
+
 
 def parse_datetime(date_string):
     try:
@@ -40,9 +78,14 @@ def returns_json(f):
                     headers.remove(header)
             headers.append(('Content-Type', 'application/json'))
             e.get_headers = lambda x: headers
-            e.get_body = lambda x: json.dumps({"message": e.description})
+            e.get_body = lambda x: dumps({"message": e.description})
             raise e
-        if isinstance(r, tuple):
+        if isinstance(r, Response):
+            return r
+        elif isinstance(r, tuple) and len(r) == 3:
+            return Response(r[0], status=r[1], headers=r[2],
+                            content_type='application/json')
+        elif isinstance(r, tuple):
             return Response(r[0], status=r[1], content_type='application/json')
         else:
             return Response(r, content_type='application/json')
@@ -66,6 +109,22 @@ def includes_user(f):
     return decorated_function
 
 
+def optional_user(f):
+    """Add the request user as a parameter.
+
+    The user is None if the request has no valid bearer token, so public
+    endpoints still answer requests carrying an expired or garbled one.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        u = None
+        auth = request.headers.get('Authorization', '')
+        if auth.startswith('Bearer '):
+            u = User.verify_auth_token(auth[len('Bearer '):])
+        return f(u, *args, **kwargs)
+    return decorated_function
+
+
 def json_param_exists(param_name, json_root=-1):
     """Check if the given parameter exists and is valid.
 
@@ -82,12 +141,218 @@ def json_param_exists(param_name, json_root=-1):
         json_root[param_name] is not None
 
 
+def page_limit():
+    """Get the limit param, checked against the allowed page sizes."""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, 'limit must be an integer')
+    if limit < 1 or limit > MAX_LIMIT:
+        abort(400, 'limit must be between 1 and %d' % MAX_LIMIT)
+    return limit
+
+
+def next_page_headers(next_cursor):
+    """Get the response headers pointing at the next page, if any."""
+    headers = {}
+    if next_cursor is not None:
+        headers['X-Next-Cursor'] = next_cursor
+    return headers
+
+
+def paged(query, columns):
+    """Get the page of the query selected by the limit and cursor params.
+
+    Returns the rows and the response headers pointing at the next page.
+    """
+    limit = page_limit()
+    try:
+        rows, next_cursor = paginate(query, columns, limit,
+                                     request.args.get('cursor'))
+    except ValueError:
+        abort(400, 'invalid cursor')
+    return rows, next_page_headers(next_cursor)
+
+
+def paged_listing(reservations, start, end=None):
+    """Get a page of reservations merged with series occurrences.
+
+    Occurrences overlapping [start, end] (or ending from start on, without
+    end) are listed alongside the reservations in the query, both ordered
+    by listing key. Returns the page and the headers pointing at the next
+    one, like paged().
+    """
+    limit = page_limit()
+    cursor = request.args.get('cursor')
+    columns = [Reservation.start, Reservation.id]
+    try:
+        rows, more = paginate(reservations, columns, limit, cursor)
+        after = decode_cursor(cursor, columns) if cursor else None
+    except ValueError:
+        abort(400, 'invalid cursor')
+    occurrences = itertools.islice(
+        ReservationSeries.occurrences_in(start, end, after), limit + 1)
+    items = sorted(rows + list(occurrences),
+                   key=lambda item: item.listing_key)
+    next_cursor = None
+    if more is not None or len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(items[-1].listing_key)
+    return items, next_page_headers(next_cursor)
+
+
+def streamed(query, to_dict, batch_size=500, prepare_batch=None,
+             merge=None, key=None):
+    """Stream every row of the query as JSON instead of building a page.
+
+    Rows are fetched batch_size at a time and written out as they are
+    converted, so memory use doesn't grow with the result. prepare_batch,
+    if given, is called with each batch of rows before they are converted,
+    to load what eager loading can't with yield_per(). merge, if given, is
+    an iterable of more rows merged in by key, with both it and the query
+    already in that order. Sends NDJSON if the client accepts
+    application/x-ndjson, a JSON array otherwise.
+    """
+    ndjson = request.accept_mimetypes.best == 'application/x-ndjson'
+
+    def generate():
+        rows = iter(query.yield_per(batch_size))
+        if merge is not None:
+            rows = (row for _, row in heapq.merge(
+                ((key(row), row) for row in rows),
+                ((key(row), row) for row in merge)))
+        chunk = [] if ndjson else ['[']
+        first = True
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            if prepare_batch is not None:
+                prepare_batch(batch)
+            for row in batch:
+                data = dumps(to_dict(row))
+                if ndjson:
+                    chunk.append(data + '\n')
+                else:
+                    chunk.append(data if first else ',' + data)
+                first = False
+            yield ''.join(chunk)
+            chunk = []
+        if not ndjson:
+            chunk.append(']')
+        yield ''.join(chunk)
+
+    if ndjson:
+        content_type = 'application/x-ndjson'
+    else:
+        content_type = 'application/json'
+    return Response(stream_with_context(generate()),
+                    content_type=content_type)
+
+
+def snapshot(cache, key, build, last_modified=None):
+    """Serve a pre-serialized JSON body from the cache, with an ETag.
+
+    build() returns the body and response headers, and is only called when
+    the cache has nothing for key. Clients that already have the current
+    body, going by If-None-Match or else If-Modified-Since against the
+    given last_modified time, get 304 Not Modified instead. Without
+    use_last_modified, last_modified is ignored, as it is during its own
+    second: a change later in that second would leave it the same.
+    """
+    generation = cache.generation
+    cached = cache.get(key)
+    if cached is None:
+        body, headers = build()
+        cached = (body, hashlib.sha1(body).hexdigest(), headers)
+        cache.set(key, cached, generation=generation)
+    body, etag, headers = cached
+    if not use_last_modified or last_modified is not None and \
+            last_modified >= datetime.datetime.utcnow().replace(microsecond=0):
+        last_modified = None
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = last_modified is not None and \
+            request.if_modified_since is not None and \
+            request.if_modified_since >= last_modified
+    if not_modified:
+        response = Response(status=304)
+    else:
+        response = Response(body, headers=headers,
+                            content_type='application/json')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def is_id(value):
+    """Check that a JSON value is an integer ID; true and false aren't."""
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def feature_ids_param():
+    """Get the feature IDs in the comma-separated features query param."""
+    try:
+        return set(int(f) for f in
+                   request.args.get('features', '').split(',') if f)
+    except ValueError:
+        abort(400, 'features must be integers')
+
+
 @app.teardown_appcontext
 def shutdown_session(exception=None):
     """End the database session."""
     get_db().remove()
 
 
+@app.before_request
+def start_timing():
+    """Start timing the request, see metrics and diagnostics."""
+    metrics.start_request()
+    diagnostics.start_request(request.endpoint or 'unknown')
+
+
+@app.teardown_request
+def stop_timing(exception=None):
+    """Record how long the request took, streamed bodies included."""
+    metrics.end_request(request.endpoint or 'unknown')
+    diagnostics.end_request()
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    """Get this process' timings and counters for Prometheus."""
+    caches = [
+        ('token', token_cache),
+        ('permission', permission_index),
+        ('schedule_snapshot', schedule_snapshots),
+        ('catalog_snapshot', catalog_snapshots),
+        ('user_search', user_search_cache)
+    ]
+    lines = []
+    for stat, kind in [('hits', 'counter'), ('misses', 'counter'),
+                       ('evictions', 'counter'), ('size', 'gauge')]:
+        lines.extend(metrics.gauge(
+            'cache_' + stat + ('_total' if kind == 'counter' else ''),
+            'Cache %s.' % stat,
+            [({'cache': name}, c.stats()[stat]) for name, c in caches],
+            kind))
+    for stat in ['connects', 'checkouts', 'checkins', 'invalidations']:
+        lines.extend(metrics.gauge(
+            'db_pool_%s_total' % stat, 'Connection pool %s.' % stat,
+            [({}, database.pool_stats[stat])], 'counter'))
+    for stat in ['checked_out', 'peak_checked_out']:
+        lines.extend(metrics.gauge(
+            'db_pool_' + stat,
+            'Connections %s.' % stat.replace('_', ' '),
+            [({}, database.pool_stats[stat])]))
+    return Response(metrics.render(lines),
+                    content_type='text/plain; version=0.0.4')
+
+
 @app.route('/v1/auth', methods=['POST'])
 @returns_json
 def auth():
@@ -112,7 +377,7 @@ def auth():
 
     encoded = user.generate_auth_token()
 
-    return json.dumps({'token': encoded})
+    return dumps({'token': encoded})
 
 
 @app.route('/v1/user/<int:user_id>', methods=['GET'])
@@ -125,7 +390,7 @@ def user_read(user_id):
     if user is None:
         abort(404, "user not found")
 
-    return json.dumps(user.as_dict(include_teams_and_permissions=True))
+    return dumps(user.as_dict(include_teams_and_permissions=True))
 
 
 @app.route('/v1/user', methods=['GET'])
@@ -134,13 +399,19 @@ def user_search_partial():
     """Get a user id from a partial user name."""
     username = request.args.get('search') or ''
 
+    limit = page_limit()
+    try:
+        users, next_cursor = User.search(username, limit,
+                                         request.args.get('cursor'))
+    except ValueError:
+        abort(400, 'invalid cursor')
     ret = []
-    for user in User.query.filter(User.name.ilike(username + "%")):
+    for user_id, name in users:
         ret.append({
-            "id": user.id,
-            "name": user.name
+            "id": user_id,
+            "name": name
         })
-    return json.dumps(ret)
+    return dumps(ret), 200, next_page_headers(next_cursor)
 
 
 # team CRUD
@@ -187,7 +458,7 @@ def team_read(token_user, team_id):
     if team is None:
         abort(404, 'team not found')
 
-    return json.dumps(team.as_dict(for_user=token_user))
+    return dumps(team.as_dict(for_user=token_user))
 
 
 @app.route('/v1/team/<int:team_id>', methods=['PUT'])
@@ -240,7 +511,13 @@ def team_delete(token_user, team_id):
         abort(403, 'insufficient permissions to delete team')
 
     # deschedule reservations for the team then delete the team
+    ReservationEvent.record_deletes([
+        res_id for res_id, in
+        get_db().query(Reservation.id).filter_by(team_id=team.id)
+    ])
     Reservation.query.filter_by(team_id=team.id).delete()
+    for series in ReservationSeries.query.filter_by(team_id=team.id):
+        get_db().delete(series)
     get_db().delete(team)
     get_db().commit()
 
@@ -362,9 +639,9 @@ def reservation_add(token_user):
             for conflict in conflicting_reservations:
                 get_db().delete(conflict)
         else:
-            return json.dumps({"overridable": True}), 409
+            return dumps({"overridable": True}), 409
     elif conflict_status == Reservation.CONFLICT_FAILURE:
-        return json.dumps({"overridable": False}), 409
+        return dumps({"overridable": False}), 409
 
     get_db().add(res)
     get_db().commit()
@@ -372,6 +649,96 @@ def reservation_add(token_user):
     return '', 201
 
 
+@app.route('/v1/reservation/batch', methods=['POST'])
+@returns_json
+@includes_user
+def reservation_add_batch(token_user):
+    """Add many reservations at once; either all are added or none are.
+
+    Takes a list of reservations, each with the team ID, room ID, start and
+    end date times, and an optional override flag for the whole batch.
+    """
+    if not json_param_exists('reservations') or \
+            not isinstance(request.json['reservations'], list) or \
+            len(request.json['reservations']) == 0:
+        abort(400, 'one or more required parameter is missing')
+    items = request.json['reservations']
+    if len(items) > MAX_BATCH_SIZE:
+        abort(400, 'at most %d reservations can be added at once'
+              % MAX_BATCH_SIZE)
+    for item in items:
+        if not isinstance(item, dict) or \
+           not json_param_exists('team_id', item) or \
+           not json_param_exists('room_id', item) or \
+           not json_param_exists('start', item) or \
+           not json_param_exists('end', item):
+            abort(400, 'one or more required parameter is missing')
+        if not is_id(item['team_id']) or not is_id(item['room_id']):
+            abort(400, 'team and room ids must be integers')
+
+    if not token_user.has_permission('reservation.create'):
+        abort(403)
+
+    teams = {}
+    for team in Team.query.filter(
+            Team.id.in_(set(item['team_id'] for item in items))).options(
+            joinedload(Team.team_type), subqueryload(Team.members)):
+        teams[team.id] = team
+    rooms = {}
+    for room in Room.query.filter(
+            Room.id.in_(set(item['room_id'] for item in items))):
+        rooms[room.id] = room
+
+    reservations = []
+    for item in items:
+        team = teams.get(item['team_id'])
+        if team is None:
+            abort(400, 'invalid team id')
+        if not team.has_member(token_user):
+            abort(403)
+
+        room = rooms.get(item['room_id'])
+        if room is None:
+            abort(400, 'invalid room id')
+
+        start = parse_datetime(item['start'])
+        end = parse_datetime(item['end'])
+        if start is None or end is None:
+            abort(400, 'cannot parse start or end date')
+        if start >= end:
+            abort(400, "start time must be before end time")
+
+        reservations.append(Reservation(team=team, room=room,
+                                        created_by=token_user,
+                                        start=start, end=end))
+
+    attempt_override = False
+    if json_param_exists("override") and isinstance(request.json["override"], bool):
+        attempt_override = request.json["override"]
+
+    conflict_status, conflicting_reservations = \
+        Reservation.validate_batch_conflicts(reservations)
+    if conflict_status == Reservation.NO_CONFLICT:
+        pass
+    elif conflict_status == Reservation.CONFLICT_OVERRIDABLE:
+        if attempt_override:
+            # Delete conflicting reservations
+            for conflict in conflicting_reservations:
+                get_db().delete(conflict)
+        else:
+            return dumps({"overridable": True}), 409
+    elif conflict_status == Reservation.CONFLICT_FAILURE:
+        return dumps({"overridable": False}), 409
+
+    get_db().add_all(reservations)
+    get_db().flush()
+    # read the new IDs before the commit expires every reservation
+    ids = [res.id for res in reservations]
+    get_db().commit()
+
+    return dumps({"ids": ids}), 201
+
+
 @app.route('/v1/reservation/<int:res_id>', methods=['GET'])
 @returns_json
 @includes_user
@@ -381,7 +748,7 @@ def reservation_read(token_user, res_id):
     if res is None:
         abort(404, 'reservation not found')
 
-    return json.dumps(res.as_dict(for_user=token_user))
+    return dumps(res.as_dict(for_user=token_user))
 
 
 @app.route('/v1/reservation/<int:res_id>', methods=['PUT'])
@@ -435,9 +802,9 @@ def reservation_update(token_user, res_id):
             for conflict in conflicting_reservations:
                 get_db().delete(conflict)
         else:
-            return json.dumps({"overridable": True}), 409
+            return dumps({"overridable": True}), 409
     elif conflict_status == Reservation.CONFLICT_FAILURE:
-        return json.dumps({"overridable": False}), 409
+        return dumps({"overridable": False}), 409
 
     get_db().commit()
 
@@ -466,17 +833,222 @@ def reservation_delete(token_user, res_id):
     return '', 204
 
 
+# recurring reservations
+
+@app.route('/v1/reservation/series', methods=['POST'])
+@returns_json
+@includes_user
+def reservation_series_add(token_user):
+    """Add a recurring reservation.
+
+    Uses the team ID, room ID, start and end date times of the first
+    occurrence, frequency ("daily" or "weekly"), optional interval, the
+    date time no occurrence may start after, and an optional list of start
+    date times of occurrences to skip.
+    """
+    if not json_param_exists('team_id') or \
+       not json_param_exists('room_id') or \
+       not json_param_exists('start') or \
+       not json_param_exists('end') or \
+       not json_param_exists('frequency') or \
+       not json_param_exists('until'):
+        abort(400, 'one or more required parameter is missing')
+
+    team_id = request.json['team_id']
+    room_id = request.json['room_id']
+    if not is_id(team_id) or not is_id(room_id):
+        abort(400, 'team and room ids must be integers')
+
+    team = Team.query.get(team_id)
+    if team is None:
+        abort(400, 'invalid team id')
+
+    if not (token_user.has_permission('reservation.create') and team.has_member(token_user)):
+        abort(403)
+
+    room = Room.query.get(room_id)
+    if room is None:
+        abort(400, 'invalid room id')
+
+    start = parse_datetime(request.json['start'])
+    end = parse_datetime(request.json['end'])
+    until = parse_datetime(request.json['until'])
+    if start is None or end is None or until is None:
+        abort(400, 'cannot parse start, end or until date')
+
+    if start >= end:
+        abort(400, "start time must be before end time")
+    if until < start:
+        abort(400, "until must not be before start time")
+
+    frequency = request.json['frequency']
+    if not isinstance(frequency, basestring) or frequency not in FREQUENCIES:
+        abort(400, 'frequency must be "daily" or "weekly"')
+
+    interval = request.json.get('interval', 1)
+    if not is_id(interval) or not 1 <= interval <= MAX_SERIES_INTERVAL:
+        abort(400, 'interval must be an integer between 1 and %d'
+              % MAX_SERIES_INTERVAL)
+
+    series = ReservationSeries(team=team, room=room, created_by=token_user,
+                               start=start, end=end, frequency=frequency,
+                               interval=interval, until=until)
+    if end - start >= series.period():
+        abort(400, 'each occurrence must end before the next one starts')
+
+    exceptions = request.json.get('exceptions') or []
+    if not isinstance(exceptions, list):
+        abort(400, 'exceptions must be a list of date times')
+    exception_starts = set()
+    for exception in exceptions:
+        exception_start = None
+        if isinstance(exception, basestring):
+            exception_start = parse_datetime(exception)
+        if exception_start is None:
+            abort(400, 'cannot parse exception date')
+        if not series.is_occurrence(exception_start):
+            abort(400, 'exception is not an occurrence of the series')
+        exception_starts.add(exception_start)
+    for exception_start in sorted(exception_starts):
+        series.exceptions.append(SeriesException(start=exception_start))
+
+    attempt_override = False
+    if json_param_exists("override") and isinstance(request.json["override"], bool):
+        attempt_override = request.json["override"]
+
+    conflict_status, conflicting_reservations = series.validate_conflicts()
+    if conflict_status == Reservation.NO_CONFLICT:
+        pass
+    elif conflict_status == Reservation.CONFLICT_OVERRIDABLE:
+        if attempt_override:
+            # Delete conflicting reservations
+            for conflict in conflicting_reservations:
+                get_db().delete(conflict)
+        else:
+            return dumps({"overridable": True}), 409
+    elif conflict_status == Reservation.CONFLICT_FAILURE:
+        return dumps({"overridable": False}), 409
+
+    get_db().add(series)
+    get_db().commit()
+
+    return dumps({"id": series.id}), 201
+
+
+@app.route('/v1/reservation/series', methods=['GET'])
+@returns_json
+def get_reservation_series():
+    """List recurring reservations with their occurrences in a window.
+
+    Query params: start, end
+    """
+    if 'start' not in request.args or 'end' not in request.args:
+        abort(400, 'one or more required parameter is missing')
+    start = parse_datetime(request.args['start'])
+    end = parse_datetime(request.args['end'])
+    if start is None or end is None:
+        abort(400, 'cannot parse start or end date')
+    if start >= end:
+        abort(400, 'start time must be before end time')
+    if end - start > MAX_SERIES_WINDOW:
+        abort(400, 'time window is too long')
+
+    ret = []
+    for series in ReservationSeries.query.filter(
+            ReservationSeries.start <= end,
+            ReservationSeries.last_end >= start
+    ).options(*ReservationSeries.listing_options()).order_by(
+            ReservationSeries.id):
+        data = series.as_dict(start, end)
+        if data['occurrences']:
+            ret.append(data)
+    return dumps(ret)
+
+
+@app.route('/v1/reservation/series/<int:series_id>/exception',
+           methods=['POST'])
+@returns_json
+@includes_user
+def reservation_series_skip(token_user, series_id):
+    """Cancel a single occurrence of a recurring reservation.
+
+    Uses the start date time of the occurrence.
+    """
+    if not json_param_exists('start'):
+        abort(400, 'one or more required parameter is missing')
+
+    series = ReservationSeries.query.get(series_id)
+    if series is None:
+        abort(404, 'reservation series not found')
+
+    if not token_user.has_permission('reservation.update.elevated'):
+        if not (series.team.has_member(token_user) and
+                token_user.has_permission('reservation.update')):
+            abort(403, 'insufficient permissions to update reservation')
+
+    start = parse_datetime(request.json['start'])
+    if start is None:
+        abort(400, 'cannot parse start date')
+    if any(e.start == start for e in series.exceptions):
+        abort(409, 'occurrence is already cancelled')
+    if not series.is_occurrence(start):
+        abort(400, 'start is not an occurrence of the series')
+
+    series.exceptions.append(SeriesException(start=start))
+    get_db().commit()
+
+    return '', 201
+
+
+@app.route('/v1/reservation/series/<int:series_id>', methods=['DELETE'])
+@returns_json
+@includes_user
+def reservation_series_delete(token_user, series_id):
+    """Remove a recurring reservation and all its occurrences."""
+    series = ReservationSeries.query.get(series_id)
+    if series is None:
+        abort(404, 'reservation series not found')
+
+    if not token_user.has_permission('reservation.delete.elevated'):
+        if not (series.team.has_member(token_user) and
+                token_user.has_permission('reservation.delete')):
+            abort(403, 'insufficient permissions to delete reservation')
+
+    get_db().delete(series)
+    get_db().commit()
+
+    return '', 204
+
+
 # room CRUD
 
 @app.route('/v1/room', methods=['GET'])
 @returns_json
 def room_list():
-    """List all rooms."""
-    rooms = []
-    for room in Room.query.all():
-        rooms.append(room.as_dict())
+    """List all rooms.
 
-    return json.dumps(rooms)
+    Optional query param: features, to only list rooms with all of them.
+    """
+    feature_ids = feature_ids_param()
+
+    def build():
+        rooms = Room.query
+        if feature_ids:
+            room_ids = Room.with_features(feature_ids)
+            if not room_ids:
+                return dumps([]), {}
+            rooms = rooms.filter(Room.id.in_(room_ids))
+
+        page, headers = paged(rooms, [Room.id])
+        rooms = []
+        for room in page:
+            rooms.append(room.as_dict())
+        return dumps(rooms), headers
+
+    return snapshot(catalog_snapshots, (
+        room_version.version, 'room_list', tuple(sorted(feature_ids)),
+        request.args.get('limit'), request.args.get('cursor')
+    ), build, room_version.modified)
 
 
 @app.route('/v1/room', methods=['POST'])
@@ -498,18 +1070,92 @@ def room_add():
         get_db().commit()
     except IntegrityError:
         abort(409, 'room number is already in use')
-    return json.dumps(room.as_dict(include_features=False)), 201
+    return dumps(room.as_dict(include_features=False)), 201
 
 
 @app.route('/v1/room/<int:room_id>', methods=['GET'])
 @returns_json
 def room_read(room_id):
     """Get a room's info given its ID."""
-    room = Room.query.get(room_id)
-    if room is None:
-        abort(404, 'room not found')
+    def build():
+        room = Room.query.get(room_id)
+        if room is None:
+            abort(404, 'room not found')
+        return dumps(room.as_dict(include_features=True)), {}
+
+    return snapshot(catalog_snapshots, (
+        room_version.version, feature_version.version, 'room_read', room_id
+    ), build, max(room_version.modified, feature_version.modified))
 
-    return json.dumps(room.as_dict(include_features=True))
+
+@app.route('/v1/room/availability', methods=['GET'])
+@returns_json
+def room_availability():
+    """Find free time in rooms.
+
+    Query params: start, end, and optionally duration (minutes, default 0)
+    and features (comma-separated feature IDs every room must have).
+    """
+    if 'start' not in request.args or 'end' not in request.args:
+        abort(400, 'one or more required parameter is missing')
+    start = parse_datetime(request.args['start'])
+    end = parse_datetime(request.args['end'])
+    if start is None or end is None:
+        abort(400, 'cannot parse start or end date')
+    if start >= end:
+        abort(400, 'start time must be before end time')
+    if end - start > MAX_AVAILABILITY_WINDOW:
+        abort(400, 'time window is too long')
+
+    try:
+        minutes = int(request.args.get('duration', 0))
+    except ValueError:
+        abort(400, 'duration must be an integer')
+    if minutes < 0:
+        abort(400, 'duration must not be negative')
+    # no slot is longer than the window, and huge values overflow timedelta
+    if minutes > MAX_AVAILABILITY_WINDOW.total_seconds() // 60:
+        abort(400, 'duration is too long')
+    duration = datetime.timedelta(minutes=minutes)
+
+    rooms = Room.query
+    feature_ids = feature_ids_param()
+    if feature_ids:
+        room_ids = Room.with_features(feature_ids)
+        if not room_ids:
+            return dumps([])
+        rooms = rooms.filter(Room.id.in_(room_ids))
+    rooms = rooms.order_by(Room.id).all()
+    if not rooms:
+        return dumps([])
+
+    busy = get_db().query(
+        Reservation.room_id, Reservation.start, Reservation.end
+    ).filter(
+        Reservation.end >= start,
+        Reservation.start <= end,
+        Reservation.room_id.in_([room.id for room in rooms])
+    ).order_by(Reservation.room_id, Reservation.start)
+    occurrences = [
+        (room_id, occurrence_start, occurrence_end)
+        for _, room_id, recurrence
+        in ReservationSeries.in_rooms([room.id for room in rooms], start, end)
+        for occurrence_start, occurrence_end
+        in recurrence.occurrences(start, end)
+    ]
+    if occurrences:
+        busy = sorted([tuple(row) for row in busy] + occurrences)
+    free = find_free_slots([room.id for room in rooms], busy,
+                           start, end, duration)
+
+    ret = []
+    for room in rooms:
+        if room.id in free:
+            ret.append({
+                'room': room.as_dict(),
+                'slots': [{'start': s, 'end': e} for s, e in free[room.id]]
+            })
+    return dumps(ret)
 
 
 @app.route('/v1/room/<int:room_id>', methods=['PUT'])
@@ -531,19 +1177,33 @@ def room_update(room_id):
     if not json_param_exists('features'):
         abort(400, 'one or more required parameter is missing')
 
-    features = request.json['features']
+    if not isinstance(request.json['features'], list) or \
+            not all(is_id(f) for f in request.json['features']):
+        abort(400, 'features must be a list of feature ids')
+
+    feature_ids = set(request.json['features'])
+    if feature_ids:
+        features = RoomFeature.query.filter(
+            RoomFeature.id.in_(feature_ids)).all()
+    else:
+        features = []
+    if len(features) != len(feature_ids):
+        abort(400, 'invalid feature id')
 
     # remove relationships not in features
-    for r in room.features:
-        if r not in features:
-            room.features.delete(r)
+    for f in list(room.features):
+        if f.id not in feature_ids:
+            room.features.remove(f)
 
     # add relationships in features
     for f in features:
         if f not in room.features:
-            room.features.add(f)
+            room.features.append(f)
 
-    get_db().commit()
+    try:
+        get_db().commit()
+    except IntegrityError:
+        abort(409, 'room number is already in use')
 
     return '', 204
 
@@ -567,39 +1227,171 @@ def room_delete(room_id):
 @returns_json
 def feature_list():
     """List all rooms."""
-    features = []
-    for feature in RoomFeature.query.all():
-        features.append(feature.as_dict())
+    def build():
+        page, headers = paged(RoomFeature.query, [RoomFeature.id])
+        features = []
+        for feature in page:
+            features.append(feature.as_dict())
+        return dumps(features), headers
 
-    return json.dumps(features)
+    return snapshot(catalog_snapshots, (
+        feature_version.version, 'feature_list',
+        request.args.get('limit'), request.args.get('cursor')
+    ), build, feature_version.modified)
 
 
 @app.route('/v1/reservation', methods=['GET'])
 @returns_json
-def get_reservations():
+@optional_user
+def get_reservations(token_user):
     """Get a filtered reservation list.
 
-    Optional query params: start, end
+    Optional query params: start, end, limit, cursor, stream
+
+    Occurrences of reservation series are listed with the reservations;
+    they have no id, but a series_id. With stream=true the whole result is
+    streamed rather than paged. Users with team.read.elevated also see team
+    names and members. Without start and end, pages are served from
+    snapshots shared by every viewer of the same kind.
     """
+    elevated = token_user is not None and \
+        token_user.has_permission('team.read.elevated')
+    for_user = token_user if elevated else None
+
     start_date = request.args.get('start')
     end_date = request.args.get('end')
 
     if start_date is not None and end_date is not None:
-        start = parse_datetime(request.json['start'])
-        end = parse_datetime(request.json['end'])
+        start = parse_datetime(start_date)
+        end = parse_datetime(end_date)
         if start is None or end is None:
             abort(400, 'cannot parse start or end date')
 
         reservations = Reservation.query.filter(
             Reservation.end >= start, Reservation.start <= end)
+        upcoming = False
     else:
+        start = datetime.datetime.now()
+        end = None
         reservations = Reservation.query.filter(
-            or_(Reservation.start >= datetime.datetime.now(),
-                Reservation.end >= datetime.datetime.now()))
+            or_(Reservation.start >= start, Reservation.end >= start))
+        upcoming = True
+    reservations = reservations.options(*Reservation.listing_options())
+
+    # members are loaded for the page or batch, occurrences' teams included;
+    # subqueryload wouldn't work with yield_per() anyway
+    if request.args.get('stream') == 'true':
+        return streamed(
+            reservations.order_by(Reservation.start, Reservation.id),
+            lambda x: x.as_dict(for_user=for_user),
+            prepare_batch=Reservation.load_members if elevated else None,
+            merge=ReservationSeries.occurrences_in(start, end),
+            key=lambda x: x.listing_key)
+
+    def build():
+        page, headers = paged_listing(reservations, start, end)
+        if elevated:
+            Reservation.load_members(page)
+        return dumps([r.as_dict(for_user=for_user) for r in page]), headers
+
+    if upcoming:
+        return snapshot(schedule_snapshots, (
+            'elevated' if elevated else 'anonymous',
+            request.args.get('limit'),
+            request.args.get('cursor')
+        ), build)
+    body, headers = build()
+    return body, 200, headers
+
+
+def wait_for_changes(since, limit, timeout):
+    """Get reservation events after since, waiting up to timeout for one."""
+    deadline = time.time() + timeout
+    while True:
+        seen = reservation_feed.count
+        events = ReservationEvent.since(since, limit)
+        remaining = deadline - time.time()
+        if events or remaining <= 0:
+            return events
+        # end the transaction so the next check sees newer commits
+        get_db().rollback()
+        reservation_feed.wait(seen, min(remaining, FEED_POLL_INTERVAL))
+
+
+def feed_position():
+    """Get the sequence number to resume the change feed after.
+
+    Taken from the Last-Event-ID header or the since query param, or the
+    latest event if neither is given. Positions before the oldest event
+    kept get 410 Gone, since the events after them may have been pruned.
+    """
+    since = request.headers.get('Last-Event-ID', request.args.get('since'))
+    if since is None:
+        return ReservationEvent.latest()
+    try:
+        since = int(since)
+    except ValueError:
+        abort(400, 'since must be an integer')
+    oldest = ReservationEvent.oldest()
+    if oldest is not None and since < oldest - 1:
+        abort(410, 'events after since are no longer kept')
+    return since
+
 
-    reservations = map(lambda x: x.as_dict(), reservations)
+@app.route('/v1/reservation/changes', methods=['GET'])
+@returns_json
+def reservation_changes():
+    """Long-poll for reservation changes.
 
-    return json.dumps(reservations)
+    Optional query params: since (the cursor of the last response),
+    timeout (seconds to wait for a change, default 25), limit
+    """
+    since = feed_position()
+    try:
+        timeout = float(request.args.get('timeout', 25))
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400, 'timeout and limit must be numbers')
+    # written so that nan fails too
+    if not 0 <= timeout <= MAX_FEED_TIMEOUT:
+        abort(400, 'timeout must be between 0 and %d' % MAX_FEED_TIMEOUT)
+    if limit < 1 or limit > MAX_LIMIT:
+        abort(400, 'limit must be between 1 and %d' % MAX_LIMIT)
+
+    events = wait_for_changes(since, limit, timeout)
+    return dumps({
+        'events': [event.as_dict() for event in events],
+        'cursor': events[-1].id if events else since
+    })
+
+
+@app.route('/v1/reservation/changes/stream', methods=['GET'])
+def reservation_changes_stream():
+    """Stream reservation changes as server-sent events.
+
+    Resumes after the Last-Event-ID header or the since query param.
+    """
+    since = feed_position()
+
+    def generate():
+        last = since
+        yield 'retry: 3000\n\n'
+        while True:
+            events = wait_for_changes(last, DEFAULT_LIMIT, FEED_HEARTBEAT)
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            chunk = []
+            for event in events:
+                chunk.append('id: %d\nevent: %s\ndata: %s\n\n' % (
+                    event.id, event.kind, dumps(event.as_dict())))
+            last = events[-1].id
+            yield ''.join(chunk)
+
+    return Response(stream_with_context(generate()),
+                    content_type='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+"""Request, SQL, JWT and serialization timings.
+
+Histograms are kept per process and rendered in the Prometheus text
+exposition format.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+# upper bounds, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+# upper bounds for SQL statements per request
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_families = []
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets."""
+
+    def __init__(self, buckets):
+        """Create an empty histogram with the given bucket upper bounds."""
+        self.buckets = tuple(buckets)
+        # observations per bucket, plus one past the last bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record a value."""
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def snapshot(self):
+        """Get the cumulative count at each bound, the total and the sum."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets, counts):
+            running += count
+            cumulative.append((bound, running))
+        return cumulative, running + counts[-1], total
+
+
+class HistogramFamily(object):
+    """Histograms for one metric, one for each value of a label."""
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS,
+                 label=None):
+        """Create a family; without a label it holds a single histogram."""
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.label = label
+        self._histograms = {}
+        self._lock = threading.Lock()
+        _families.append(self)
+
+    def observe(self, value, label_value=None):
+        """Record a value in the histogram for the label value."""
+        histogram = self._histograms.get(label_value)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(
+                    label_value, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def clear(self):
+        """Drop every observation."""
+        with self._lock:
+            self._histograms = {}
+
+    def render(self):
+        """Get the family's lines in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        for label_value in sorted(self._histograms):
+            cumulative, count, total = \
+                self._histograms[label_value].snapshot()
+            if self.label is None:
+                labels = ''
+            else:
+                labels = '%s="%s",' % (self.label, _escape(label_value))
+            for bound, running in cumulative:
+                lines.append('%s_bucket{%sle="%s"} %d' % (
+                    self.name, labels, _format(bound), running))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (
+                self.name, labels, count))
+            labels = '{%s}' % labels.rstrip(',') if labels else ''
+            lines.append('%s_sum%s %s' % (self.name, labels, _format(total)))
+            lines.append('%s_count%s %d' % (self.name, labels, count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def gauge(name, description, samples, kind='gauge'):
+    """Get lines for a gauge or counter in the Prometheus text format.
+
+    samples is a list of (labels dict, value) pairs.
+    """
+    lines = ['# HELP %s %s' % (name, description),
+             '# TYPE %s %s' % (name, kind)]
+    for labels, value in samples:
+        if labels:
+            label_text = '{%s}' % ','.join(
+                '%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+        else:
+            label_text = ''
+        lines.append('%s%s %s' % (name, label_text, _format(value)))
+    return lines
+
+
+def render(extra_lines=()):
+    """Get every histogram, then extra_lines, as a Prometheus text page."""
+    lines = []
+    for family in _families:
+        lines.extend(family.render())
+    lines.extend(extra_lines)
+    return '\n'.join(lines) + '\n'
+
+
+def clear_all():
+    """Drop every observation in every histogram."""
+    for family in _families:
+        family.clear()
+
+
+request_seconds = HistogramFamily(
+    'http_request_duration_seconds',
+    'Time from the start of a request until its response is sent.',
+    label='endpoint')
+request_statements = HistogramFamily(
+    'http_request_sql_statements',
+    'SQL statements executed per request.',
+    buckets=COUNT_BUCKETS, label='endpoint')
+request_sql_seconds = HistogramFamily(
+    'http_request_sql_duration_seconds',
+    'Time spent executing SQL per request.',
+    label='endpoint')
+sql_seconds = HistogramFamily(
+    'sql_statement_duration_seconds',
+    'Time taken by each SQL statement.')
+jwt_seconds = HistogramFamily(
+    'jwt_verify_duration_seconds',
+    'Time taken to check the signature of a bearer token.')
+serialize_seconds = HistogramFamily(
+    'json_serialize_duration_seconds',
+    'Time taken to encode a response body as JSON.')
+
+
+# SQL statements are credited to the request running on the same thread
+_current = threading.local()
+
+
+def start_request():
+    """Start timing a request on this thread."""
+    _current.started = time.time()
+    _current.statements = 0
+    _current.sql_seconds = 0.0
+
+
+def record_statement(seconds):
+    """Record a SQL statement, and credit it to the current request."""
+    sql_seconds.observe(seconds)
+    if getattr(_current, 'started', None) is not None:
+        _current.statements += 1
+        _current.sql_seconds += seconds
+
+
+def end_request(endpoint):
+    """Stop timing the request on this thread and record it."""
+    started = getattr(_current, 'started', None)
+    if started is None:
+        return
+    _current.started = None
+    request_seconds.observe(time.time() - started, endpoint)
+    request_statements.observe(_current.statements, endpoint)
+    request_sql_seconds.observe(_current.sql_seconds, endpoint)
@@ -1,25 +1,78 @@
 """Models."""
 
 from sqlalchemy import Column, Integer, String, Table, ForeignKey, DateTime
-from sqlalchemy.orm import relationship
-from database import Base
+from sqlalchemy import Index
+from sqlalchemy import event, inspect, select, and_, func, distinct
+from sqlalchemy.orm import relationship, make_transient_to_detached, \
+    object_session, Session, joinedload, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from database import Base, get_db
+from cache import LRUCache, VersionCounter
+from schedule import ReservationIndex, SeriesIndex, sweep_conflicts
+from feature_index import FeatureIndex
+from name_index import NameIndex
+from pagination import encode_cursor, decode_cursor, paginate, MAX_LIMIT
+from recurrence import Recurrence, FREQUENCIES
+from feed import ChangeNotifier
+import datetime
+import heapq
 import jwt
+import metrics
+import os
+import time
 
 
 secret = 'secret'
 
+# raw bearer token -> snapshot of the verified user, see verify_auth_token().
+# Only this process' writes drop entries, so a user deleted or changed
+# elsewhere is seen for up to ttl seconds. A size of 0 turns it off.
+token_cache = LRUCache(
+    max_size=int(os.getenv('TOKEN_CACHE_SIZE', 4096)),
+    ttl=int(os.getenv('TOKEN_CACHE_TTL', 60))
+)
+
+# user id -> frozenset of permission names, see effective_permissions().
+# Dropped the same way as token_cache.
+permission_index = LRUCache(
+    max_size=int(os.getenv('PERMISSION_CACHE_SIZE', 4096)),
+    ttl=int(os.getenv('PERMISSION_CACHE_TTL', 60))
+)
+
+# (viewer class, limit, cursor) -> serialized page of upcoming
+# reservations, see get_reservations()
+schedule_snapshots = LRUCache(
+    max_size=int(os.getenv('SCHEDULE_CACHE_SIZE', 256)),
+    ttl=int(os.getenv('SCHEDULE_CACHE_TTL', 10))
+)
+
+# bumped after every commit that changes rooms (including which features
+# they have) or features, see room_list(), room_read() and feature_list()
+room_version = VersionCounter()
+feature_version = VersionCounter()
+
+# (versions, endpoint, args) -> serialized room or feature listing
+catalog_snapshots = LRUCache(
+    max_size=int(os.getenv('CATALOG_CACHE_SIZE', 1024)),
+    ttl=int(os.getenv('CATALOG_CACHE_TTL', 60))
+)
+
 
 join_table_user_roles = Table(
     'user_roles', Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('role_id', Integer, ForeignKey('roles.id'))
+    Column('role_id', Integer, ForeignKey('roles.id')),
+    Index('ix_user_roles_user_id_role_id', 'user_id', 'role_id'),
+    Index('ix_user_roles_role_id', 'role_id')
 )
 
 
 join_table_user_teams = Table(
     'user_teams', Base.metadata,
     Column('user_id', Integer, ForeignKey('users.id')),
-    Column('team_id', Integer, ForeignKey('teams.id'))
+    Column('team_id', Integer, ForeignKey('teams.id')),
+    Index('ix_user_teams_user_id_team_id', 'user_id', 'team_id'),
+    Index('ix_user_teams_team_id', 'team_id')
 )
 
 
@@ -39,14 +92,81 @@ class User(Base):
 
     @staticmethod
     def verify_auth_token(token):
-        """Get the user from a JWT token."""
+        """Get the user from a JWT token.
+
+        Verified tokens are cached, so repeat requests skip both the
+        signature check and the user lookup.
+        """
+        entry = token_cache.get(token)
+        if entry is not None:
+            user = User(name=entry['name'], email=entry['email'])
+            user.id = entry['id']
+            make_transient_to_detached(user)
+            return get_db().merge(user, load=False)
+
+        started = time.time()
         try:
             decoded = jwt.decode(token, secret, algorithms=['HS256'])
         except jwt.DecodeError:
             return None
+        finally:
+            metrics.jwt_seconds.observe(time.time() - started)
         user = User.query.get(decoded['id'])
+        if user is None:
+            return None
+
+        token_cache.set(token, {
+            'id': user.id,
+            'name': user.name,
+            'email': user.email
+        })
         return user
 
+    @staticmethod
+    def search(prefix, limit, cursor=None):
+        """Get a page of users whose names start with prefix, in any case.
+
+        Users are ordered by case-folded name, then ID. Returns (id, name)
+        pairs and a cursor for the next page, or None if this is the last
+        page. Raises ValueError for a malformed cursor.
+        """
+        folded = func.lower(User.name, type_=String).label('folded_name')
+        columns = [folded, User.id]
+        after = decode_cursor(cursor, columns) if cursor else None
+        prefix = prefix.lower()
+        if _use_name_index():
+            found = name_index.search(prefix, limit + 1, after)
+        else:
+            # matches the lower(name) text_pattern_ops index on Postgres
+            pattern = prefix.replace('\\', '\\\\').replace('%', '\\%') \
+                .replace('_', '\\_') + '%'
+            query = get_db().query(folded, User.id, User.name).filter(
+                func.lower(User.name).like(pattern, escape='\\'))
+            # only first pages come from the cache; later ones start after
+            # a cursor, which has to be compared in the database's collation
+            matches = None
+            if after is None:
+                matches = _cached_user_matches(prefix)
+                if matches is None and user_search_cache_matches > 0:
+                    matches = _load_user_matches(prefix, query, columns,
+                                                 limit)
+            if matches is None:
+                rows, next_cursor = paginate(query, columns, limit, cursor)
+                return [(row.id, row.name) for row in rows], next_cursor
+            found = [match for match in matches
+                     if match[0].startswith(prefix)][:limit + 1]
+
+        next_cursor = None
+        if len(found) > limit:
+            found = found[:limit]
+            next_cursor = encode_cursor(found[-1][:2])
+        return [(user_id, name) for _, user_id, name in found], next_cursor
+
+    @staticmethod
+    def invalidate_cached_tokens(user_id):
+        """Forget every cached token belonging to the given user."""
+        token_cache.invalidate_where(lambda entry: entry['id'] == user_id)
+
     def __init__(self, name=None, email=None):
         """Create a user."""
         self.name = name
@@ -56,13 +176,38 @@ class User(Base):
         """Create a JWT token with the user ID."""
         return jwt.encode({'id': self.id}, secret, algorithm='HS256')
 
+    def effective_permissions(self):
+        """Get the names of every permission granted by the user's roles.
+
+        Answered from the permission index when possible; on a miss the
+        set is loaded with a single query over the join tables.
+        """
+        if self.id is None or inspect(self).attrs.roles.history.has_changes():
+            # unflushed role changes aren't visible to a query yet
+            return frozenset(
+                permission.name
+                for role in self.roles
+                for permission in role.permissions
+            )
+
+        permissions = permission_index.get(self.id)
+        if permissions is None:
+            rows = get_db().query(Permission.name).join(
+                join_table_role_permissions
+            ).join(
+                join_table_user_roles,
+                join_table_user_roles.c.role_id ==
+                join_table_role_permissions.c.role_id
+            ).filter(
+                join_table_user_roles.c.user_id == self.id
+            ).distinct()
+            permissions = frozenset(name for name, in rows)
+            permission_index.set(self.id, permissions)
+        return permissions
+
     def has_permission(self, permission_name):
         """Check that a user has the given permission."""
-        for role in self.roles:
-            for permission in role.permissions:
-                if permission.name == permission_name:
-                    return True
-        return False
+        return permission_name in self.effective_permissions()
 
     def as_dict(self, include_teams_and_permissions=False, for_user=None):
         """
@@ -71,17 +216,12 @@ class User(Base):
         Optionally includes the user's teams and permissions.
         """
         if include_teams_and_permissions:
-            all_permissions = []
-            for role in self.roles:
-                for permission in role.permissions:
-                    if permission not in all_permissions:
-                        all_permissions.append(permission.name)
             return {
                 'id': self.id,
                 'name': self.name,
                 'email': self.email,
                 'teams': map(lambda t: t.as_dict(for_user=for_user), self.teams),
-                'permissions': all_permissions
+                'permissions': sorted(self.effective_permissions())
             }
         else:
             return {
@@ -93,7 +233,10 @@ class User(Base):
 join_table_role_permissions = Table(
     'role_permissions', Base.metadata,
     Column('role_id', Integer, ForeignKey('roles.id')),
-    Column('permission_id', Integer, ForeignKey('permissions.id'))
+    Column('permission_id', Integer, ForeignKey('permissions.id')),
+    Index('ix_role_permissions_role_id_permission_id',
+          'role_id', 'permission_id'),
+    Index('ix_role_permissions_permission_id', 'permission_id')
 )
 
 
@@ -158,7 +301,7 @@ class Team(Base):
     __tablename__ = 'teams'
     id = Column(Integer, primary_key=True)
     name = Column(String(50), unique=True)
-    team_type_id = Column(Integer, ForeignKey('teamtypes.id'))
+    team_type_id = Column(Integer, ForeignKey('teamtypes.id'), index=True)
     team_type = relationship("TeamType", back_populates="teams")
     members = relationship('User',
                            secondary=join_table_user_teams,
@@ -199,7 +342,10 @@ class Team(Base):
 join_table_room_roomfeatures = Table(
     'room_roomfeatures', Base.metadata,
     Column('room_id', Integer, ForeignKey('rooms.id')),
-    Column('roomfeature_id', Integer, ForeignKey('roomfeatures.id'))
+    Column('roomfeature_id', Integer, ForeignKey('roomfeatures.id')),
+    Index('ix_room_roomfeatures_room_id_roomfeature_id',
+          'room_id', 'roomfeature_id'),
+    Index('ix_room_roomfeatures_roomfeature_id', 'roomfeature_id')
 )
 
 
@@ -218,6 +364,18 @@ class Room(Base):
         """Create a room."""
         self.number = number
 
+    @staticmethod
+    def with_features(feature_ids):
+        """Get the IDs of rooms that have every one of the given features."""
+        if use_feature_index:
+            return feature_index.rooms_with(feature_ids)
+        column = join_table_room_roomfeatures.c.roomfeature_id
+        return [room_id for room_id, in get_db().query(
+            join_table_room_roomfeatures.c.room_id
+        ).filter(column.in_(feature_ids)).group_by(
+            join_table_room_roomfeatures.c.room_id
+        ).having(func.count(distinct(column)) == len(feature_ids))]
+
     def as_dict(self, include_features=False):
         """
         Get the room as a dictionary.
@@ -266,12 +424,18 @@ class Reservation(Base):
     """Reservation for a room and team."""
 
     __tablename__ = 'reservations'
+    __table_args__ = (
+        # conflict checks: one room, overlapping a time range
+        Index('ix_reservations_room_id_start_end', 'room_id', 'start', 'end'),
+        # listings of upcoming reservations
+        Index('ix_reservations_end', 'end'),
+    )
     id = Column(Integer, primary_key=True)
-    team_id = Column(Integer, ForeignKey('teams.id'))
+    team_id = Column(Integer, ForeignKey('teams.id'), index=True)
     team = relationship('Team', back_populates='reservations')
     room_id = Column(Integer, ForeignKey('rooms.id'))
     room = relationship('Room', back_populates='reservations')
-    created_by_id = Column(Integer, ForeignKey('users.id'))
+    created_by_id = Column(Integer, ForeignKey('users.id'), index=True)
     created_by = relationship('User')
     start = Column(DateTime)
     end = Column(DateTime)
@@ -290,6 +454,11 @@ class Reservation(Base):
         self.room = room
         self.created_by = created_by
 
+    @property
+    def listing_key(self):
+        """Get the (start, id) key reservation listings are ordered by."""
+        return self.start, self.id
+
     def as_dict(self, for_user=None):
         """Get the reservation as a dictionary."""
         return {
@@ -300,23 +469,1016 @@ class Reservation(Base):
             'end': self.end.isoformat()
         }
 
+    @staticmethod
+    def listing_options(include_members=False):
+        """Get loader options that fetch everything as_dict() touches.
+
+        Teams, team types and rooms are joined into the main query;
+        members, when wanted, come from one extra query for all teams.
+        """
+        options = [
+            joinedload(Reservation.team).joinedload(Team.team_type),
+            joinedload(Reservation.room)
+        ]
+        if include_members:
+            options.append(subqueryload(Reservation.team, Team.members))
+        return options
+
+    @staticmethod
+    def load_members(reservations):
+        """Load the members of the reservations' teams in one query.
+
+        For queries that can't use listing_options(include_members=True),
+        such as ones read with yield_per(), and for series occurrences.
+        Teams whose members are already loaded are skipped.
+        """
+        teams = {}
+        for reservation in reservations:
+            team = reservation.team
+            if team is not None and 'members' not in team.__dict__:
+                teams[team.id] = team
+        if not teams:
+            return
+        members = dict((team_id, []) for team_id in teams)
+        for team_id, user in get_db().query(
+                join_table_user_teams.c.team_id, User).filter(
+                join_table_user_teams.c.user_id == User.id,
+                join_table_user_teams.c.team_id.in_(teams)):
+            members[team_id].append(user)
+        for team_id, team in teams.items():
+            set_committed_value(team, 'members', members[team_id])
+
     def validate_conflicts(self):
-        conflicting_reservations = Reservation.query.filter(
-            Reservation.end >= self.start,
-            Reservation.start <= self.end,
+        """Check this reservation against others in the same room.
+
+        Conflicts are found in the in-memory reservation index; only the
+        conflicting rows themselves are loaded. Overlapping an occurrence
+        of a recurring series can't be overridden.
+        """
+        if ReservationSeries.any_overlapping(self.room.id,
+                                             self.start, self.end):
+            return Reservation.CONFLICT_FAILURE, []
+
+        if use_reservation_index:
+            conflicts = reservation_index.conflicts(
+                self.room.id, self.start, self.end, exclude_id=self.id)
+            if not conflicts:
+                return Reservation.NO_CONFLICT, []
+            priority = self.team.team_type.priority
+            can_override = all(p > priority for _, p in conflicts)
+            conflicting_reservations = Reservation.query.filter(
+                Reservation.id.in_([res_id for res_id, _ in conflicts])
+            ).all()
+        else:
+            conflicting_reservations = Reservation.query.filter(
+                Reservation.end >= self.start,
+                Reservation.start <= self.end,
+                Reservation.room_id == self.room.id,
+                Reservation.id != self.id
+            ).all()
+            if len(conflicting_reservations) == 0:
+                return Reservation.NO_CONFLICT, conflicting_reservations
+            priority = self.team.team_type.priority
+            can_override = all(
+                conflict.team.team_type.priority > priority
+                for conflict in conflicting_reservations
+            )
+
+        if can_override:
+            return Reservation.CONFLICT_OVERRIDABLE, conflicting_reservations
+        else:
+            return Reservation.CONFLICT_FAILURE, conflicting_reservations
+
+
+    @staticmethod
+    def validate_batch_conflicts(reservations):
+        """Check new reservations against existing ones and each other.
+
+        Returns a status for the whole batch, with the same override rules
+        as validate_conflicts(), and the existing reservations in conflict.
+        New reservations that overlap each other or a recurring series
+        always fail.
+        """
+        new = sorted((r.room.id, r.start, r.end, i)
+                     for i, r in enumerate(reservations))
+        series = {}
+        for _, room_id, recurrence in ReservationSeries.in_rooms(
+                set(r[0] for r in new),
+                min(r[1] for r in new), max(r[2] for r in new)):
+            series.setdefault(room_id, []).append(recurrence)
+        for room_id, start, end, _ in new:
+            for recurrence in series.get(room_id, ()):
+                if recurrence.overlaps(start, end):
+                    return Reservation.CONFLICT_FAILURE, []
+
+        existing = get_db().query(
+            Reservation.room_id,
+            Reservation.start,
+            Reservation.end,
+            Reservation.id,
+            TeamType.priority
+        ).outerjoin(Team, Reservation.team_id == Team.id).outerjoin(
+            TeamType, Team.team_type_id == TeamType.id
+        ).filter(
+            Reservation.room_id.in_(set(r[0] for r in new)),
+            Reservation.end >= min(r[1] for r in new),
+            Reservation.start <= max(r[2] for r in new)
+        ).order_by(Reservation.room_id, Reservation.start).all()
+
+        clashes, conflicts = sweep_conflicts(new, existing)
+        if clashes:
+            return Reservation.CONFLICT_FAILURE, []
+        if not conflicts:
+            return Reservation.NO_CONFLICT, []
+
+        can_override = all(
+            p > reservations[i].team.team_type.priority
+            for i, found in conflicts.items()
+            for _, p in found
+        )
+        conflicting_reservations = Reservation.query.filter(Reservation.id.in_(
+            set(res_id for found in conflicts.values() for res_id, _ in found)
+        )).all()
+        if can_override:
+            return Reservation.CONFLICT_OVERRIDABLE, conflicting_reservations
+        else:
+            return Reservation.CONFLICT_FAILURE, conflicting_reservations
+
+
+class ReservationSeries(Base):
+    """Recurring reservation for a room and team.
+
+    A series is stored once; its occurrences are worked out from the
+    first occurrence, the frequency and interval whenever they're needed.
+    """
+
+    __tablename__ = 'reservation_series'
+    __table_args__ = (
+        Index('ix_reservation_series_room_id_start',
+              'room_id', 'start', 'last_end'),
+        Index('ix_reservation_series_last_end', 'last_end'),
+    )
+    id = Column(Integer, primary_key=True)
+    team_id = Column(Integer, ForeignKey('teams.id'), index=True)
+    team = relationship('Team')
+    room_id = Column(Integer, ForeignKey('rooms.id'))
+    room = relationship('Room')
+    created_by_id = Column(Integer, ForeignKey('users.id'))
+    created_by = relationship('User')
+    # first occurrence
+    start = Column(DateTime)
+    end = Column(DateTime)
+    # 'daily' or 'weekly'
+    frequency = Column(String(10))
+    # occurs every interval days or weeks
+    interval = Column(Integer)
+    # no occurrence starts after until
+    until = Column(DateTime)
+    # end of the last occurrence, for range queries
+    last_end = Column(DateTime)
+    exceptions = relationship('SeriesException',
+                              back_populates='series',
+                              cascade='all, delete-orphan')
+
+    def __init__(self, start=None, end=None, frequency='weekly', interval=1,
+                 until=None, team=None, room=None, created_by=None):
+        """Create a series."""
+        self.start = start
+        self.end = end
+        self.frequency = frequency
+        self.interval = interval
+        self.until = until
+        self.team = team
+        self.room = room
+        self.created_by = created_by
+        if start is not None and end is not None and until is not None:
+            self.last_end = self.recurrence().last_end
+
+    def period(self):
+        """Get the time between the starts of consecutive occurrences."""
+        return FREQUENCIES[self.frequency] * self.interval
+
+    def recurrence(self):
+        """Get the occurrences of the series, minus its exceptions."""
+        return Recurrence(self.start, self.end, self.period(), self.until,
+                          [e.start for e in self.exceptions])
+
+    def is_occurrence(self, start):
+        """Check if an occurrence of the series starts at the given time."""
+        for occurrence, _ in self.recurrence().occurrences(start, start):
+            if occurrence == start:
+                return True
+        return False
+
+    def as_dict(self, window_start, window_end, for_user=None):
+        """Get the series as a dictionary.
+
+        Only the occurrences overlapping the given window are included.
+        """
+        return {
+            'id': self.id,
+            'team': self.team.as_dict(for_user=for_user),
+            'room': self.room.as_dict(include_features=False),
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat(),
+            'frequency': self.frequency,
+            'interval': self.interval,
+            'until': self.until.isoformat() if self.until else None,
+            'exceptions': [start.isoformat() for start
+                           in sorted(e.start for e in self.exceptions)],
+            'occurrences': [
+                {'start': start.isoformat(), 'end': end.isoformat()}
+                for start, end
+                in self.recurrence().occurrences(window_start, window_end)
+            ]
+        }
+
+    @staticmethod
+    def listing_options():
+        """Get loader options that fetch everything as_dict() touches."""
+        return [
+            joinedload(ReservationSeries.team).joinedload(Team.team_type),
+            joinedload(ReservationSeries.room),
+            subqueryload(ReservationSeries.exceptions)
+        ]
+
+    @staticmethod
+    def occurrences_in(start, end=None, after=None):
+        """Get the occurrences of every series overlapping [start, end].
+
+        Without end, every occurrence ending from start on is included.
+        The series are loaded up front; their occurrences are worked out
+        as the returned iterator is read, as Occurrences in listing order
+        starting after the listing key given as after.
+        """
+        series = ReservationSeries.query.filter(
+            ReservationSeries.last_end >= start)
+        if end is not None:
+            series = series.filter(ReservationSeries.start <= end)
+        series = series.options(*ReservationSeries.listing_options()).all()
+        if after is not None:
+            after = tuple(after)
+            # earlier occurrences all sort before the cursor
+            start = max(start, after[0])
+
+        def walk(s):
+            for occurrence_start, occurrence_end in s.recurrence().occurrences(
+                    start, end or datetime.datetime.max):
+                occurrence = Occurrence(s, occurrence_start, occurrence_end)
+                if after is None or occurrence.listing_key > after:
+                    yield occurrence.listing_key, occurrence
+
+        return (occurrence for _, occurrence
+                in heapq.merge(*[walk(s) for s in series]))
+
+    @staticmethod
+    def in_rooms(room_ids, start, end):
+        """Get (series_id, room_id, recurrence) for series in the rooms.
+
+        Only series running at some point within [start, end] are
+        included; whether an occurrence actually falls in it is up to the
+        caller.
+        """
+        if use_reservation_index:
+            return [(series_id, room_id, recurrence)
+                    for room_id in room_ids
+                    for series_id, recurrence in series_index.in_room(room_id)
+                    if recurrence.start <= end and
+                    recurrence.last_end >= start]
+        return [(series.id, series.room_id, series.recurrence())
+                for series in ReservationSeries.query.filter(
+                    ReservationSeries.room_id.in_(room_ids),
+                    ReservationSeries.start <= end,
+                    ReservationSeries.last_end >= start
+                ).options(subqueryload(ReservationSeries.exceptions))]
+
+    @staticmethod
+    def any_overlapping(room_id, start, end):
+        """Check if any series in the room has an occurrence overlapping."""
+        return any(recurrence.overlaps(start, end)
+                   for _, _, recurrence
+                   in ReservationSeries.in_rooms([room_id], start, end))
+
+    def validate_conflicts(self):
+        """Check the series against other reservations in the same room.
+
+        Each reservation within the span of the series is checked against
+        it by arithmetic, and so is each other series, so no occurrence is
+        ever materialized. Returns a status with the same override rules
+        as Reservation.validate_conflicts(); overlapping another series
+        can't be overridden.
+        """
+        recurrence = self.recurrence()
+        for series_id, _, other in ReservationSeries.in_rooms(
+                [self.room.id], self.start, self.last_end):
+            if series_id != self.id and \
+                    recurrence.overlaps_recurrence(other):
+                return Reservation.CONFLICT_FAILURE, []
+
+        rows = get_db().query(
+            Reservation.id,
+            Reservation.start,
+            Reservation.end,
+            TeamType.priority
+        ).outerjoin(Team, Reservation.team_id == Team.id).outerjoin(
+            TeamType, Team.team_type_id == TeamType.id
+        ).filter(
             Reservation.room_id == self.room.id,
-            Reservation.id != self.id
+            Reservation.end >= self.start,
+            Reservation.start <= self.last_end
+        )
+        conflicts = [(res_id, priority)
+                     for res_id, start, end, priority in rows
+                     if recurrence.overlaps(start, end)]
+        if not conflicts:
+            return Reservation.NO_CONFLICT, []
+
+        priority = self.team.team_type.priority
+        can_override = all(p > priority for _, p in conflicts)
+        conflicting_reservations = Reservation.query.filter(
+            Reservation.id.in_([res_id for res_id, _ in conflicts])
         ).all()
+        if can_override:
+            return Reservation.CONFLICT_OVERRIDABLE, conflicting_reservations
+        else:
+            return Reservation.CONFLICT_FAILURE, conflicting_reservations
+
+
+class Occurrence(object):
+    """Single occurrence of a reservation series, listed with reservations.
+
+    Occurrences have no ID of their own. In listings they sort by their
+    series' ID negated, so they never share a key with a reservation.
+    """
+
+    def __init__(self, series, start, end):
+        """Create the occurrence of series from start to end."""
+        self.series = series
+        self.team = series.team
+        self.start = start
+        self.end = end
+
+    @property
+    def listing_key(self):
+        """Get the (start, id) key reservation listings are ordered by."""
+        return self.start, -self.series.id
+
+    def as_dict(self, for_user=None):
+        """Get the occurrence as a dictionary, shaped like a reservation."""
+        return {
+            'id': None,
+            'series_id': self.series.id,
+            'team': self.team.as_dict(for_user=for_user),
+            'room': self.series.room.as_dict(include_features=False),
+            'start': self.start.isoformat(),
+            'end': self.end.isoformat()
+        }
+
+
+class SeriesException(Base):
+    """Occurrence of a reservation series that has been cancelled."""
+
+    __tablename__ = 'reservation_series_exceptions'
+    id = Column(Integer, primary_key=True)
+    series_id = Column(Integer, ForeignKey('reservation_series.id'),
+                       index=True)
+    series = relationship('ReservationSeries', back_populates='exceptions')
+    # start of the cancelled occurrence
+    start = Column(DateTime)
+
+    def __init__(self, start=None):
+        """Create an exception for the occurrence starting at start."""
+        self.start = start
+
+
+# how long change feed events are kept; older ones are deleted by
+# whichever process records an event, at most every FEED_PRUNE_INTERVAL
+# seconds
+feed_retention = datetime.timedelta(
+    days=int(os.getenv('FEED_RETENTION_DAYS', 7)))
+FEED_PRUNE_INTERVAL = 3600
+
+
+class ReservationEvent(Base):
+    """Change to a reservation, for the change feed.
+
+    The ID doubles as the feed's sequence number: events are only ever
+    appended, so it goes up in the order the changes were committed.
+    Events older than feed_retention are pruned, apart from the latest.
+    A 'series' event says a reservation series or its exceptions changed,
+    so its occurrences should be read again.
+    """
+
+    __tablename__ = 'reservation_events'
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = Column(Integer, primary_key=True)
+    # 'create', 'update', 'delete' or 'series'
+    kind = Column(String(10))
+    reservation_id = Column(Integer)
+    series_id = Column(Integer)
+    # the reservation as it was left by the change; empty for deletes
+    team_id = Column(Integer)
+    room_id = Column(Integer)
+    start = Column(DateTime)
+    end = Column(DateTime)
+    created = Column(DateTime, index=True)
+
+    # when this process last pruned old events, see record()
+    pruned_at = 0
+
+    def as_dict(self):
+        """Get the event as a dictionary."""
+        if self.kind == 'series':
+            return {
+                'seq': self.id,
+                'type': self.kind,
+                'series': {'id': self.series_id}
+            }
+        if self.kind == 'delete':
+            reservation = {'id': self.reservation_id}
+        else:
+            reservation = {
+                'id': self.reservation_id,
+                'team_id': self.team_id,
+                'room_id': self.room_id,
+                'start': self.start.isoformat(),
+                'end': self.end.isoformat()
+            }
+        return {
+            'seq': self.id,
+            'type': self.kind,
+            'reservation': reservation
+        }
+
+    @staticmethod
+    def latest():
+        """Get the sequence number of the last event, 0 if there are none."""
+        return get_db().query(func.max(ReservationEvent.id)).scalar() or 0
+
+    @staticmethod
+    def oldest():
+        """Get the sequence number of the first event kept, None if none."""
+        return get_db().query(func.min(ReservationEvent.id)).scalar()
+
+    @staticmethod
+    def since(seq, limit):
+        """Get up to limit events after the given sequence number."""
+        return ReservationEvent.query.filter(
+            ReservationEvent.id > seq
+        ).order_by(ReservationEvent.id).limit(limit).all()
+
+    @staticmethod
+    def record(connection, kind, reservation_id, team_id=None, room_id=None,
+               start=None, end=None, series_id=None):
+        """Append an event in the transaction the connection is part of.
+
+        On Postgres this locks reservation_events until the transaction
+        ends, so transactions that write reservations commit one at a
+        time.
+        """
+        if connection.dialect.name == 'postgresql':
+            # make concurrent writers commit in sequence number order, so
+            # a reader never sees an event before one numbered below it
+            connection.execute(
+                'LOCK TABLE reservation_events IN SHARE ROW EXCLUSIVE MODE')
+        now = datetime.datetime.utcnow()
+        connection.execute(ReservationEvent.__table__.insert().values(
+            kind=kind,
+            reservation_id=reservation_id,
+            series_id=series_id,
+            team_id=team_id,
+            room_id=room_id,
+            start=start,
+            end=end,
+            created=now
+        ))
+        if time.time() - ReservationEvent.pruned_at >= FEED_PRUNE_INTERVAL:
+            ReservationEvent.pruned_at = time.time()
+            ReservationEvent.prune(connection, now - feed_retention)
+
+    @staticmethod
+    def prune(connection, before):
+        """Delete events created before the given time, except the latest.
+
+        The latest event is kept so the sequence number of the feed's end,
+        and the point it was pruned to, can still be told.
+        """
+        table = ReservationEvent.__table__
+        connection.execute(table.delete().where(and_(
+            table.c.created < before,
+            table.c.id < select([func.max(table.c.id)]).as_scalar()
+        )))
+
+    @staticmethod
+    def record_deletes(reservation_ids):
+        """Append delete events for reservations removed in bulk."""
+        session = get_db()
+        connection = session.connection()
+        for reservation_id in reservation_ids:
+            ReservationEvent.record(connection, 'delete', reservation_id)
+        if reservation_ids:
+            session.info['reservation_feed_changed'] = True
+
+
+def _load_reservation_index():
+    return get_db().query(
+        Reservation.id,
+        Reservation.room_id,
+        Reservation.start,
+        Reservation.end,
+        TeamType.priority
+    ).outerjoin(Team, Reservation.team_id == Team.id).outerjoin(
+        TeamType, Team.team_type_id == TeamType.id
+    ).all()
+
+# wakes clients waiting on the change feed, see reservation_changes()
+reservation_feed = ChangeNotifier()
+
+# room id -> reservations sorted by start, see validate_conflicts()
+use_reservation_index = os.getenv('RESERVATION_INDEX', 'TRUE') == 'TRUE'
+reservation_index = ReservationIndex(_load_reservation_index)
+
+
+def _load_series_index():
+    return [(series.id, series.room_id, series.recurrence())
+            for series in ReservationSeries.query.options(
+                subqueryload(ReservationSeries.exceptions))]
+
+# room id -> recurring series, see ReservationSeries.in_rooms()
+series_index = SeriesIndex(_load_series_index)
+
+
+def _load_feature_index():
+    return get_db().query(
+        join_table_room_roomfeatures.c.room_id,
+        join_table_room_roomfeatures.c.roomfeature_id
+    ).all()
+
+# feature id -> bitset of room ids, see Room.with_features()
+use_feature_index = os.getenv('ROOM_FEATURE_INDEX', 'TRUE') == 'TRUE'
+feature_index = FeatureIndex(_load_feature_index)
+
+
+def _load_name_index():
+    return get_db().query(User.id, User.name).all()
+
+# users sorted by case-folded name, see User.search(). None leaves it to
+# _use_name_index()
+use_name_index = {'TRUE': True, 'FALSE': False}.get(
+    os.getenv('USER_SEARCH_INDEX'))
+name_index = NameIndex(_load_name_index)
+
+
+def _use_name_index():
+    """Whether user searches go to the name index.
+
+    Unless USER_SEARCH_INDEX says otherwise, only SQLite uses it: Postgres
+    answers prefix searches from its lower(name) index without holding
+    every user in each process.
+    """
+    if use_name_index is not None:
+        return use_name_index
+    return get_db().get_bind().dialect.name == 'sqlite'
+
+# case-folded prefix -> every (folded name, id, name) starting with it, for
+# searches that go to the database. Typing on narrows a cached prefix
+# rather than querying again. Bounded by the users held across all
+# prefixes; prefixes matching more than USER_SEARCH_CACHE_MATCHES users
+# aren't cached.
+user_search_cache = LRUCache(
+    max_size=int(os.getenv('USER_SEARCH_CACHE_SIZE', 1024)),
+    ttl=int(os.getenv('USER_SEARCH_CACHE_TTL', 30)),
+    weigh=len,
+    max_weight=int(os.getenv('USER_SEARCH_CACHE_USERS', 100000))
+)
+user_search_cache_matches = int(os.getenv('USER_SEARCH_CACHE_MATCHES',
+                                          MAX_LIMIT))
+
+
+def _cached_user_matches(prefix):
+    """Get the cached matches of the longest cached start of prefix."""
+    return user_search_cache.get_first(
+        prefix[:end] for end in range(len(prefix), -1, -1))
+
+
+def _load_user_matches(prefix, query, columns, limit):
+    """Get the first matches for prefix, caching them if that's all.
+
+    Fetches USER_SEARCH_CACHE_MATCHES + 1 matches, or the limit + 1 that
+    paginate() would for a page bigger than that, so the first page can
+    always be cut from them.
+    """
+    generation = user_search_cache.generation
+    rows = query.order_by(*columns).limit(
+        max(user_search_cache_matches, limit) + 1).all()
+    matches = tuple((row.folded_name, row.id, row.name) for row in rows)
+    if len(matches) <= user_search_cache_matches:
+        user_search_cache.set(prefix, matches, generation)
+    return matches
+
+
+# drop cached tokens and permission sets whenever what they captured may
+# have changed. Users touched in a session are dropped again once it
+# commits, in case another thread re-cached them in between.
+
+def _forget_user(user):
+    # read the id from the identity key, which never triggers a load
+    identity = inspect(user).identity
+    if identity is None:
+        return
+    user_id, = identity
+    permission_index.invalidate(user_id)
+    User.invalidate_cached_tokens(user_id)
+    session = object_session(user)
+    if session is not None:
+        session.info.setdefault('stale_users', set()).add(user_id)
+
+
+def _forget_all_permissions(target):
+    permission_index.clear()
+    token_cache.clear()
+    session = object_session(target)
+    if session is not None:
+        session.info['stale_permissions'] = True
+
+
+@event.listens_for(User.roles, 'append')
+@event.listens_for(User.roles, 'remove')
+@event.listens_for(User.teams, 'append')
+@event.listens_for(User.teams, 'remove')
+def _user_changed(user, value, initiator):
+    _forget_user(user)
+
+
+@event.listens_for(Role.users, 'append')
+@event.listens_for(Role.users, 'remove')
+@event.listens_for(Team.members, 'append')
+@event.listens_for(Team.members, 'remove')
+def _member_changed(target, user, initiator):
+    _forget_user(user)
+
+
+@event.listens_for(Role.permissions, 'append')
+@event.listens_for(Role.permissions, 'remove')
+def _role_permissions_changed(role, permission, initiator):
+    _forget_all_permissions(role)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _forget_user(user)
+
+
+@event.listens_for(Role, 'after_delete')
+@event.listens_for(Permission, 'after_delete')
+def _role_or_permission_deleted(mapper, connection, target):
+    _forget_all_permissions(target)
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_after_commit(session):
+    if session.info.pop('stale_permissions', False):
+        permission_index.clear()
+        token_cache.clear()
+    for user_id in session.info.pop('stale_users', ()):
+        permission_index.invalidate(user_id)
+        User.invalidate_cached_tokens(user_id)
+
+
+# keep the reservation index in step with committed reservations. Flushed
+# changes are held on the session until it commits or rolls back.
+
+def _pending_reservation_changes(target):
+    return object_session(target).info.setdefault('reservation_changes', [])
+
+
+@event.listens_for(Reservation, 'after_insert')
+@event.listens_for(Reservation, 'after_update')
+def _reservation_saved(mapper, connection, reservation):
+    # use the team already in memory if there is one, rather than a query
+    # for every reservation in a batch
+    team = inspect(reservation).attrs.team.loaded_value
+    team_type = None
+    if isinstance(team, Team) and team.id == reservation.team_id:
+        team_type = inspect(team).attrs.team_type.loaded_value
+    if isinstance(team_type, TeamType):
+        priority = team_type.priority
+    else:
+        priority = connection.execute(
+            select([TeamType.priority]).where(and_(
+                Team.id == reservation.team_id,
+                TeamType.id == Team.team_type_id
+            ))
+        ).scalar()
+    _pending_reservation_changes(reservation).append((
+        reservation.id,
+        reservation.room_id,
+        reservation.start,
+        reservation.end,
+        priority
+    ))
+
+
+@event.listens_for(Reservation, 'after_delete')
+def _reservation_deleted(mapper, connection, reservation):
+    _pending_reservation_changes(reservation).append((reservation.id,))
+
+
+def _record_reservation_event(connection, kind, reservation):
+    if kind == 'delete':
+        ReservationEvent.record(connection, kind, reservation.id)
+    else:
+        ReservationEvent.record(connection, kind, reservation.id,
+                                reservation.team_id, reservation.room_id,
+                                reservation.start, reservation.end)
+    object_session(reservation).info['reservation_feed_changed'] = True
+
+
+@event.listens_for(Reservation, 'after_insert')
+def _reservation_created_feed(mapper, connection, reservation):
+    _record_reservation_event(connection, 'create', reservation)
+
 
-        if len(conflicting_reservations) > 0:
-            can_override = True
-            for conflict in conflicting_reservations:
-                if conflict.team.team_type.priority <= self.team.team_type.priority:
-                    can_override = False
-                    break
-            if can_override:
-                return Reservation.CONFLICT_OVERRIDABLE, conflicting_reservations
-            else:
-                return Reservation.CONFLICT_FAILURE, conflicting_reservations
+@event.listens_for(Reservation, 'after_update')
+def _reservation_updated_feed(mapper, connection, reservation):
+    # dirty instances with no column changes get here too
+    if object_session(reservation).is_modified(reservation,
+                                               include_collections=False):
+        _record_reservation_event(connection, 'update', reservation)
+
+
+@event.listens_for(Reservation, 'after_delete')
+def _reservation_deleted_feed(mapper, connection, reservation):
+    _record_reservation_event(connection, 'delete', reservation)
+
+
+def _record_series_event(connection, target, series_id):
+    # one event per series per transaction, however many of its
+    # exceptions changed with it
+    session = object_session(target)
+    recorded = session.info.setdefault('series_events', set())
+    if series_id is None or series_id in recorded:
+        return
+    recorded.add(series_id)
+    ReservationEvent.record(connection, 'series', None, series_id=series_id)
+    session.info['reservation_feed_changed'] = True
+
+
+@event.listens_for(ReservationSeries, 'after_insert')
+@event.listens_for(ReservationSeries, 'after_update')
+@event.listens_for(ReservationSeries, 'after_delete')
+def _series_changed_feed(mapper, connection, series):
+    _record_series_event(connection, series, series.id)
+
+
+@event.listens_for(SeriesException, 'after_insert')
+@event.listens_for(SeriesException, 'after_update')
+@event.listens_for(SeriesException, 'after_delete')
+def _series_exception_changed_feed(mapper, connection, exception):
+    _record_series_event(connection, exception, exception.series_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _notify_feed(session):
+    session.info.pop('series_events', None)
+    if session.info.pop('reservation_feed_changed', False):
+        reservation_feed.notify()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _forget_feed_changes(session, previous_transaction):
+    session.info.pop('series_events', None)
+    session.info.pop('reservation_feed_changed', None)
+
+
+@event.listens_for(Team.team_type, 'set')
+def _team_type_changed(team, value, oldvalue, initiator):
+    session = object_session(team)
+    if team.id is not None and session is not None:
+        session.info['reservation_index_stale'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _reservations_bulk_changed(update_context):
+    if update_context.mapper.class_ is Reservation:
+        update_context.session.info['reservation_index_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_reservation_changes(session):
+    changes = session.info.pop('reservation_changes', ())
+    if session.info.pop('reservation_index_stale', False):
+        reservation_index.clear()
+        return
+    for change in changes:
+        if len(change) == 1:
+            reservation_index.remove(change[0])
         else:
-            return Reservation.NO_CONFLICT, conflicting_reservations
+            reservation_index.add(*change)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_reservation_changes(session, previous_transaction):
+    # the rollback may only have undone some of the flushed changes, so
+    # rebuild the index rather than guess which ones survived
+    if session.info.pop('reservation_changes', None):
+        session.info['reservation_index_stale'] = True
+
+
+# add committed users to the name index; renames and deletes rebuild it.
+# Any of them empty the search cache.
+
+@event.listens_for(User, 'after_insert')
+def _user_created(mapper, connection, user):
+    object_session(user).info.setdefault('new_users', []).append(
+        (user.id, user.name))
+
+
+def _mark_names_stale(user):
+    object_session(user).info['name_index_stale'] = True
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, user):
+    if inspect(user).attrs.name.history.has_changes():
+        _mark_names_stale(user)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_removed(mapper, connection, user):
+    _mark_names_stale(user)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _users_bulk_changed(update_context):
+    if update_context.mapper.class_ is User:
+        update_context.session.info['name_index_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_user_changes(session):
+    new_users = session.info.pop('new_users', ())
+    stale = session.info.pop('name_index_stale', False)
+    if new_users or stale:
+        user_search_cache.clear()
+    if stale:
+        name_index.clear()
+        return
+    for user_id, name in new_users:
+        name_index.add(user_id, name)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _discard_user_changes(session, previous_transaction):
+    if session.info.pop('new_users', None):
+        session.info['name_index_stale'] = True
+
+
+# drop schedule snapshots after any commit that changed what they show:
+# reservations and series occurrences, or the teams and rooms they're
+# listed with
+
+def _mark_snapshots_stale(target):
+    session = object_session(target)
+    if session is not None:
+        session.info['snapshots_stale'] = True
+
+
+@event.listens_for(Reservation, 'after_insert')
+@event.listens_for(Reservation, 'after_update')
+@event.listens_for(Reservation, 'after_delete')
+@event.listens_for(Team, 'after_update')
+@event.listens_for(Team, 'after_delete')
+@event.listens_for(TeamType, 'after_update')
+@event.listens_for(Room, 'after_update')
+@event.listens_for(Room, 'after_delete')
+@event.listens_for(ReservationSeries, 'after_insert')
+@event.listens_for(ReservationSeries, 'after_update')
+@event.listens_for(ReservationSeries, 'after_delete')
+@event.listens_for(SeriesException, 'after_insert')
+@event.listens_for(SeriesException, 'after_update')
+@event.listens_for(SeriesException, 'after_delete')
+def _listed_row_changed(mapper, connection, target):
+    _mark_snapshots_stale(target)
+
+
+@event.listens_for(Team.members, 'append')
+@event.listens_for(Team.members, 'remove')
+@event.listens_for(User.teams, 'append')
+@event.listens_for(User.teams, 'remove')
+def _listed_members_changed(target, value, initiator):
+    _mark_snapshots_stale(target)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _listed_rows_bulk_changed(update_context):
+    if update_context.mapper.class_ in (Reservation, Team, Room,
+                                        ReservationSeries, SeriesException):
+        update_context.session.info['snapshots_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _drop_snapshots(session):
+    if session.info.pop('snapshots_stale', False):
+        schedule_snapshots.clear()
+
+
+# bump the room and feature versions after any commit that changed them.
+# Room.features changes are noted by _room_features_changed() below.
+
+@event.listens_for(Room, 'after_insert')
+@event.listens_for(Room, 'after_update')
+@event.listens_for(Room, 'after_delete')
+def _room_changed(mapper, connection, room):
+    object_session(room).info['rooms_changed'] = True
+
+
+@event.listens_for(RoomFeature, 'after_insert')
+@event.listens_for(RoomFeature, 'after_update')
+@event.listens_for(RoomFeature, 'after_delete')
+def _feature_changed(mapper, connection, feature):
+    object_session(feature).info['features_changed'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _catalog_bulk_changed(update_context):
+    if update_context.mapper.class_ is Room:
+        update_context.session.info['rooms_changed'] = True
+    elif update_context.mapper.class_ is RoomFeature:
+        update_context.session.info['features_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_catalog_versions(session):
+    if session.info.pop('rooms_changed', False):
+        room_version.bump()
+    if session.info.pop('features_changed', False):
+        feature_version.bump()
+
+
+# rebuild the series index after any commit that changed a series
+
+def _mark_series_stale(target):
+    session = object_session(target)
+    if session is not None:
+        session.info['series_index_stale'] = True
+
+
+@event.listens_for(ReservationSeries, 'after_insert')
+@event.listens_for(ReservationSeries, 'after_update')
+@event.listens_for(ReservationSeries, 'after_delete')
+@event.listens_for(SeriesException, 'after_insert')
+@event.listens_for(SeriesException, 'after_update')
+@event.listens_for(SeriesException, 'after_delete')
+def _series_changed(mapper, connection, target):
+    _mark_series_stale(target)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _series_bulk_changed(update_context):
+    if update_context.mapper.class_ in (ReservationSeries, SeriesException):
+        update_context.session.info['series_index_stale'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _rebuild_series_index(session):
+    if session.info.pop('series_index_stale', False):
+        series_index.clear()
+
+
+# rebuild the feature index after any commit that changed which rooms have
+# which features
+
+def _mark_features_stale(target):
+    session = object_session(target)
+    if session is not None:
+        session.info['feature_index_stale'] = True
+
+
+@event.listens_for(Room.features, 'append')
+@event.listens_for(Room.features, 'remove')
+@event.listens_for(RoomFeature.rooms, 'append')
+@event.listens_for(RoomFeature.rooms, 'remove')
+def _room_features_changed(target, value, initiator):
+    session = object_session(target)
+    if session is not None:
+        session.info['feature_index_stale'] = True
+        # room reads list features too, see _bump_catalog_versions()
+        session.info['rooms_changed'] = True
+
+
+@event.listens_for(Room, 'after_delete')
+@event.listens_for(RoomFeature, 'after_delete')
+def _room_or_feature_deleted(mapper, connection, target):
+    _mark_features_stale(target)
+
+
+@event.listens_for(Session, 'after_commit')
+def _rebuild_feature_index(session):
+    if session.info.pop('feature_index_stale', False):
+        feature_index.clear()
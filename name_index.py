@@ -0,0 +1,62 @@
+"""In-memory index of user names for prefix search."""
+
+from bisect import bisect_left, bisect_right
+
+from cache import LazyIndex
+
+
+class NameIndex(LazyIndex):
+    """Every user, sorted by case-folded name then ID.
+
+    Users whose names start with a prefix sit next to each other, so a
+    search is a binary search and a walk over the page it returns. The
+    index is filled by loader() the first time it is used, and kept up to
+    date with add() as users are committed. It only sees changes committed
+    by this process.
+
+    loader must return an iterable of (user_id, name) pairs.
+    """
+
+    def _reset(self):
+        # (folded name, user id), sorted, and the names in the same order
+        self._keys = []
+        self._names = []
+
+    def _build(self, rows):
+        entries = sorted((name.lower(), user_id, name)
+                         for user_id, name in rows
+                         if name is not None)
+        self._keys = [(folded, user_id) for folded, user_id, _ in entries]
+        self._names = [name for _, _, name in entries]
+
+    def add(self, user_id, name):
+        """Add a newly committed user."""
+        with self._lock:
+            if not self._loaded or name is None:
+                return
+            key = (name.lower(), user_id)
+            i = bisect_left(self._keys, key)
+            if i < len(self._keys) and self._keys[i] == key:
+                return
+            self._keys.insert(i, key)
+            self._names.insert(i, name)
+
+    def search(self, prefix, limit, after=None):
+        """Get up to limit users whose names start with prefix, any case.
+
+        Returns (folded name, user id, name) tuples in index order, starting
+        after the (folded name, user id) key given as after.
+        """
+        prefix = prefix.lower()
+        with self._lock:
+            self._ensure_loaded()
+            keys = self._keys
+            i = bisect_left(keys, (prefix,))
+            if after is not None:
+                i = max(i, bisect_right(keys, tuple(after)))
+            found = []
+            while i < len(keys) and len(found) < limit and \
+                    keys[i][0].startswith(prefix):
+                found.append(keys[i] + (self._names[i],))
+                i += 1
+            return found
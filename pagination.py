@@ -0,0 +1,77 @@
+"""Keyset pagination for list endpoints."""
+
+from sqlalchemy import and_, or_, DateTime, Integer, String
+import base64
+import iso8601
+import json
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def encode_cursor(values):
+    """Encode the sort key of the last row on a page as an opaque string."""
+    values = [v.isoformat() if hasattr(v, 'isoformat') else v
+              for v in values]
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+
+def decode_cursor(cursor, columns):
+    """Decode a cursor made by encode_cursor() for the given sort columns.
+
+    Raises ValueError if the cursor is malformed, including when a value
+    doesn't fit its column's type. Sort columns are never NULL.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise ValueError('invalid cursor')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('invalid cursor')
+    decoded = []
+    for column, value in zip(columns, values):
+        if isinstance(column.type, DateTime):
+            try:
+                value = iso8601.parse_date(value).replace(tzinfo=None)
+            except (iso8601.ParseError, TypeError):
+                raise ValueError('invalid cursor')
+        elif not _fits(column.type, value):
+            raise ValueError('invalid cursor')
+        decoded.append(value)
+    return decoded
+
+
+def _fits(column_type, value):
+    if isinstance(column_type, Integer):
+        # bool is an int too, but not a valid ID
+        return isinstance(value, (int, long)) and not isinstance(value, bool)
+    if isinstance(column_type, String):
+        return isinstance(value, basestring)
+    return False
+
+
+def _after(columns, values):
+    """Build a filter for rows sorting strictly after the given key."""
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column > value
+    return or_(column > value,
+               and_(column == value, _after(columns[1:], values[1:])))
+
+
+def paginate(query, columns, limit, cursor=None):
+    """Get one page of the query, ordered by the given unique sort key.
+
+    Returns the rows and a cursor for the next page, or None if this is
+    the last page. Raises ValueError for a malformed cursor.
+    """
+    query = query.order_by(*columns)
+    if cursor:
+        query = query.filter(_after(columns, decode_cursor(cursor, columns)))
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, c.key) for c in columns])
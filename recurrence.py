@@ -0,0 +1,101 @@
+"""Arithmetic on regularly repeating time intervals."""
+
+import datetime
+
+
+def _us(delta):
+    """Get a timedelta as an integer number of microseconds."""
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+class Recurrence(object):
+    """Occurrences [start + k * period, end + k * period] for k = 0, 1, ...
+
+    Occurrences start no later than until, and any starting at a time in
+    exceptions are skipped. Occurrences are never materialized up front:
+    the ones near a given time are found by arithmetic.
+    """
+
+    def __init__(self, start, end, period, until, exceptions=()):
+        """Create a recurrence; end - start must be shorter than period."""
+        self.start = start
+        self.duration = end - start
+        self.period = period
+        self.exceptions = frozenset(exceptions)
+        if until < start:
+            self.count = 0
+        else:
+            self.count = _us(until - start) // _us(period) + 1
+
+    @property
+    def last_end(self):
+        """Get the end of the last occurrence, counting skipped ones."""
+        return self.start + self.period * (self.count - 1) + self.duration
+
+    def _index_range(self, start, end):
+        """Get the first and last k whose occurrence overlaps [start, end]."""
+        period = _us(self.period)
+        # occurrence k overlaps if it starts by end and ends by start
+        first = -(_us(self.start + self.duration - start) // period)
+        last = _us(end - self.start) // period
+        return max(first, 0), min(last, self.count - 1)
+
+    def occurrences(self, start, end):
+        """Yield (start, end) of the occurrences overlapping [start, end]."""
+        first, last = self._index_range(start, end)
+        for k in xrange(first, last + 1):
+            occurrence = self.start + self.period * k
+            if occurrence not in self.exceptions:
+                yield occurrence, occurrence + self.duration
+
+    def overlaps(self, start, end):
+        """Check if any occurrence overlaps [start, end], ends included."""
+        for _ in self.occurrences(start, end):
+            return True
+        return False
+
+    def overlaps_recurrence(self, other):
+        """Check if any occurrence overlaps one of the other recurrence's.
+
+        Differences between the two recurrences' occurrence starts are
+        always the initial offset plus a multiple of the GCD of the
+        periods, which rules most pairs out without looking at a single
+        occurrence. Otherwise the sparser recurrence is walked over the
+        span both cover, checking each occurrence against the other.
+        """
+        if self.count == 0 or other.count == 0:
+            return False
+        span_start = max(self.start, other.start)
+        span_end = min(self.last_end, other.last_end)
+        if span_start > span_end:
+            return False
+
+        # other's occurrence starts minus self's, offset + m * step, must
+        # fall within [-other.duration, self.duration] for some m
+        step = _gcd(_us(self.period), _us(other.period))
+        offset = _us(other.start - self.start)
+        low = -_us(other.duration) - offset
+        high = _us(self.duration) - offset
+        if high // step < -(-low // step):
+            return False
+
+        if self.period >= other.period:
+            sparse, dense = self, other
+        else:
+            sparse, dense = other, self
+        for start, end in sparse.occurrences(span_start, span_end):
+            if dense.overlaps(start, end):
+                return True
+        return False
+
+
+FREQUENCIES = {
+    'daily': datetime.timedelta(days=1),
+    'weekly': datetime.timedelta(weeks=1)
+}
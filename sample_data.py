@@ -0,0 +1,337 @@
+"""Sample and generated data for new databases.
+
+Rows are written with batched Core inserts, or COPY on Postgres, rather
+than one ORM object at a time, so large volumes load in seconds. The
+sample rooms, features, team types, permissions and roles, with a user and
+single team for each role, are always created. SEED_USERS, SEED_TEAMS,
+SEED_ROOMS and SEED_RESERVATIONS add generated rows on top, and the same
+SEED_RANDOM always generates the same data.
+"""
+
+import datetime
+import os
+import random
+from cStringIO import StringIO
+
+from sqlalchemy import func, select
+import cache
+from models import User, Team, TeamType, Room, RoomFeature, Role, \
+    Permission, Reservation, join_table_user_roles, join_table_user_teams, \
+    join_table_role_permissions, join_table_room_roomfeatures
+
+BATCH = 10000
+
+SLOT = datetime.timedelta(hours=1)
+# generated reservations start every other hour from 8:00, leaving a gap
+# since touching reservations conflict, for this many days either side of
+# the origin
+SLOT_HOURS = (8, 10, 12, 14, 16, 18)
+SPAN_DAYS = 90
+
+FEATURES = ['Projector', 'TV', 'Webcam', 'Phone Line']
+
+ROOMS = [
+    ('1562', ['Projector']),
+    ('1564', ['Projector']),
+    ('1662', ['Projector']),
+    ('1560', ['Projector']),
+    ('1561', ['TV', 'Webcam']),
+    ('1665', ['TV', 'Webcam']),
+    ('1563', ['TV']),
+    ('1663', ['TV']),
+    ('1565', ['TV', 'Webcam']),
+    ('1661', ['Projector']),
+    ('1660', ['Projector'])
+]
+
+# name, priority, advance time in days
+TEAM_TYPES = [
+    ('single', 4, 7 * 2),
+    ('other_team', 4, 7 * 2),
+    ('class', 3, 7 * 2),
+    ('colab_class', 2, 7 * 2),
+    ('senior_project', 1, 7 * 2)
+]
+
+PERMISSIONS = [
+    'team.create',
+    'team.create.elevated',
+    'team.delete',
+    'team.delete.elevated',
+    'team.read',
+    'team.read.elevated',
+    'team.update',
+    'team.update.elevated',
+    'reservation.create',
+    'reservation.delete',
+    'reservation.delete.elevated',
+    'reservation.read',
+    'reservation.update',
+    'reservation.update.elevated',
+    'room.update.elevated',
+    'room.create.elevated',
+    'room.read',
+    'room.delete.elevated',
+    'feature.create',
+    'feature.delete',
+    'feature.update',
+    'feature.read',
+    'role.create',
+    'role.delete',
+    'role.update'
+]
+
+STUDENT = [
+    'team.create',
+    'team.delete',
+    'team.read',
+    'team.update',
+    'reservation.create',
+    'reservation.delete',
+    'reservation.read',
+    'reservation.update',
+    'room.read',
+    'feature.read'
+]
+
+# each role also gets a user and single team of the same name
+ROLES = [
+    ('admin', PERMISSIONS),
+    ('labbie', STUDENT + ['team.read.elevated']),
+    ('professor', STUDENT + ['team.create.elevated', 'team.read.elevated']),
+    ('student', STUDENT)
+]
+
+
+def volumes():
+    """Get the amounts of data to generate from the environment."""
+    return {
+        'users': int(os.getenv('SEED_USERS', 0)),
+        'teams': int(os.getenv('SEED_TEAMS', 0)),
+        'rooms': int(os.getenv('SEED_ROOMS', 0)),
+        'reservations': int(os.getenv('SEED_RESERVATIONS', 0)),
+        'random_seed': int(os.getenv('SEED_RANDOM', 0))
+    }
+
+
+def seed(engine, users=0, teams=0, rooms=0, reservations=0, random_seed=0,
+         origin=None):
+    """Write the sample data, then generated data, in one transaction.
+
+    Generated users are students with a single team each, as if they had
+    logged in; generated teams are other_teams of two to six of them.
+    Reservations belong to the generated teams, or the users' single teams
+    if there are none, and are spread over the generated rooms without
+    conflicting, around origin (default today).
+
+    Returns the IDs of the generated rows, see generate().
+    """
+    with engine.begin() as conn:
+        write_sample(conn)
+        generated = generate(conn, users, teams, rooms, reservations,
+                             random_seed, origin)
+        if conn.dialect.name == 'postgresql':
+            reset_sequences(conn)
+    # the caches don't see Core inserts
+    cache.clear_all()
+    return generated
+
+
+def write_sample(conn):
+    """Write the sample rooms, types, roles and users."""
+    insert(conn, RoomFeature.__table__, [
+        {'id': i, 'name': name} for i, name in enumerate(FEATURES, 1)])
+    feature_ids = dict((name, i) for i, name in enumerate(FEATURES, 1))
+    insert(conn, Room.__table__, [
+        {'id': i, 'number': number}
+        for i, (number, _) in enumerate(ROOMS, 1)])
+    insert(conn, join_table_room_roomfeatures, [
+        {'room_id': i, 'roomfeature_id': feature_ids[feature]}
+        for i, (_, features) in enumerate(ROOMS, 1)
+        for feature in features])
+
+    insert(conn, TeamType.__table__, [
+        {'id': i, 'name': name, 'priority': priority,
+         'advance_time': advance_time}
+        for i, (name, priority, advance_time) in enumerate(TEAM_TYPES, 1)])
+    insert(conn, Permission.__table__, [
+        {'id': i, 'name': name} for i, name in enumerate(PERMISSIONS, 1)])
+    permission_ids = dict((name, i) for i, name in enumerate(PERMISSIONS, 1))
+
+    # TODO don't seed users in production?
+    insert(conn, Role.__table__, [
+        {'id': i, 'name': name} for i, (name, _) in enumerate(ROLES, 1)])
+    insert(conn, join_table_role_permissions, [
+        {'role_id': i, 'permission_id': permission_ids[permission]}
+        for i, (_, permissions) in enumerate(ROLES, 1)
+        for permission in permissions])
+    insert(conn, User.__table__, [
+        {'id': i, 'name': name, 'email': name + '@example.com'}
+        for i, (name, _) in enumerate(ROLES, 1)])
+    insert(conn, join_table_user_roles, [
+        {'user_id': i, 'role_id': i} for i in range(1, len(ROLES) + 1)])
+    insert(conn, Team.__table__, [
+        {'id': i, 'name': name, 'team_type_id': 1}
+        for i, (name, _) in enumerate(ROLES, 1)])
+    insert(conn, join_table_user_teams, [
+        {'user_id': i, 'team_id': i} for i in range(1, len(ROLES) + 1)])
+
+    # a week from now, for the admin's team, in the last room
+    start = datetime.datetime.now() + datetime.timedelta(days=7)
+    insert(conn, Reservation.__table__, [
+        {'team_id': 1, 'room_id': len(ROOMS), 'created_by_id': 1,
+         'start': start, 'end': start + SLOT}])
+
+
+def generate(conn, users=0, teams=0, rooms=0, reservations=0, random_seed=0,
+             origin=None):
+    """Write generated rows after any already in the database.
+
+    Returns a dict of the generated user, team and room IDs, with the
+    teams as (team ID, ID of a member) pairs, and the origin used.
+    """
+    rng = random.Random(random_seed)
+    if origin is None:
+        origin = datetime.datetime.combine(datetime.date.today(),
+                                           datetime.time())
+    student = conn.scalar(select([Role.id]).where(Role.name == 'student'))
+    single, other = [
+        conn.scalar(select([TeamType.id]).where(TeamType.name == name))
+        for name in ('single', 'other_team')]
+
+    user_ids = range(next_id(conn, User), next_id(conn, User) + users)
+    insert(conn, User.__table__, [
+        {'id': u, 'name': 'user%06d' % u,
+         'email': 'user%06d@example.com' % u} for u in user_ids])
+    insert(conn, join_table_user_roles, [
+        {'user_id': u, 'role_id': student} for u in user_ids])
+
+    first_team = next_id(conn, Team)
+    single_teams = [(first_team + i, u) for i, u in enumerate(user_ids)]
+    insert(conn, Team.__table__, [
+        {'id': t, 'name': 'user%06d' % u, 'team_type_id': single}
+        for t, u in single_teams])
+    insert(conn, join_table_user_teams, [
+        {'user_id': u, 'team_id': t} for t, u in single_teams])
+    if teams and len(user_ids) < 2:
+        raise ValueError('generated teams need at least two users')
+    shared_teams = []
+    team_rows = []
+    member_rows = []
+    for i in range(teams):
+        team_id = first_team + len(single_teams) + i
+        members = rng.sample(user_ids, min(len(user_ids),
+                                           rng.randint(2, 6)))
+        shared_teams.append((team_id, members[0]))
+        team_rows.append({'id': team_id, 'name': 'team%06d' % team_id,
+                          'team_type_id': other})
+        member_rows.extend({'user_id': u, 'team_id': team_id}
+                           for u in members)
+    insert(conn, Team.__table__, team_rows)
+    insert(conn, join_table_user_teams, member_rows)
+
+    feature_ids = [row[0] for row in conn.execute(select([RoomFeature.id]))]
+    room_ids = range(next_id(conn, Room), next_id(conn, Room) + rooms)
+    insert(conn, Room.__table__, [
+        {'id': r, 'number': 'R%05d' % r} for r in room_ids])
+    insert(conn, join_table_room_roomfeatures, [
+        {'room_id': r, 'roomfeature_id': f} for r in room_ids
+        for f in rng.sample(feature_ids,
+                            rng.randint(0, min(2, len(feature_ids))))])
+
+    owners = shared_teams or single_teams
+    per_room = 2 * SPAN_DAYS * len(SLOT_HOURS)
+    if reservations:
+        if not owners:
+            raise ValueError('generated reservations need users')
+        if reservations > len(room_ids) * per_room:
+            raise ValueError('%d generated rooms hold at most %d '
+                             'reservations' % (len(room_ids),
+                                               len(room_ids) * per_room))
+    rows = []
+    # pick distinct slots, in order so rows go in by room and time
+    for slot in sorted(rng.sample(xrange(len(room_ids) * per_room),
+                                  reservations)):
+        room, slot = divmod(slot, per_room)
+        day, hour = divmod(slot, len(SLOT_HOURS))
+        start = origin + datetime.timedelta(days=day - SPAN_DAYS,
+                                            hours=SLOT_HOURS[hour])
+        team_id, user_id = rng.choice(owners)
+        rows.append({'team_id': team_id, 'room_id': room_ids[room],
+                     'created_by_id': user_id,
+                     'start': start, 'end': start + SLOT})
+    insert(conn, Reservation.__table__, rows)
+
+    return {
+        'users': user_ids,
+        'teams': shared_teams or single_teams,
+        'rooms': room_ids,
+        'origin': origin
+    }
+
+
+def next_id(conn, model):
+    """Get the ID after the highest one in use for the model."""
+    return (conn.scalar(select([func.max(model.id)])) or 0) + 1
+
+
+def insert(conn, table, rows):
+    """Insert rows, given as dicts, in batches; by COPY on Postgres."""
+    if conn.dialect.name == 'postgresql':
+        copy(conn, table, rows)
+        return
+    for i in range(0, len(rows), BATCH):
+        conn.execute(table.insert(), rows[i:i + BATCH])
+
+
+def copy(conn, table, rows):
+    """Load rows into a Postgres table with COPY ... FROM STDIN."""
+    if not rows:
+        return
+    columns = sorted(rows[0])
+    data = StringIO()
+    for row in rows:
+        data.write(','.join(_csv_field(row[c]) for c in columns) + '\n')
+    data.seek(0)
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(copy_statement(conn.dialect, table, columns), data)
+    finally:
+        cursor.close()
+
+
+def copy_statement(dialect, table, columns):
+    """Get the COPY statement loading CSV rows of the given columns."""
+    # columns such as "end" are reserved words
+    quote = dialect.identifier_preparer.quote
+    return 'COPY %s (%s) FROM STDIN WITH CSV' % (
+        quote(table.name), ', '.join(quote(c) for c in columns))
+
+
+def _csv_field(value):
+    # an unquoted empty field is NULL in CSV mode and a quoted one is an
+    # empty string, so every string is quoted
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, long)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '"%s"' % value.replace('"', '""')
+
+
+def reset_sequences(conn):
+    """Move each Postgres ID sequence past the IDs inserted explicitly."""
+    for table in (RoomFeature, Room, TeamType, Permission, Role, User, Team,
+                  Reservation):
+        name = table.__tablename__
+        conn.execute(
+            "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+            "COALESCE(MAX(id), 0) + 1, false) FROM %s"
+            % (name, conn.dialect.identifier_preparer.quote(name)))
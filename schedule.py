@@ -0,0 +1,180 @@
+"""In-memory index of reservations, used for conflict checks."""
+
+from bisect import bisect_left, bisect_right, insort
+import datetime
+
+from cache import LazyIndex
+
+
+class RoomSchedule(object):
+    """Reservations in a single room, kept sorted by start time.
+
+    Each entry is a (start, end, reservation_id, priority) tuple.
+    """
+
+    def __init__(self):
+        """Create an empty schedule."""
+        self.entries = []
+        # longest reservation ever added, bounds how far back a scan goes
+        self.max_length = datetime.timedelta(0)
+
+    def add(self, entry):
+        """Insert an entry, keeping the list sorted."""
+        insort(self.entries, entry)
+        length = entry[1] - entry[0]
+        if length > self.max_length:
+            self.max_length = length
+
+    def remove(self, entry):
+        """Remove an entry if present."""
+        i = bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def overlapping(self, start, end):
+        """Yield entries that overlap [start, end], endpoints included.
+
+        Only entries starting within max_length before start can reach
+        it, so the scan is O(log n + k) for reservations of bounded length.
+        """
+        hi = bisect_right(self.entries,
+                          (end, datetime.datetime.max, float('inf')))
+        lo = bisect_left(self.entries, (start - self.max_length,))
+        for entry in self.entries[lo:hi]:
+            if entry[1] >= start:
+                yield entry
+
+
+class ReservationIndex(LazyIndex):
+    """Per-room interval index of every reservation.
+
+    The index is filled by loader() the first time it is used, and kept up
+    to date with add() and remove() as reservations are committed. It only
+    sees changes committed by this process.
+
+    loader must return an iterable of (reservation_id, room_id, start, end,
+    priority) tuples.
+    """
+
+    def _reset(self):
+        self._rooms = {}
+        self._by_id = {}
+
+    def _build(self, rows):
+        rooms = {}
+        by_id = {}
+        for res_id, room_id, start, end, priority in rows:
+            if room_id is None or start is None or end is None:
+                continue
+            entry = (start, end, res_id, priority)
+            rooms.setdefault(room_id, RoomSchedule()).add(entry)
+            by_id[res_id] = (room_id, entry)
+        self._rooms = rooms
+        self._by_id = by_id
+
+    def add(self, res_id, room_id, start, end, priority):
+        """Add a reservation, replacing any earlier copy of it."""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove(res_id)
+            if room_id is None or start is None or end is None:
+                return
+            entry = (start, end, res_id, priority)
+            self._rooms.setdefault(room_id, RoomSchedule()).add(entry)
+            self._by_id[res_id] = (room_id, entry)
+
+    def remove(self, res_id):
+        """Remove a reservation."""
+        with self._lock:
+            if self._loaded:
+                self._remove(res_id)
+
+    def _remove(self, res_id):
+        found = self._by_id.pop(res_id, None)
+        if found is not None:
+            room_id, entry = found
+            self._rooms[room_id].remove(entry)
+
+    def conflicts(self, room_id, start, end, exclude_id=None):
+        """Get (reservation_id, priority) for reservations overlapping.
+
+        Overlap is inclusive of the endpoints, matching the original range
+        query on the reservations table.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            schedule = self._rooms.get(room_id)
+            if schedule is None:
+                return []
+            return [(res_id, priority)
+                    for _, _, res_id, priority
+                    in schedule.overlapping(start, end)
+                    if res_id != exclude_id]
+
+
+def sweep_conflicts(new, existing):
+    """Find overlaps for a batch of new reservations in one sorted sweep.
+
+    new holds (room_id, start, end, key) tuples and existing holds
+    (room_id, start, end, reservation_id, priority) tuples, both sorted by
+    room and start. Overlap is inclusive of the endpoints.
+
+    Returns a list of (key, key) pairs of new reservations that overlap
+    each other, and a dict of key -> [(reservation_id, priority)] for new
+    reservations that overlap existing ones.
+    """
+    clashes = []
+    conflicts = {}
+    j = 0
+    room = None
+    active = []        # existing reservations that may still overlap
+    latest = None      # new reservation reaching furthest so far
+    for room_id, start, end, key in new:
+        if room_id != room:
+            room = room_id
+            active = []
+            latest = None
+            while j < len(existing) and existing[j][0] < room_id:
+                j += 1
+        while j < len(existing) and existing[j][0] == room_id and \
+                existing[j][1] <= end:
+            active.append(existing[j])
+            j += 1
+        # new reservations arrive in start order, so anything ending
+        # before this one starts can't overlap the rest of the room either
+        active = [e for e in active if e[2] >= start]
+        if active:
+            conflicts[key] = [(e[3], e[4]) for e in active]
+        if latest is not None and latest[0] >= start:
+            clashes.append((latest[1], key))
+        if latest is None or end > latest[0]:
+            latest = (end, key)
+    return clashes, conflicts
+
+
+class SeriesIndex(LazyIndex):
+    """Recurring reservation series, grouped by room.
+
+    Series are few and rarely change, so rather than being kept up to date
+    entry by entry the index is rebuilt by loader() on first use after
+    clear().
+
+    loader must return an iterable of (series_id, room_id, recurrence)
+    tuples.
+    """
+
+    def _reset(self):
+        self._rooms = {}
+
+    def _build(self, rows):
+        rooms = {}
+        for series_id, room_id, recurrence in rows:
+            rooms.setdefault(room_id, []).append((series_id, recurrence))
+        self._rooms = rooms
+
+    def in_room(self, room_id):
+        """Get (series_id, recurrence) for every series in the room."""
+        with self._lock:
+            self._ensure_loaded()
+            return self._rooms.get(room_id, [])
@@ -1,31 +1,113 @@
 """Unit tests."""
 
 import os
+import base64
 import database
 import unittest
 import tempfile
 import json
+import logging
 import datetime
-
+import shutil
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from sqlalchemy import event
+from werkzeug.http import http_date
+
+import diagnostics
 import main
+import metrics
+import models
+import sample_data
 from models import *
 
 
+@contextmanager
+def count_queries():
+    """Count the SQL statements executed inside the block.
+
+    Yields a list that holds the statements once the block exits.
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(database.engine, 'before_cursor_execute',
+                 before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(database.engine, 'before_cursor_execute',
+                     before_cursor_execute)
+
+
+# most SQL statements a single request to each endpoint may run
+QUERY_BUDGETS = {
+    'feature_list': 1,
+    'get_reservation_series': 2,
+    'get_reservations': 5,
+    'reservation_read': 7,
+    'room_availability': 4,
+    'room_list': 2,
+    'room_read': 2,
+    'team_read': 3,
+    'user_read': 2,
+    'user_search_partial': 1
+}
+
+
+# seeded once per process, then copied for each test, see setUpModule()
+TEMPLATE_DB = None
+
+
+def setUpModule():
+    """Create and seed the template database."""
+    global TEMPLATE_DB
+    fd, TEMPLATE_DB = tempfile.mkstemp()
+    os.close(fd)
+    database.set_engine('sqlite:///' + TEMPLATE_DB)
+    database.init_db()
+    database.get_db().remove()
+    database.engine.dispose()
+
+
+def tearDownModule():
+    """Remove the template database."""
+    os.unlink(TEMPLATE_DB)
+
+
 class TestCase(unittest.TestCase):
     """Unit tests for APIs."""
 
     def setUp(self):
         """Set up for the tests."""
         self.db_fd, self.db_name = tempfile.mkstemp()
+        shutil.copyfile(TEMPLATE_DB, self.db_name)
         database.set_engine('sqlite:///' + self.db_name)
-        database.init_db()
         self.app = main.app.test_client()
+        self.query_problems = []
+        diagnostics.add_listener(self.check_queries)
 
     def tearDown(self):
         """Cleanup from the tests."""
+        diagnostics.remove_listener(self.check_queries)
         database.get_db().close()
         os.close(self.db_fd)
         os.unlink(self.db_name)
+        self.assertEquals(self.query_problems, [])
+
+    def check_queries(self, trace):
+        """Note requests over their query budget or repeating a SELECT."""
+        budget = QUERY_BUDGETS.get(trace.endpoint)
+        if budget is not None and trace.statements > budget:
+            self.query_problems.append(
+                '%s ran %d statements, budget %d'
+                % (trace.endpoint, trace.statements, budget))
+        for shape, count in trace.repeated():
+            self.query_problems.append(
+                '%s ran %d times in %s' % (shape, count, trace.endpoint))
 
     def test_auth(self):
         """Test the authentication process."""
@@ -167,11 +249,192 @@ class TestCase(unittest.TestCase):
         self.assertTrue("members" not in got)
         self.assertTrue("advance_time" not in got)
 
+    def test_init_db_creates_indexes(self):
+        """Test that the declared indexes exist after init_db."""
+        from sqlalchemy import inspect
+        inspector = inspect(database.engine)
+        names = set(i['name'] for i in inspector.get_indexes('reservations'))
+        self.assertTrue('ix_reservations_room_id_start_end' in names)
+        self.assertTrue('ix_reservations_end' in names)
+        Reservation.__table__.indexes.copy().pop().drop(bind=database.engine)
+        database.create_indexes()
+        inspector = inspect(database.engine)
+        self.assertEquals(
+            names,
+            set(i['name'] for i in inspector.get_indexes('reservations')))
+
+    def test_generated_data(self):
+        """Test that generated data is reproducible and conflict free."""
+        from sqlalchemy import select
+        volumes = {'users': 20, 'teams': 5, 'rooms': 3, 'reservations': 200,
+                   'random_seed': 7,
+                   'origin': datetime.datetime(2030, 1, 1)}
+        with database.engine.begin() as conn:
+            generated = sample_data.generate(conn, **volumes)
+        self.assertEquals(len(generated['users']), 20)
+        self.assertEquals(len(generated['teams']), 5)
+        self.assertEquals(Reservation.query.count(), 201)
+        a = Reservation.__table__.alias()
+        b = Reservation.__table__.alias()
+        overlapping = database.engine.execute(select([a.c.id]).where(
+            (a.c.room_id == b.c.room_id) & (a.c.id < b.c.id) &
+            (a.c.end >= b.c.start) & (a.c.start <= b.c.end))).fetchall()
+        self.assertEquals(overlapping, [])
+
+        rows = []
+        try:
+            for _ in range(2):
+                fd, name = tempfile.mkstemp()
+                os.close(fd)
+                try:
+                    database.set_engine('sqlite:///' + name)
+                    database.init_db(**volumes)
+                    rows.append(database.engine.execute(
+                        select([Reservation.team_id, Reservation.room_id,
+                                Reservation.start]).where(Reservation.id > 1)
+                        .order_by(Reservation.id)).fetchall())
+                finally:
+                    database.get_db().remove()
+                    database.engine.dispose()
+                    os.unlink(name)
+        finally:
+            # back to this test's database, which tearDown() removes
+            database.set_engine('sqlite:///' + self.db_name)
+        self.assertEquals(len(rows[0]), 200)
+        self.assertEquals(rows[0], rows[1])
+
+    def test_copy_statement_quotes_identifiers(self):
+        """Test that COPY quotes reserved column names on Postgres."""
+        from sqlalchemy.dialects import postgresql
+        self.assertEquals(
+            sample_data.copy_statement(
+                postgresql.dialect(), Reservation.__table__,
+                ['created_by_id', 'end', 'room_id', 'start', 'team_id']),
+            'COPY reservations (created_by_id, "end", room_id, start, '
+            'team_id) FROM STDIN WITH CSV')
+
+    def test_copy_fields_keep_empty_strings(self):
+        """Test that COPY data tells empty strings apart from NULL."""
+        self.assertEquals(
+            [sample_data._csv_field(value) for value in (
+                None, '', 3, True, u'caf\xe9', 'say "hi"',
+                datetime.datetime(2030, 1, 1, 8, 30))],
+            ['', '""', '3', 'true', '"caf\xc3\xa9"', '"say ""hi"""',
+             '"2030-01-01T08:30:00"'])
+
+    def test_requests_return_pool_connections(self):
+        """Test that pool stats count checkouts and nothing leaks."""
+        database.reset_pool_stats()
+        rv = self.app.get('/v1/room')
+        self.assertEquals(rv.status_code, 200)
+        self.assertTrue(database.pool_stats['checkouts'] > 0)
+        self.assertEquals(database.pool_stats['checked_out'], 0)
+        self.assertEquals(database.pool_stats['checkins'],
+                          database.pool_stats['checkouts'])
+
+        # connections checked out across a reset are still counted
+        connection = database.engine.connect()
+        database.reset_pool_stats()
+        self.assertEquals(database.pool_stats['checked_out'], 1)
+        connection.close()
+        self.assertEquals(database.pool_stats['checked_out'], 0)
+        self.assertEquals(database.pool_stats['peak_checked_out'], 1)
+
+    def test_reset_after_fork(self):
+        """Test that a forked worker starts with empty caches."""
+        import wsgi
+        self.assertTrue(wsgi.app is main.app)
+        u = User.query.filter_by(name='student').first()
+        User.verify_auth_token(u.generate_auth_token())
+        self.assertTrue(len(token_cache) > 0)
+        database.reset_after_fork()
+        self.assertEquals(len(token_cache), 0)
+        self.assertEquals(database.pool_stats['checked_out'], 0)
+
+    def test_metrics(self):
+        """Test that requests, SQL and token checks show up in metrics."""
+        metrics.clear_all()
+        token = User.query.filter_by(
+            name='admin').first().generate_auth_token()
+        database.get_db().remove()
+        self.app.get('/v1/room')
+        self.app.get('/v1/room')
+        with count_queries() as statements:
+            self.app.get('/v1/reservation/1',
+                         headers={'Authorization': 'Bearer ' + token})
+        rv = self.app.get('/metrics')
+        self.assertEquals(rv.status_code, 200)
+        lines = rv.data.splitlines()
+        self.assertTrue(
+            'http_request_duration_seconds_count{endpoint="room_list"} 2'
+            in lines)
+        self.assertTrue(
+            'http_request_sql_statements_sum{endpoint="reservation_read"} %d'
+            % len(statements) in lines)
+        self.assertTrue('jwt_verify_duration_seconds_count 1' in lines)
+        self.assertTrue(any(line.startswith('cache_misses_total{cache="token"}')
+                            for line in lines))
+
+    def test_diagnostics(self):
+        """Test flagging slow statements and repeated SELECTs."""
+        messages = []
+
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        handler = Handler()
+        diagnostics.log.addHandler(handler)
+        enabled = diagnostics.enabled
+        slow = diagnostics.slow_query_seconds
+        diagnostics.enabled = True
+        diagnostics.slow_query_seconds = 0
+        try:
+            self.app.get('/v1/room')
+        finally:
+            diagnostics.enabled = enabled
+            diagnostics.slow_query_seconds = slow
+            diagnostics.log.removeHandler(handler)
+        self.assertTrue(messages)
+        self.assertTrue(all(m.startswith('slow query') and ' in room_list: '
+                            in m for m in messages))
+
+        trace = diagnostics.RequestTrace('team_read')
+        for i in range(12):
+            trace.record('SELECT name FROM users WHERE id IN (%s)'
+                         % ', '.join(['?'] * (i + 1)))
+            trace.record('INSERT INTO users (name) VALUES (?)')
+        self.assertEquals(trace.statements, 24)
+        self.assertEquals(trace.repeated(), [
+            ('SELECT name FROM users WHERE id IN (...)', 12)])
+
     def test_student_has_permission(self):
         u = User.query.filter_by(name='student').first()
         self.assertTrue(u.has_permission('room.read'))
         self.assertFalse(u.has_permission('team.create.elevated'))
 
+    def test_has_permission_uses_index(self):
+        """Test that repeat permission checks don't hit the database."""
+        u = User.query.filter_by(name='professor').first()
+        with count_queries() as statements:
+            self.assertTrue(u.has_permission('team.read.elevated'))
+        self.assertEquals(len(statements), 1)
+
+        with count_queries() as statements:
+            self.assertTrue(u.has_permission('team.create.elevated'))
+            self.assertFalse(u.has_permission('role.create'))
+        self.assertEquals(len(statements), 0)
+
+    def test_permission_index_invalidated_on_role_permission_change(self):
+        """Test that changing a role's permissions is picked up."""
+        u = User.query.filter_by(name='student').first()
+        self.assertFalse(u.has_permission('role.create'))
+        role = Role.query.filter_by(name='student').first()
+        role.permissions.append(
+            Permission.query.filter_by(name='role.create').first())
+        database.get_db().commit()
+        self.assertTrue(u.has_permission('role.create'))
+
     def test_failure_of_token_verify(self):
         u = User.verify_auth_token("asdfasdfsadfsadfsadfa")
         self.assertIsNone(u)
@@ -184,6 +447,40 @@ class TestCase(unittest.TestCase):
         got = User.verify_auth_token(token)
         self.assertIsNone(got)
 
+    def test_token_verify_cached(self):
+        """Test that a verified token is served from the token cache."""
+        u = User.query.filter_by(name='student').first()
+        token = u.generate_auth_token()
+        hits_before = token_cache.hits
+        self.assertEquals(User.verify_auth_token(token).id, u.id)
+        got = User.verify_auth_token(token)
+        self.assertEquals(token_cache.hits - hits_before, 1)
+        self.assertEquals(got.id, u.id)
+        self.assertEquals(got.name, u.name)
+        self.assertTrue(got.has_permission('room.read'))
+        self.assertFalse(got.has_permission('team.create.elevated'))
+
+        # a size of 0, as several gunicorn workers use, caches nothing
+        try:
+            token_cache.max_size = 0
+            token_cache.clear()
+            User.verify_auth_token(token)
+            self.assertEquals(len(token_cache), 0)
+        finally:
+            token_cache.max_size = 4096
+
+    def test_token_cache_invalidated_on_role_change(self):
+        """Test that changing a user's roles drops their cached tokens."""
+        u = User.query.filter_by(name='student').first()
+        token = u.generate_auth_token()
+        self.assertFalse(
+            User.verify_auth_token(token).has_permission('role.create'))
+        admin_role = Role.query.filter_by(name='admin').first()
+        u.roles.append(admin_role)
+        database.get_db().commit()
+        self.assertTrue(
+            User.verify_auth_token(token).has_permission('role.create'))
+
     def test_delete_team(self):
         """Test that teams can be deleted and their associated reservations will be deleted."""
         team_count_original = len(Team.query.all())
@@ -342,6 +639,421 @@ class TestCase(unittest.TestCase):
         num_reservations_after = len(Reservation.query.all())
         self.assertEquals(num_reservations_after - num_reservations_before, 1)
 
+    def test_validate_conflicts_uses_index(self):
+        """Test that conflict checks are answered without a range query."""
+        admin = User.query.filter_by(name='admin').first()
+        team = admin.teams[0]
+        team.team_type
+        room = Room.query.filter_by(number='1660').first()
+        existing = Reservation.query.filter_by(room_id=room.id).first()
+
+        overlapping = Reservation(start=existing.start,
+                                  end=existing.end,
+                                  team=team, room=room, created_by=admin)
+        status, conflicts = overlapping.validate_conflicts()
+        self.assertEquals(status, Reservation.CONFLICT_FAILURE)
+        self.assertEquals([c.id for c in conflicts], [existing.id])
+
+        later = Reservation(start=existing.end + datetime.timedelta(hours=1),
+                            end=existing.end + datetime.timedelta(hours=2),
+                            team=team, room=room, created_by=admin)
+        with count_queries() as statements:
+            status, conflicts = later.validate_conflicts()
+        self.assertEquals(status, Reservation.NO_CONFLICT)
+        self.assertEquals(len(statements), 0)
+
+        # committed reservations are picked up by the index
+        database.get_db().expunge(overlapping)
+        database.get_db().add(later)
+        database.get_db().commit()
+        status, conflicts = Reservation(
+            start=later.start, end=later.end, team=team, room=room,
+            created_by=admin).validate_conflicts()
+        self.assertEquals(status, Reservation.CONFLICT_FAILURE)
+
+    def test_reservation_changes(self):
+        """Test following reservation changes from a cursor."""
+        student = User.query.filter_by(name='student').first()
+        team = Team(name='feed_team')
+        team.team_type = TeamType.query.filter_by(name='other_team').first()
+        team.members.append(student)
+        database.get_db().add(team)
+        database.get_db().commit()
+        team_id = team.id
+        room_id = Room.query.first().id
+        token = student.generate_auth_token()
+        start = datetime.datetime(2031, 2, 3, 9)
+
+        rv = self.app.get('/v1/reservation/changes?timeout=0')
+        self.assertEquals(rv.status_code, 200)
+        got = json.loads(rv.data)
+        self.assertEquals(got['events'], [])
+        cursor = got['cursor']
+
+        rv = self.app.post('/v1/reservation', data=json.dumps({
+            "team_id": team_id,
+            "room_id": room_id,
+            "start": start.isoformat(),
+            "end": (start + datetime.timedelta(hours=1)).isoformat()
+        }), content_type='application/json',
+            headers={"Authorization": "Bearer " + token})
+        self.assertEquals(rv.status_code, 201)
+        res_id = Reservation.query.filter_by(team_id=team_id).first().id
+        rv = self.app.put('/v1/reservation/%d' % res_id, data=json.dumps({
+            "room_id": room_id,
+            "start": start.isoformat(),
+            "end": (start + datetime.timedelta(hours=2)).isoformat()
+        }), content_type='application/json',
+            headers={"Authorization": "Bearer " + token})
+        self.assertEquals(rv.status_code, 204)
+        rv = self.app.delete('/v1/team/%d' % team_id,
+                             headers={"Authorization": "Bearer " + token})
+        self.assertEquals(rv.status_code, 204)
+
+        rv = self.app.get('/v1/reservation/changes?timeout=0&since=%d'
+                          % cursor)
+        got = json.loads(rv.data)
+        self.assertEquals([(e['type'], e['reservation']['id'])
+                           for e in got['events']],
+                          [('create', res_id), ('update', res_id),
+                           ('delete', res_id)])
+        self.assertEquals(got['events'][1]['reservation']['end'],
+                          (start + datetime.timedelta(hours=2)).isoformat())
+        seqs = [e['seq'] for e in got['events']]
+        self.assertEquals(seqs, sorted(seqs))
+        self.assertEquals(got['cursor'], seqs[-1])
+
+        # the event stream resumes after Last-Event-ID
+        rv = self.app.get('/v1/reservation/changes/stream', buffered=False,
+                          headers={'Last-Event-ID': str(seqs[0])})
+        self.assertEquals(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        self.assertEquals(next(chunks), 'retry: 3000\n\n')
+        ids = [line for line in next(chunks).splitlines()
+               if line.startswith('id: ')]
+        self.assertEquals(ids, ['id: %d' % seq for seq in seqs[1:]])
+        rv.close()
+
+        for timeout in ('nan', 'inf', '-1', 'x'):
+            rv = self.app.get('/v1/reservation/changes?timeout=' + timeout)
+            self.assertEquals(rv.status_code, 400)
+
+        # events past the retention period go the next time one is recorded
+        ReservationEvent.query.update({
+            'created': datetime.datetime.utcnow() - models.feed_retention -
+            datetime.timedelta(minutes=1)})
+        database.get_db().commit()
+        ReservationEvent.pruned_at = 0
+        try:
+            ReservationEvent.record(database.get_db().connection(),
+                                    'delete', res_id)
+            database.get_db().commit()
+        finally:
+            ReservationEvent.pruned_at = 0
+        self.assertEquals([e.id for e in ReservationEvent.query],
+                          [seqs[-1] + 1])
+        rv = self.app.get('/v1/reservation/changes?timeout=0&since=%d'
+                          % seqs[0])
+        self.assertEquals(rv.status_code, 410)
+        rv = self.app.get('/v1/reservation/changes?timeout=0&since=%d'
+                          % seqs[-1])
+        self.assertEquals(len(json.loads(rv.data)['events']), 1)
+
+    def test_add_reservation_batch(self):
+        """Test adding a semester's worth of sessions in one request."""
+        professor = User.query.filter_by(name='professor').first()
+        team = Team(name='class_1')
+        team.team_type = TeamType.query.filter_by(name='class').first()
+        team.members.append(professor)
+        database.get_db().add(team)
+        database.get_db().commit()
+        team_id = team.id
+        rooms = [r.id for r in Room.query.limit(2)]
+        token = professor.generate_auth_token()
+        num_reservations_before = len(Reservation.query.all())
+
+        start = datetime.datetime(2017, 1, 30, 10)
+        batch = []
+        for week in range(15):
+            for room_id in rooms:
+                session_start = start + datetime.timedelta(weeks=week)
+                batch.append({
+                    "team_id": team_id,
+                    "room_id": room_id,
+                    "start": session_start.isoformat(),
+                    "end": (session_start +
+                            datetime.timedelta(hours=2)).isoformat()
+                })
+
+        # two sessions in the same room at once fail the whole batch
+        rv = self.app.post(
+            '/v1/reservation/batch',
+            data=json.dumps({"reservations": batch + [batch[0]]}),
+            content_type='application/json',
+            headers={"Authorization": "Bearer " + token}
+        )
+        self.assertEquals(rv.status_code, 409)
+        self.assertFalse(json.loads(rv.data)["overridable"])
+        self.assertEquals(len(Reservation.query.all()),
+                          num_reservations_before)
+
+        for bad in ({"team_id": [team_id]}, {"room_id": {}},
+                    {"room_id": True}, {"team_id": "1"}):
+            rv = self.app.post(
+                '/v1/reservation/batch',
+                data=json.dumps({"reservations": [dict(batch[0], **bad)]}),
+                content_type='application/json',
+                headers={"Authorization": "Bearer " + token}
+            )
+            self.assertEquals(rv.status_code, 400)
+
+        rv = self.app.post(
+            '/v1/reservation/batch',
+            data=json.dumps({"reservations": batch}),
+            content_type='application/json',
+            headers={"Authorization": "Bearer " + token}
+        )
+        self.assertEquals(rv.status_code, 201)
+        self.assertEquals(len(json.loads(rv.data)["ids"]), 30)
+        self.assertEquals(len(Reservation.query.all()) -
+                          num_reservations_before, 30)
+
+    def test_add_reservation_batch_override(self):
+        """Test that batches follow the single-reservation override rules."""
+        student = User.query.filter_by(name='student').first()
+        low_team = Team(name='other_team_1')
+        low_team.team_type = TeamType.query.filter_by(
+            name='other_team').first()
+        low_team.members.append(student)
+        high_team = Team(name='senior_project_1')
+        high_team.team_type = TeamType.query.filter_by(
+            name='senior_project').first()
+        high_team.members.append(student)
+        room = Room.query.first()
+        start = datetime.datetime(2017, 3, 1, 9)
+        low = Reservation(start=start,
+                          end=start + datetime.timedelta(hours=1),
+                          team=low_team, room=room, created_by=student)
+        database.get_db().add_all([low_team, high_team, low])
+        database.get_db().commit()
+        low_id = low.id
+        low_team_id = low_team.id
+        high_team_id = high_team.id
+        room_id = room.id
+        token = student.generate_auth_token()
+
+        def post(team_id, override):
+            return self.app.post(
+                '/v1/reservation/batch',
+                data=json.dumps({
+                    "reservations": [{
+                        "team_id": team_id,
+                        "room_id": room_id,
+                        "start": (start + datetime.timedelta(
+                            minutes=30)).isoformat(),
+                        "end": (start + datetime.timedelta(
+                            hours=2)).isoformat()
+                    }],
+                    "override": override
+                }),
+                content_type='application/json',
+                headers={"Authorization": "Bearer " + token}
+            )
+
+        rv = post(high_team_id, False)
+        self.assertEquals(rv.status_code, 409)
+        self.assertTrue(json.loads(rv.data)["overridable"])
+        rv = post(low_team_id, True)
+        self.assertEquals(rv.status_code, 409)
+        self.assertFalse(json.loads(rv.data)["overridable"])
+        rv = post(high_team_id, True)
+        self.assertEquals(rv.status_code, 201)
+        self.assertIsNone(Reservation.query.get(low_id))
+
+    def test_recurrence_overlaps(self):
+        """Test finding overlapping occurrences without expanding them."""
+        monday = datetime.datetime(2030, 1, 7, 10)
+        hour = datetime.timedelta(hours=1)
+        week = datetime.timedelta(weeks=1)
+        weekly = Recurrence(monday, monday + hour, week,
+                            monday + 51 * week, [monday + 2 * week])
+        self.assertEquals(weekly.count, 52)
+        self.assertTrue(weekly.overlaps(monday + 30 * week,
+                                        monday + 30 * week + hour))
+        self.assertFalse(weekly.overlaps(monday + 2 * week,
+                                         monday + 2 * week + hour))
+        self.assertFalse(weekly.overlaps(monday + 52 * week,
+                                         monday + 52 * week + hour))
+        self.assertEquals(len(list(weekly.occurrences(monday, monday + 4 * week))), 4)
+
+        # Wednesdays every other week never meet Mondays
+        wednesday = monday + datetime.timedelta(days=2)
+        self.assertFalse(weekly.overlaps_recurrence(Recurrence(
+            wednesday, wednesday + hour, 2 * week, wednesday + 100 * week)))
+        # every third day lands on a Monday once in three weeks
+        self.assertTrue(weekly.overlaps_recurrence(Recurrence(
+            wednesday, wednesday + hour, datetime.timedelta(days=3),
+            wednesday + 100 * week)))
+        # ...but not if the series stops before then
+        self.assertFalse(weekly.overlaps_recurrence(Recurrence(
+            wednesday, wednesday + hour, datetime.timedelta(days=3),
+            wednesday + week)))
+
+    def test_reservation_series(self):
+        """Test adding a weekly series and booking around it."""
+        professor = User.query.filter_by(name='professor').first()
+        team = Team(name='class_2')
+        team.team_type = TeamType.query.filter_by(name='class').first()
+        team.members.append(professor)
+        database.get_db().add(team)
+        database.get_db().commit()
+        team_id = team.id
+        room_id = Room.query.first().id
+        token = professor.generate_auth_token()
+        monday = datetime.datetime(2030, 1, 7, 10)
+        week = datetime.timedelta(weeks=1)
+
+        def post(path, data):
+            return self.app.post(path, data=json.dumps(data),
+                                 content_type='application/json',
+                                 headers={"Authorization": "Bearer " + token})
+
+        def reserve(start):
+            return post('/v1/reservation', {
+                "team_id": team_id,
+                "room_id": room_id,
+                "start": start.isoformat(),
+                "end": (start + datetime.timedelta(hours=1)).isoformat()
+            })
+
+        num_reservations_before = len(Reservation.query.all())
+        rv = post('/v1/reservation/series', {
+            "team_id": team_id,
+            "room_id": room_id,
+            "start": monday.isoformat(),
+            "end": (monday + datetime.timedelta(hours=2)).isoformat(),
+            "frequency": "weekly",
+            "until": (monday + 15 * week).isoformat(),
+            "exceptions": [(monday + 5 * week).isoformat()]
+        })
+        self.assertEquals(rv.status_code, 201)
+        series_id = json.loads(rv.data)["id"]
+        self.assertEquals(len(Reservation.query.all()),
+                          num_reservations_before)
+
+        rv = self.app.get('/v1/reservation/series', query_string={
+            'start': (monday + 4 * week).isoformat(),
+            'end': (monday + 7 * week).isoformat()
+        })
+        self.assertEquals(rv.status_code, 200)
+        got = json.loads(rv.data)
+        self.assertEquals([s['id'] for s in got], [series_id])
+        self.assertEquals([o['start'] for o in got[0]['occurrences']], [
+            (monday + 4 * week).isoformat(),
+            (monday + 6 * week).isoformat(),
+            (monday + 7 * week).isoformat()
+        ])
+
+        rv = self.app.get('/v1/room/availability', query_string={
+            'start': (monday + 7 * week).isoformat(),
+            'end': (monday + 7 * week + datetime.timedelta(hours=4)).isoformat()
+        })
+        slots = [r['slots'] for r in json.loads(rv.data)
+                 if r['room']['id'] == room_id][0]
+        self.assertEquals([slot['start'] for slot in slots], [
+            (monday + 7 * week + datetime.timedelta(hours=2)).isoformat()
+        ])
+
+        # occurrences can't be overridden; skipped ones and the gaps
+        # between them are free
+        rv = reserve(monday + 10 * week + datetime.timedelta(minutes=30))
+        self.assertEquals(rv.status_code, 409)
+        self.assertFalse(json.loads(rv.data)["overridable"])
+        self.assertEquals(reserve(monday + 5 * week).status_code, 201)
+        self.assertEquals(reserve(monday + 3 * week +
+                                  datetime.timedelta(days=1)).status_code, 201)
+
+        # a daily series that would land on the weekly one can't be added
+        rv = post('/v1/reservation/series', {
+            "team_id": team_id,
+            "room_id": room_id,
+            "start": (monday + 8 * week - datetime.timedelta(days=2)).isoformat(),
+            "end": (monday + 8 * week - datetime.timedelta(days=2, hours=-1)).isoformat(),
+            "frequency": "daily",
+            "until": (monday + 9 * week).isoformat()
+        })
+        self.assertEquals(rv.status_code, 409)
+
+        rv = post('/v1/reservation/series/%d/exception' % series_id,
+                  {"start": (monday + 10 * week).isoformat()})
+        self.assertEquals(rv.status_code, 201)
+        self.assertEquals(reserve(monday + 10 * week).status_code, 201)
+
+        # occurrences are listed with reservations, paged by the same key
+        window = {'start': (monday + 4 * week).isoformat(),
+                  'end': (monday + 11 * week).isoformat()}
+        rv = self.app.get('/v1/reservation', query_string=window)
+        listed = [(r['start'], r['id'], r.get('series_id'))
+                  for r in json.loads(rv.data)]
+        self.assertEquals(listed, [
+            ((monday + 4 * week).isoformat(), None, series_id),
+            ((monday + 5 * week).isoformat(), listed[1][1], None),
+            ((monday + 6 * week).isoformat(), None, series_id),
+            ((monday + 7 * week).isoformat(), None, series_id),
+            ((monday + 8 * week).isoformat(), None, series_id),
+            ((monday + 9 * week).isoformat(), None, series_id),
+            ((monday + 10 * week).isoformat(), listed[6][1], None),
+            ((monday + 11 * week).isoformat(), None, series_id)
+        ])
+        paged = []
+        cursor = None
+        while True:
+            query = dict(window, limit=3)
+            if cursor:
+                query['cursor'] = cursor
+            rv = self.app.get('/v1/reservation', query_string=query)
+            self.assertEquals(rv.status_code, 200)
+            paged.extend((r['start'], r['id'], r.get('series_id'))
+                         for r in json.loads(rv.data))
+            cursor = rv.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.assertEquals(paged, listed)
+        rv = self.app.get('/v1/reservation', query_string=dict(
+            window, stream='true'))
+        self.assertEquals([(r['start'], r['id'], r.get('series_id'))
+                           for r in json.loads(rv.data)], listed)
+
+        # cancelling an occurrence is a feed event and drops the snapshots
+        upcoming = json.loads(self.app.get('/v1/reservation').data)
+        cursor = ReservationEvent.latest()
+        rv = post('/v1/reservation/series/%d/exception' % series_id,
+                  {"start": (monday + 11 * week).isoformat()})
+        self.assertEquals(rv.status_code, 201)
+        rv = self.app.get('/v1/reservation/changes?timeout=0&since=%d'
+                          % cursor)
+        self.assertEquals([(e['type'], e['series']['id'])
+                           for e in json.loads(rv.data)['events']],
+                          [('series', series_id)])
+        self.assertEquals(
+            len(json.loads(self.app.get('/v1/reservation').data)),
+            len(upcoming) - 1)
+
+        for bad in ({"frequency": ["weekly"]}, {"interval": 10 ** 30},
+                    {"interval": True}, {"team_id": [team_id]}):
+            data = {
+                "team_id": team_id,
+                "room_id": room_id,
+                "start": (monday + 30 * week).isoformat(),
+                "end": (monday + 30 * week +
+                        datetime.timedelta(hours=1)).isoformat(),
+                "frequency": "weekly",
+                "until": (monday + 40 * week).isoformat()
+            }
+            data.update(bad)
+            self.assertEquals(
+                post('/v1/reservation/series', data).status_code, 400)
+
     def test_update_basic_reservation(self):
         student = User.query.filter_by(name='student').first()
         team_type = TeamType.query.filter_by(name='other_team').first()
@@ -614,6 +1326,300 @@ class TestCase(unittest.TestCase):
         self.assertEquals(got["room"]["number"], reservation.room.number)
         self.assertEquals(got["id"], reservation.id)
 
+    def test_get_reservations_query_count(self):
+        """Test that listing reservations takes a fixed number of queries."""
+        start = datetime.datetime.now() + datetime.timedelta(days=1)
+
+        def add_reservations(count):
+            student = User.query.filter_by(name='student').first()
+            rooms = Room.query.all()
+            team_type = TeamType.query.filter_by(name='other_team').first()
+            for i in range(count):
+                team = Team(name='listing%d-%d' % (count, i))
+                team.team_type = team_type
+                team.members.append(student)
+                database.get_db().add(Reservation(
+                    start=start + datetime.timedelta(hours=i),
+                    end=start + datetime.timedelta(hours=i, minutes=30),
+                    team=team,
+                    room=rooms[i % len(rooms)],
+                    created_by=student
+                ))
+            database.get_db().commit()
+
+        def list_reservations():
+            database.get_db().remove()
+            with count_queries() as statements:
+                rv = self.app.get('/v1/reservation')
+            self.assertEquals(rv.status_code, 200)
+            return len(json.loads(rv.data)), len(statements)
+
+        add_reservations(2)
+        small_rows, small_queries = list_reservations()
+        add_reservations(20)
+        large_rows, large_queries = list_reservations()
+        self.assertEquals(large_rows - small_rows, 20)
+        self.assertEquals(small_queries, large_queries)
+
+    def test_get_reservations_snapshot(self):
+        """Test that upcoming reservations are served from a snapshot."""
+        student = User.query.filter_by(name='student').first()
+        team = Team(name='snapshot_team')
+        team.team_type = TeamType.query.filter_by(name='other_team').first()
+        team.members.append(student)
+        start = datetime.datetime.now() + datetime.timedelta(days=3)
+        database.get_db().add(Reservation(
+            start=start, end=start + datetime.timedelta(hours=1),
+            team=team, room=Room.query.first(), created_by=student))
+        database.get_db().commit()
+        team_id = team.id
+        room_id = Room.query.first().id
+        token = student.generate_auth_token()
+        professor_token = User.query.filter_by(
+            name='professor').first().generate_auth_token()
+
+        rv = self.app.get('/v1/reservation')
+        self.assertEquals(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        # a bad token is treated as no token at all
+        for auth in ('Bearer garbage', 'Basic abc'):
+            bad = self.app.get('/v1/reservation',
+                               headers={'Authorization': auth})
+            self.assertEquals(bad.status_code, 200)
+            self.assertEquals(bad.headers['ETag'], etag)
+        with count_queries() as statements:
+            rv = self.app.get('/v1/reservation',
+                              headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 304)
+        self.assertEquals(rv.data, '')
+        self.assertEquals(len(statements), 0)
+
+        # elevated viewers get their own snapshot, with team details
+        rv = self.app.get('/v1/reservation', headers={
+            'Authorization': 'Bearer ' + professor_token,
+            'If-None-Match': etag
+        })
+        self.assertEquals(rv.status_code, 200)
+        self.assertTrue(all('name' in r['team'] for r in json.loads(rv.data)))
+
+        rv = self.app.post('/v1/reservation', data=json.dumps({
+            "team_id": team_id,
+            "room_id": room_id,
+            "start": (start + datetime.timedelta(hours=2)).isoformat(),
+            "end": (start + datetime.timedelta(hours=3)).isoformat()
+        }), content_type='application/json',
+            headers={"Authorization": "Bearer " + token})
+        self.assertEquals(rv.status_code, 201)
+        rv = self.app.get('/v1/reservation',
+                          headers={'If-None-Match': etag})
+        self.assertEquals(rv.status_code, 200)
+        self.assertNotEquals(rv.headers['ETag'], etag)
+
+    def test_get_reservations_paginated(self):
+        """Test walking the reservation list a page at a time."""
+        admin = User.query.filter_by(name='admin').first()
+        team = admin.teams[0]
+        room = Room.query.first()
+        start = datetime.datetime.now() + datetime.timedelta(days=1)
+        for i in range(5):
+            database.get_db().add(Reservation(
+                start=start + datetime.timedelta(hours=i),
+                end=start + datetime.timedelta(hours=i, minutes=30),
+                team=team, room=room, created_by=admin))
+        database.get_db().commit()
+
+        seen = []
+        url = '/v1/reservation?limit=2'
+        while True:
+            rv = self.app.get(url)
+            self.assertEquals(rv.status_code, 200)
+            page = json.loads(rv.data)
+            self.assertTrue(len(page) <= 2)
+            seen.extend(page)
+            if 'X-Next-Cursor' not in rv.headers:
+                break
+            url = '/v1/reservation?limit=2&cursor=' + \
+                rv.headers['X-Next-Cursor']
+        self.assertEquals(len(seen), 6)
+        self.assertEquals(len(set(r['id'] for r in seen)), 6)
+        self.assertEquals(seen, sorted(seen, key=lambda r: (r['start'],
+                                                           r['id'])))
+
+    def test_get_reservations_streamed(self):
+        """Test that a streamed listing matches the paged one."""
+        admin = User.query.filter_by(name='admin').first()
+        team = admin.teams[0]
+        room = Room.query.first()
+        start = datetime.datetime.now() + datetime.timedelta(days=1)
+        for i in range(3):
+            database.get_db().add(Reservation(
+                start=start + datetime.timedelta(hours=i),
+                end=start + datetime.timedelta(hours=i, minutes=30),
+                team=team, room=room, created_by=admin))
+        database.get_db().commit()
+
+        paged = json.loads(self.app.get('/v1/reservation').data)
+        rv = self.app.get('/v1/reservation?stream=true')
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data), paged)
+
+        rv = self.app.get('/v1/reservation?stream=true',
+                          headers={'Accept': 'application/x-ndjson'})
+        self.assertEquals(rv.content_type, 'application/x-ndjson')
+        lines = rv.data.splitlines()
+        self.assertEquals(map(json.loads, lines), paged)
+
+        # elevated users also get team members, loaded a batch at a time
+        headers = {'Authorization': 'Bearer ' + User.query.filter_by(
+            name='professor').first().generate_auth_token()}
+        paged = json.loads(self.app.get('/v1/reservation',
+                                        headers=headers).data)
+        rv = self.app.get('/v1/reservation?stream=true', headers=headers)
+        self.assertEquals(rv.status_code, 200)
+        streamed = json.loads(rv.data)
+        self.assertEquals(streamed, paged)
+        self.assertEquals(streamed[-1]['team']['members'][0]['name'],
+                          'admin')
+
+        database.get_db().query(Reservation).delete()
+        database.get_db().commit()
+        rv = self.app.get('/v1/reservation?stream=true')
+        self.assertEquals(json.loads(rv.data), [])
+
+    def test_list_bad_page_params(self):
+        """Test that invalid limits and cursors are rejected."""
+        self.assertEquals(self.app.get('/v1/room?limit=0').status_code, 400)
+        self.assertEquals(self.app.get('/v1/room?limit=x').status_code, 400)
+        self.assertEquals(
+            self.app.get('/v1/feature?cursor=garbage').status_code, 400)
+        rv = self.app.get('/v1/room?limit=4')
+        self.assertEquals(len(json.loads(rv.data)), 4)
+        rv = self.app.get('/v1/room?limit=4&cursor=' +
+                          rv.headers['X-Next-Cursor'])
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(len(json.loads(rv.data)), 4)
+
+        # well-formed cursors holding values of the wrong type
+        for path, values in (
+                ('/v1/user?search=a', [None, None]),
+                ('/v1/user?search=a', ['a', True]),
+                ('/v1/reservation', ['2017-01-01T00:00:00', {}]),
+                ('/v1/room', [{}]),
+                ('/v1/room', ['x']),
+                ('/v1/feature', [1.5])):
+            rv = self.app.get('%s%scursor=%s' % (
+                path, '&' if '?' in path else '?',
+                base64.urlsafe_b64encode(json.dumps(values))))
+            self.assertEquals(rv.status_code, 400)
+
+    def test_user_search(self):
+        """Test paging through users by prefix, with and without the
+        in-memory name index."""
+        for name in ('Pat', 'patrick', 'PATTY', 'pa_ul', 'paxton'):
+            database.get_db().add(User(name, name + '@example.com'))
+        database.get_db().commit()
+
+        def search(prefix):
+            names = []
+            url = '/v1/user?limit=2&search=' + prefix
+            while url:
+                rv = self.app.get(url)
+                self.assertEquals(rv.status_code, 200)
+                names.extend(u['name'] for u in json.loads(rv.data))
+                cursor = rv.headers.get('X-Next-Cursor')
+                url = cursor and '/v1/user?limit=2&search=%s&cursor=%s' % (
+                    prefix, cursor)
+            return names
+
+        try:
+            # unset, the index is only used on SQLite
+            models.use_name_index = None
+            self.assertTrue(models._use_name_index())
+            for use_index in (None, True, False):
+                models.use_name_index = use_index
+                self.assertEquals(search('pat'), ['Pat', 'patrick', 'PATTY'])
+                self.assertEquals(search('PA_'), ['pa_ul'])
+                self.assertEquals(search('pa%25'), [])
+                self.assertEquals(
+                    self.app.get('/v1/user?search=pa&cursor=x').status_code,
+                    400)
+
+            models.use_name_index = True
+            self.app.post('/v1/auth', data='{"username": "pattern"}',
+                          content_type='application/json')
+            self.assertEquals(search('patt'), ['pattern', 'PATTY'])
+        finally:
+            models.use_name_index = True
+
+    def test_user_search_cache(self):
+        """Test that longer prefixes are answered from a cached shorter
+        one until auth adds a user."""
+        for name in ('Pat', 'patrick', 'paxton'):
+            database.get_db().add(User(name, name + '@example.com'))
+        database.get_db().commit()
+
+        def search(prefix):
+            rv = self.app.get('/v1/user?search=' + prefix)
+            self.assertEquals(rv.status_code, 200)
+            return [u['name'] for u in json.loads(rv.data)]
+
+        try:
+            models.use_name_index = False
+            self.assertEquals(search('pa'), ['Pat', 'patrick', 'paxton'])
+            # each search is one hit or miss, however many prefixes it tries
+            hits = models.user_search_cache.hits
+            misses = models.user_search_cache.misses
+            self.assertEquals(search('patr'), ['patrick'])
+            self.assertEquals(models.user_search_cache.hits, hits + 1)
+            self.assertEquals(models.user_search_cache.misses, misses)
+            self.assertEquals(search('zed'), [])
+            self.assertEquals(models.user_search_cache.misses, misses + 1)
+            with count_queries() as statements:
+                self.assertEquals(search('pat'), ['Pat', 'patrick'])
+                self.assertEquals(search('PATR'), ['patrick'])
+                rv = self.app.get('/v1/user?limit=1&search=pa')
+            self.assertEquals(statements, [])
+            # later pages are read in the database's order
+            with count_queries() as statements:
+                rv = self.app.get('/v1/user?limit=1&search=pa&cursor=' +
+                                  rv.headers['X-Next-Cursor'])
+            self.assertEquals([u['name'] for u in json.loads(rv.data)],
+                              ['patrick'])
+            self.assertEquals(len(statements), 1)
+
+            self.app.post('/v1/auth', data='{"username": "patsy"}',
+                          content_type='application/json')
+            self.assertEquals(search('pat'), ['Pat', 'patrick', 'patsy'])
+
+            # too many matches to cache, but enough for the page
+            models.user_search_cache_matches = 1
+            models.user_search_cache.clear()
+            self.assertEquals(search('pat'), ['Pat', 'patrick', 'patsy'])
+            self.assertEquals(models.user_search_cache.get('pat'), None)
+        finally:
+            models.use_name_index = True
+            models.user_search_cache_matches = MAX_LIMIT
+
+        cache = LRUCache(max_size=10, weigh=len, max_weight=4)
+        cache.set('a', (1, 2))
+        cache.set('b', (1, 2, 3))
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.weight, 3)
+
+    def test_dumps_encodes_datetimes(self):
+        """Test that every JSON backend writes datetimes as ISO 8601."""
+        import serialization
+        when = datetime.datetime(2017, 1, 29, 16, 2, 23, 913000)
+        for name in ('json', 'simplejson'):
+            try:
+                _, encode = serialization.load_backend(name)
+            except ImportError:
+                continue
+            self.assertEquals(json.loads(encode({'start': when})),
+                              {'start': '2017-01-29T16:02:23.913000'})
+        self.assertRaises(TypeError, serialization.dumps, object())
+        self.assertRaises(ValueError, serialization.load_backend, 'ujson')
+
     def test_room_read(self):
         """ test that querying an existing room returns json data """
         room = Room.query.first()
@@ -626,6 +1632,184 @@ class TestCase(unittest.TestCase):
         self.assertTrue('features' in got)
         self.assertTrue(len(got['features']) > 0)
 
+    def test_room_availability(self):
+        """Test finding free slots around existing reservations."""
+        room = Room.query.filter_by(number='1660').first()
+        res = Reservation.query.filter_by(room_id=room.id).first()
+        window_start = res.start - datetime.timedelta(hours=2)
+        window_end = res.end + datetime.timedelta(hours=3)
+        rv = self.app.get('/v1/room/availability', query_string={
+            'start': window_start.isoformat(),
+            'end': window_end.isoformat(),
+            'duration': 90
+        })
+        self.assertEquals(rv.status_code, 200)
+        got = json.loads(rv.data)
+        self.assertEquals(len(got), len(Room.query.all()))
+        slots = [r['slots'] for r in got if r['room']['id'] == room.id][0]
+        # the two hours before the reservation, the three hours after it
+        self.assertEquals(slots, [
+            {'start': window_start.isoformat(), 'end': res.start.isoformat()},
+            {'start': res.end.isoformat(), 'end': window_end.isoformat()}
+        ])
+
+        rv = self.app.get('/v1/room/availability', query_string={
+            'start': window_start.isoformat(),
+            'end': window_end.isoformat(),
+            'duration': 150
+        })
+        slots = [r['slots'] for r in json.loads(rv.data)
+                 if r['room']['id'] == room.id][0]
+        self.assertEquals(len(slots), 1)
+
+    def test_room_availability_features(self):
+        """Test that availability only lists rooms with every feature."""
+        tv = RoomFeature.query.filter_by(name='TV').first()
+        webcam = RoomFeature.query.filter_by(name='Webcam').first()
+        projector = RoomFeature.query.filter_by(name='Projector').first()
+        start = datetime.datetime(2017, 3, 1, 8)
+        params = {
+            'start': start.isoformat(),
+            'end': (start + datetime.timedelta(hours=8)).isoformat(),
+            'features': '%d,%d' % (tv.id, webcam.id)
+        }
+        rv = self.app.get('/v1/room/availability', query_string=params)
+        self.assertEquals(rv.status_code, 200)
+        numbers = sorted(r['room']['number'] for r in json.loads(rv.data))
+        self.assertEquals(numbers, ['1561', '1565', '1665'])
+
+        params['features'] = '%d,%d' % (projector.id, webcam.id)
+        rv = self.app.get('/v1/room/availability', query_string=params)
+        self.assertEquals(json.loads(rv.data), [])
+
+        params['features'] = 'x'
+        rv = self.app.get('/v1/room/availability', query_string=params)
+        self.assertEquals(rv.status_code, 400)
+
+        del params['features']
+        for duration in ('-1', str(32 * 24 * 60), '10' * 20):
+            params['duration'] = duration
+            rv = self.app.get('/v1/room/availability', query_string=params)
+            self.assertEquals(rv.status_code, 400)
+
+    def test_room_list_feature_filter(self):
+        """Test filtering rooms by feature, before and after an update."""
+        projector = RoomFeature.query.filter_by(name='Projector').first()
+        webcam = RoomFeature.query.filter_by(name='Webcam').first()
+        room = Room.query.filter_by(number='1560').first()
+        room_id = room.id
+        url = '/v1/room?features=%d,%d' % (projector.id, webcam.id)
+
+        rv = self.app.get(url)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(json.loads(rv.data), [])
+
+        rv = self.app.put(
+            '/v1/room/' + str(room_id),
+            data=json.dumps({
+                'number': '1560',
+                'features': [projector.id, webcam.id]
+            }),
+            content_type='application/json'
+        )
+        self.assertEquals(rv.status_code, 204)
+        rv = self.app.put(
+            '/v1/room/' + str(room_id),
+            data=json.dumps({'number': '1560', 'features': [True]}),
+            content_type='application/json'
+        )
+        self.assertEquals(rv.status_code, 400)
+
+        rv = self.app.get(url)
+        self.assertEquals([r['id'] for r in json.loads(rv.data)], [room_id])
+        rv = self.app.get('/v1/room?features=%d' % projector.id)
+        self.assertEquals(len(json.loads(rv.data)), 6)
+
+        # bit positions don't depend on how large the room ids are
+        index = FeatureIndex(lambda: [(10 ** 9, 1), (7, 1), (7, 2)])
+        self.assertEquals(index.rooms_with([1]), [7, 10 ** 9])
+        self.assertEquals(index.rooms_with([1, 2]), [7])
+        self.assertTrue(index._bitsets[1] < 4)
+
+        # as with several workers, without the in-memory index
+        models.use_feature_index = False
+        try:
+            self.assertEquals(Room.with_features([projector.id, webcam.id]),
+                              [room_id])
+            self.assertEquals(len(Room.with_features([projector.id])), 6)
+        finally:
+            models.use_feature_index = True
+
+    def test_room_conditional_get(self):
+        """Test that room reads honor ETags until a room changes."""
+        room = Room.query.first()
+        room_id = room.id
+        number = room.number
+        paths = ['/v1/room', '/v1/room/%d' % room_id, '/v1/feature']
+        etags = {}
+        last_modified = {}
+        # Last-Modified is only sent once the second of the change is over
+        rv = self.app.get('/v1/feature')
+        self.assertNotIn('Last-Modified', rv.headers)
+        for counter in (room_version, feature_version):
+            counter.modified -= datetime.timedelta(seconds=5)
+        for path in paths:
+            rv = self.app.get(path)
+            self.assertEquals(rv.status_code, 200)
+            etags[path] = rv.headers['ETag']
+            last_modified[path] = rv.headers['Last-Modified']
+            with count_queries() as statements:
+                rv = self.app.get(path, headers={
+                    'If-None-Match': etags[path]})
+            self.assertEquals(rv.status_code, 304)
+            self.assertEquals(len(statements), 0)
+            rv = self.app.get(path, headers={
+                'If-Modified-Since': last_modified[path]})
+            self.assertEquals(rv.status_code, 304)
+
+        rv = self.app.put('/v1/room/%d' % room_id, data=json.dumps({
+            'number': number + 'b',
+            'features': []
+        }), content_type='application/json')
+        self.assertEquals(rv.status_code, 204)
+        for path in paths[:2]:
+            rv = self.app.get(path, headers={'If-None-Match': etags[path]})
+            self.assertEquals(rv.status_code, 200)
+            self.assertTrue(number + 'b' in rv.data)
+            self.assertNotIn('Last-Modified', rv.headers)
+            rv = self.app.get(path, headers={
+                'If-Modified-Since': last_modified[path]})
+            self.assertEquals(rv.status_code, 200)
+        # a second change in the same second still makes If-Modified-Since
+        # fail, as the first never handed out its time
+        for counter in (room_version, feature_version):
+            counter.bump()
+        rv = self.app.get(paths[0], headers={
+            'If-Modified-Since': http_date(room_version.modified)})
+        self.assertEquals(rv.status_code, 200)
+        rv = self.app.get('/v1/feature',
+                          headers={'If-None-Match': etags['/v1/feature']})
+        self.assertEquals(rv.status_code, 304)
+
+        # as with several workers, which can't tell when others wrote
+        main.use_last_modified = False
+        try:
+            rv = self.app.get('/v1/feature', headers={
+                'If-Modified-Since': last_modified['/v1/feature']})
+            self.assertEquals(rv.status_code, 200)
+            self.assertNotIn('Last-Modified', rv.headers)
+        finally:
+            main.use_last_modified = True
+
+    def test_version_counter(self):
+        """Test that changes bump the version and record their second."""
+        counter = VersionCounter()
+        counter.bump()
+        counter.bump()
+        self.assertEquals(counter.version, 2)
+        self.assertTrue(counter.modified <= datetime.datetime.utcnow())
+        self.assertEquals(counter.modified.microsecond, 0)
+
     def test_room_not_found(self):
         """Test that get room returns a 404 for unknown rooms."""
         self.assertIsNone(Room.query.get(100))
@@ -749,5 +1933,33 @@ class TestCase(unittest.TestCase):
         self.assertEquals(len(new_team.members), 2)
 
 
+def run_parallel(jobs):
+    """Split the tests between jobs processes; return whether all passed."""
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestCase)
+    names = [test.id().split('.', 1)[1] for test in suite]
+    started = time.time()
+    # workers write to temporary files rather than pipes, so none of them
+    # blocks on a full pipe while an earlier one is being waited for
+    outputs = [tempfile.TemporaryFile() for _ in range(min(jobs, len(names)))]
+    workers = [
+        subprocess.Popen([sys.executable, os.path.abspath(__file__)] +
+                         names[i::jobs],
+                         stdout=output, stderr=subprocess.STDOUT)
+        for i, output in enumerate(outputs)]
+    passed = True
+    for worker, output in zip(workers, outputs):
+        if worker.wait() != 0:
+            passed = False
+            output.seek(0)
+            sys.stdout.write(output.read())
+        output.close()
+    print 'Ran %d tests in %d processes in %.3fs: %s' % (
+        len(names), len(workers), time.time() - started,
+        'OK' if passed else 'FAILED')
+    return passed
+
+
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--jobs':
+        sys.exit(0 if run_parallel(int(sys.argv[2])) else 1)
     unittest.main()
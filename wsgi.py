@@ -0,0 +1,8 @@
+"""WSGI entry point.
+
+Serve with a WSGI server rather than the Flask development server, e.g.
+
+    gunicorn -c gunicorn_conf.py wsgi:app
+"""
+
+from main import app